@@ -0,0 +1,180 @@
+import logging
+import random
+import threading
+from time import monotonic, time
+
+try:
+    from packets import encode_packet
+except ImportError:
+    from app.src.packets import encode_packet
+
+# Child of the 'scan' logger so records land in scan.log
+logger = logging.getLogger('scan.batching')
+
+BATCH_VERSION = 1
+
+
+class BatchPublisher(threading.Thread):
+    """
+    Coalesce BLE sightings into one 'raw_channel' message per time window.
+
+    Sightings are grouped per beacon. A batch is flushed when the oldest
+    sighting in it reaches `window` seconds of age, or as soon as it holds
+    `max_sightings` sightings, whichever comes first.
+
+    A flushed batch looks like:
+      {"v": 1,
+       "node": "node_name",
+       "trace": {},  # Only in sampled batches; see tracing.py
+       "beacons": {
+           "bt_addr": {"s": [[rssi, epoch_seconds], ...],
+                       "packet": {"type": "EddystoneUIDFrame", ...},
+                       "properties": {...}},
+           ...
+       }}
+    """
+
+    def __init__(self, publish_fn, node_name, window=1.0, max_sightings=500,
+                 trace_rate=0.0):
+        """
+        :param publish_fn: callable Called with each batch message (a dict)
+        :param node_name: str Name of the node doing the scanning
+        :param window: float Max age in seconds of a batch before flushing
+        :param max_sightings: int Max sightings in a batch before flushing
+        :param trace_rate: float Fraction of batches to trace, 0 to 1; the
+          send path stamps their tx time (see tracing.stamping)
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.publish_fn = publish_fn
+        self.node_name = node_name
+        self.window = max(float(window), 0.0)
+        self.max_sightings = max(int(max_sightings), 1)
+        self.trace_rate = trace_rate
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._beacons = {}
+        self._count = 0
+        self._opened = 0.0  # monotonic time of first sighting in batch
+
+    def add(self, bt_addr, rssi, packet=None, properties=None, timestamp=None):
+        """
+        Add a single sighting to the current batch. Packets are kept as-is
+          and only encoded when the batch is flushed.
+        :param bt_addr: str Beacon MAC address
+        :param rssi: int Received signal strength
+        :param packet: obj Last beacontools packet for this beacon
+        :param properties: obj Last beacontools properties for this beacon
+        :param timestamp: float Epoch seconds of the sighting (default now)
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self._cond:
+            slot = self._beacons.get(bt_addr)
+            if slot is None:
+                slot = self._beacons[bt_addr] = {"s": []}
+            slot["s"].append([rssi, round(timestamp, 3)])
+            slot["packet"] = packet
+            slot["properties"] = properties
+
+            self._count += 1
+            if self._count == 1:
+                self._opened = monotonic()
+                self._cond.notify()
+            elif self._count >= self.max_sightings:
+                self._cond.notify()
+
+    def pending(self):
+        """:return: int Sightings in the current batch"""
+        return self._count
+
+    def _due(self):
+        if not self._count:
+            return False
+        return (self._count >= self.max_sightings or
+                monotonic() - self._opened >= self.window)
+
+    def _timeout(self):
+        if not self._count:
+            return None
+        return max(0.0, self._opened + self.window - monotonic())
+
+    def _take(self):
+        """Swap out the current batch and render it. Call with lock held."""
+        if not self._count:
+            return None
+        beacons = self._beacons
+        self._beacons = {}
+        self._count = 0
+
+        for slot in beacons.values():
+            slot["packet"] = encode_packet(slot["packet"])
+            slot["properties"] = encode_packet(slot["properties"])
+        batch = {"v": BATCH_VERSION,
+                 "node": self.node_name,
+                 "beacons": beacons}
+        if self.trace_rate and random.random() < self.trace_rate:
+            batch["trace"] = {}
+        return batch
+
+    def flush(self):
+        """Publish whatever is in the current batch immediately."""
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._publish(batch)
+
+    def _publish(self, batch):
+        try:
+            self.publish_fn(batch)
+        except Exception:
+            logger.exception("Failed to publish batch of {} beacons"
+                             .format(len(batch["beacons"])))
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._due():
+                    self._cond.wait(self._timeout())
+                running = self._running
+                batch = self._take()
+            if batch:
+                self._publish(batch)
+            if not running:
+                return
+
+    def stop(self, timeout=2.0):
+        """Flush the pending batch and stop the publisher thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
+        else:
+            self.flush()
+
+
+def is_batch(message):
+    return isinstance(message, dict) and "beacons" in message
+
+
+def unbatch(message):
+    """
+    Expand a batch message into legacy 'raw_channel' list messages, like:
+      [bt_addr, rssi, packet, properties, epoch_seconds, node_name]
+    :param message: dict A batch message built by BatchPublisher
+    :return: generator of list
+    """
+    node_name = message["node"]
+    for bt_addr, slot in message["beacons"].items():
+        packet = slot.get("packet")
+        properties = slot.get("properties")
+        for rssi, timestamp in slot["s"]:
+            yield [bt_addr,
+                   rssi,
+                   packet,
+                   properties,
+                   timestamp,
+                   node_name]
@@ -3,8 +3,11 @@ from pathlib import Path
 
 import dotenv
 from bottle import route, run, template, request
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
+
+try:
+    from transport import is_pubnub, make_transport
+except ImportError:
+    from app.src.transport import is_pubnub, make_transport
 
 INTERNAL_POST = "/locate"
 POST_TO = "https://localhost:8765/locate"
@@ -118,19 +121,20 @@ def set_pi_location():
         env = Path(ENV_FILE)
         if env.exists():
             dotenv.load_dotenv(str(env.absolute()))
-        pnconfig = PNConfiguration()
-        pub_key = os.environ["PUB_KEY"]
-        sub_key = os.environ["SUB_KEY"]
-        if pub_key is not None and sub_key is not None:
-            pnconfig.subscribe_key = sub_key
-            pnconfig.publish_key = pub_key
-            pnconfig.ssl = False
-            pubnub = PubNub(pnconfig)
-            pubnub.publish() \
-                .channel('nodes') \
-                .message(init_message) \
-                .should_store(True) \
-                .sync()
+        url = os.environ.get("TRANSPORT")
+        pub_key = os.environ.get("PUB_KEY")
+        sub_key = os.environ.get("SUB_KEY")
+        # Only PubNub needs the keys
+        if not is_pubnub(url) or (pub_key is not None and
+                                  sub_key is not None):
+            transport = make_transport(url, pub_key, sub_key)
+            try:
+                published = transport.publish_sync('nodes', init_message)
+            finally:
+                transport.close()
+            if not published:
+                raise IOError("Couldn't publish the new coords to {}"
+                              .format(url or "PubNub"))
 
             return template(
                 """
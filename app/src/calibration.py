@@ -0,0 +1,318 @@
+import json
+import math
+import os
+import threading
+
+import numpy
+
+try:
+    from batching import is_batch, unbatch
+    from recording import read_records
+    from registry import NODE_SNAPSHOT, NodeRegistry
+    from wire import WireDecoder
+except ImportError:
+    from app.src.batching import is_batch, unbatch
+    from app.src.recording import read_records
+    from app.src.registry import NODE_SNAPSHOT, NodeRegistry
+    from app.src.wire import WireDecoder
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+CALIBRATION_FILE = os.path.join(FILE_DIR, "..", "..", "calibration.json")
+
+# Matches any node or any beacon type in a table entry
+ANY = "*"
+
+# Settings for inside RAIN
+DEFAULT_N = 3.1  # Path loss exponent = 1.6-1.8 w/LOS to beacon indoors
+DEFAULT_MEASURED_RSSI = -46  # Beacon-specific measured RSSI @ 1m
+
+# Settings for inside a normal house
+# DEFAULT_N = 2.7
+# DEFAULT_MEASURED_RSSI = -59.8
+
+# Fitted exponents are kept in a physically sensible range
+MIN_N = 1.0
+MAX_N = 6.0
+
+
+def beacon_type(packet):
+    """
+    :param packet: dict An encoded packet from a 'raw_channel' message
+    :return: str The packet type, like "EddystoneUIDFrame", or ANY
+    """
+    if isinstance(packet, dict):
+        return packet.get("type") or ANY
+    return ANY
+
+
+class CalibrationTable(object):
+    """
+    Path-loss parameters per (node, beacon type), for turning RSSI into
+      distance with the log-distance model:
+        distance = 10 ** ((measured_rssi - rssi) / (10 * n))
+
+    Lookups fall back from (node, beacon) to (node, *), then (*, beacon),
+    then the defaults. Names are interned to integer ids so a batch of
+    RSSI values converts in one vectorized call; see rssi_to_distance.
+    """
+
+    def __init__(self, n=DEFAULT_N, measured_rssi=DEFAULT_MEASURED_RSSI,
+                 entries=None):
+        """
+        :param n: float Default path loss exponent
+        :param measured_rssi: float Default RSSI at 1 meter
+        :param entries: dict { (node, beacon_type): (n, measured_rssi) },
+          where either name may be ANY
+        """
+        self.default = (float(n), float(measured_rssi))
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._node_ids = {}
+        self._beacon_ids = {}
+        self._n = numpy.full((1, 1), self.default[0])
+        self._ref = numpy.full((1, 1), self.default[1])
+        self._params = {}  # (node, beacon) -> (10 * n, measured_rssi)
+        for (node, beacon), params in (entries or {}).items():
+            self.set(node, beacon, *params)
+
+    def set(self, node, beacon, n, measured_rssi):
+        with self._lock:
+            self.entries[(node, beacon)] = (float(n), float(measured_rssi))
+            # Every lookup may fall back differently now
+            self._params = {}
+            self._fill(range(len(self._node_ids)),
+                       range(len(self._beacon_ids)))
+
+    def params(self, node, beacon=ANY):
+        """:return: tuple (n, measured_rssi) for the node and beacon type"""
+        entries = self.entries
+        for key in ((node, beacon), (node, ANY), (ANY, beacon), (ANY, ANY)):
+            params = entries.get(key)
+            if params is not None:
+                return params
+        return self.default
+
+    def distance(self, rssi, node, beacon=ANY):
+        """
+        Convert a single RSSI value.
+        :return: float Distance in meters
+        """
+        params = self._params.get((node, beacon))
+        if params is None:
+            n, measured_rssi = self.params(node, beacon)
+            params = self._params[(node, beacon)] = (10 * n, measured_rssi)
+        return 10 ** ((params[1] - rssi) / params[0])
+
+    def node_id(self, node):
+        """:return: int The id of the node's row in the tables"""
+        node_id = self._node_ids.get(node)
+        if node_id is None:
+            with self._lock:
+                node_id = self._intern(self._node_ids, node, axis=0)
+        return node_id
+
+    def beacon_id(self, beacon):
+        """:return: int The id of the beacon type's column in the tables"""
+        beacon_id = self._beacon_ids.get(beacon)
+        if beacon_id is None:
+            with self._lock:
+                beacon_id = self._intern(self._beacon_ids, beacon, axis=1)
+        return beacon_id
+
+    def _intern(self, ids, name, axis):
+        """Add a row or column for name, growing the tables if full."""
+        if name in ids:
+            return ids[name]
+        new_id = ids[name] = len(ids)
+        if new_id >= self._n.shape[axis]:
+            pad = [(0, 0), (0, 0)]
+            pad[axis] = (0, self._n.shape[axis])
+            self._n = numpy.pad(self._n, pad, mode="edge")
+            self._ref = numpy.pad(self._ref, pad, mode="edge")
+        if axis == 0:
+            self._fill([new_id], range(len(self._beacon_ids)))
+        else:
+            self._fill(range(len(self._node_ids)), [new_id])
+        return new_id
+
+    def _fill(self, node_ids, beacon_ids):
+        nodes = dict((i, name) for name, i in self._node_ids.items())
+        beacons = dict((i, name) for name, i in self._beacon_ids.items())
+        for i in node_ids:
+            for j in beacon_ids:
+                self._n[i, j], self._ref[i, j] = \
+                    self.params(nodes[i], beacons[j])
+
+    def rssi_to_distance(self, rssi, node_ids, beacon_ids):
+        """
+        Convert many RSSI values at once.
+        :param rssi: numpy.ndarray RSSI values
+        :param node_ids: numpy.ndarray Ids from node_id, one per value
+        :param beacon_ids: numpy.ndarray Ids from beacon_id, one per value
+        :return: numpy.ndarray Distances in meters
+        """
+        n = self._n[node_ids, beacon_ids]
+        measured_rssi = self._ref[node_ids, beacon_ids]
+        return 10 ** ((measured_rssi - numpy.asarray(rssi, dtype=float)) /
+                      (10 * n))
+
+    def to_dict(self):
+        return {"default": {"n": self.default[0],
+                            "measured_rssi": self.default[1]},
+                "entries": [{"node": node, "beacon": beacon,
+                             "n": n, "measured_rssi": measured_rssi}
+                            for (node, beacon), (n, measured_rssi)
+                            in sorted(self.entries.items())]}
+
+    @classmethod
+    def from_dict(cls, data):
+        default = data.get("default", {})
+        return cls(n=default.get("n", DEFAULT_N),
+                   measured_rssi=default.get("measured_rssi",
+                                             DEFAULT_MEASURED_RSSI),
+                   entries=dict(((e.get("node", ANY), e.get("beacon", ANY)),
+                                 (e["n"], e["measured_rssi"]))
+                                for e in data.get("entries", ())))
+
+    @classmethod
+    def load(cls, path=CALIBRATION_FILE):
+        """
+        :return: CalibrationTable From the file, or the defaults if there
+          is no such file
+        """
+        try:
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path=CALIBRATION_FILE):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(temp_path, path)
+
+
+def fit_path_loss(rssi, distances):
+    """
+    Least squares fit of rssi = measured_rssi - 10 * n * log10(distance).
+    :return: tuple (n, measured_rssi), or None if the distances don't vary
+      enough to tell n apart from measured_rssi
+    """
+    x = -10 * numpy.log10(numpy.maximum(distances, 0.1))
+    if len(x) < 2 or x.std() < 0.5:  # Under about 12% spread in distance
+        return None
+    n, measured_rssi = numpy.polyfit(x, rssi, 1)
+    n = min(max(float(n), MIN_N), MAX_N)
+    # Refit the intercept in case n was clamped
+    return n, float(numpy.mean(rssi - n * x))
+
+
+def fit(nodes, beacons, rssi, distances, min_samples=20):
+    """
+    Learn a CalibrationTable from sightings at known distances. Each
+      (node, beacon), node, and beacon type with at least min_samples
+      sightings gets its own entry; everything together gives the default.
+    :param nodes: list Node name of each sighting
+    :param beacons: list Beacon type of each sighting
+    :param rssi: list RSSI of each sighting
+    :param distances: list True distance of each sighting, in meters
+    :return: CalibrationTable
+    """
+    nodes = numpy.asarray(nodes)
+    beacons = numpy.asarray(beacons)
+    rssi = numpy.asarray(rssi, dtype=float)
+    distances = numpy.asarray(distances, dtype=float)
+
+    default = fit_path_loss(rssi, distances) or \
+        (DEFAULT_N, DEFAULT_MEASURED_RSSI)
+    table = CalibrationTable(*default)
+    groups = [(node, ANY) for node in set(nodes.tolist())]
+    groups += [(ANY, beacon) for beacon in set(beacons.tolist())]
+    groups += [(node, beacon) for node, beacon in
+               set(zip(nodes.tolist(), beacons.tolist()))]
+    for node, beacon in groups:
+        rows = numpy.ones(len(rssi), dtype=bool)
+        if node != ANY:
+            rows &= nodes == node
+        if beacon != ANY:
+            rows &= beacons == beacon
+        if rows.sum() < min_samples:
+            continue
+        params = fit_path_loss(rssi[rows], distances[rows])
+        if params is not None:
+            table.set(node, beacon, *params)
+    return table
+
+
+def read_session(path):
+    """
+    Read the sightings in a session recorded with recording.Recorder (or
+      imported from a node log with recording.import_node_log).
+    :param path: str Recording file
+    :return: generator of list [bt_addr, rssi, packet, properties,
+      timestamp, node_name]
+    """
+    decoder = WireDecoder()
+    for _, _, message in read_records(path, channels=('raw_channel',)):
+        message = decoder.decode(message)
+        if is_batch(message):
+            for sighting in unbatch(message):
+                yield sighting
+        else:
+            yield message
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Fit path loss parameters from a recorded session '
+                    'with beacons at known positions.'
+    )
+    parser.add_argument(
+        'session', help='Recording of the session (see recording.py)'
+    )
+    parser.add_argument(
+        'positions', help='JSON file of beacon positions, { bt_addr: [x, y] }'
+    )
+    parser.add_argument(
+        '--nodes', default=NODE_SNAPSHOT,
+        help='JSON file of node positions, { name: [x, y] }'
+    )
+    parser.add_argument(
+        '--out', default=CALIBRATION_FILE,
+        help='Where to write the calibration table'
+    )
+    parser.add_argument(
+        '--min_samples', type=int, default=20,
+        help='Sightings needed to fit a node or beacon type on its own'
+    )
+    args = parser.parse_args()
+
+    with open(args.positions) as f:
+        positions = json.load(f)
+    node_map = NodeRegistry(snapshot_path=args.nodes)
+
+    columns = ([], [], [], [])
+    skipped = 0
+    for sighting in read_session(args.session):
+        bt_addr, rssi, packet, node = \
+            sighting[0], sighting[1], sighting[2], sighting[5]
+        if bt_addr not in positions or node not in node_map:
+            skipped += 1
+            continue
+        node_x, node_y = node_map[node]
+        columns[0].append(node)
+        columns[1].append(beacon_type(packet))
+        columns[2].append(rssi)
+        columns[3].append(math.hypot(positions[bt_addr][0] - node_x,
+                                     positions[bt_addr][1] - node_y))
+    if not columns[0]:
+        parser.error("No sightings of known beacons from known nodes")
+
+    table = fit(*columns, min_samples=args.min_samples)
+    table.save(args.out)
+    print("Fit {} sightings ({} skipped) into {} entries; wrote {}".format(
+        len(columns[0]), skipped, len(table.entries), args.out))
+    print(json.dumps(table.to_dict(), indent=2))
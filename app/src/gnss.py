@@ -0,0 +1,164 @@
+import datetime
+import struct
+from collections import namedtuple
+
+# A u-blox receiver sends every NMEA sentence it has enabled (GSV, GSA, RMC,
+#   GLL...) several times a second, while CoordinateService only wants a
+#   couple of them. NmeaFilter looks at the sentence ID and checksum of each
+#   line, which costs a few string operations, and leaves full parsing with
+#   pynmea2 to the sentences that are wanted.
+#
+# Alternatively the receiver can send UBX NAV-PVT, one binary message with
+#   position and velocity per navigation solution, decoded here with struct.
+
+# Sentences CoordinateService decodes by default
+SENTENCES = ("GGA", "VTG")
+
+# Standard NMEA sentences and their UBX message IDs (class 0xF0)
+NMEA_IDS = {"GGA": 0x00, "GLL": 0x01, "GSA": 0x02, "GSV": 0x03, "RMC": 0x04,
+            "VTG": 0x05, "GRS": 0x06, "GST": 0x07, "ZDA": 0x08, "GBS": 0x09,
+            "DTM": 0x0A, "GNS": 0x0D, "VLW": 0x0F}
+
+UBX_SYNC = b"\xb5\x62"
+CLASS_NAV, ID_NAV_PVT = 0x01, 0x07
+CLASS_CFG, ID_CFG_MSG = 0x06, 0x01
+CLASS_NMEA = 0xF0
+
+# NAV-PVT up to pDOP; later fields moved between protocol versions
+NAV_PVT = struct.Struct("<IHBBBBBBIiBBBBiiiiIIiiiiiIIH")
+NAV_PVT_FIELDS = ("iTOW", "year", "month", "day", "hour", "min", "sec",
+                  "valid", "tAcc", "nano", "fixType", "flags", "flags2",
+                  "numSV", "lon", "lat", "height", "hMSL", "hAcc", "vAcc",
+                  "velN", "velE", "velD", "gSpeed", "headMot", "sAcc",
+                  "headAcc", "pDOP")
+VALID_DATE, VALID_TIME = 0x01, 0x02
+GNSS_FIX_OK = 0x01
+
+# The parts of a GGA sentence CoordinateService uses, so a fix from NAV-PVT
+#   looks the same; timestamp is a UTC datetime.time
+Fix = namedtuple("Fix", ("latitude", "longitude", "altitude", "timestamp"))
+
+# One decoded NAV-PVT: speed in km/h and track in degrees like VTG
+Pvt = namedtuple("Pvt", ("fix", "speed", "track", "fix_ok", "raw"))
+
+
+class NmeaFilter(object):
+    """
+    Pick the wanted sentences out of a stream of NMEA lines.
+    """
+
+    def __init__(self, sentences=SENTENCES):
+        """
+        :param sentences: iterable of str Sentence types to keep, like "GGA"
+        """
+        self.sentences = frozenset(sentences)
+        self.skipped = 0
+        self.bad_checksum = 0
+
+    def sentence_type(self, line):
+        """
+        :param line: str An NMEA line, like "$GNGGA,...*hh"
+        :return: str Its type if it's wanted and intact, else None
+        """
+        # "$" + two talker characters + type, except for proprietary "$P..."
+        if line[:1] != "$" or line[1:2] == "P":
+            self.skipped += 1
+            return None
+        kind = line[3:6]
+        if kind not in self.sentences:
+            self.skipped += 1
+            return None
+        if not nmea_checksum_ok(line):
+            self.bad_checksum += 1
+            return None
+        return kind
+
+
+def nmea_checksum_ok(line):
+    """
+    :param line: str An NMEA line with or without trailing whitespace
+    :return: bool Whether its checksum is there and matches
+    """
+    star = line.rfind("*")
+    if star < 1:
+        return False
+    try:
+        expected = int(line[star + 1:star + 3], 16)
+    except ValueError:
+        return False
+    checksum = 0
+    for char in line[1:star].encode("ascii", "replace"):
+        checksum ^= char
+    return checksum == expected
+
+
+def ubx_frame(msg_class, msg_id, payload=b""):
+    """:return: bytes A UBX message, with sync bytes and checksum"""
+    body = struct.pack("<BBH", msg_class, msg_id, len(payload)) + payload
+    ck_a = ck_b = 0
+    for byte in body:
+        ck_a = (ck_a + byte) & 0xFF
+        ck_b = (ck_b + ck_a) & 0xFF
+    return UBX_SYNC + body + bytes((ck_a, ck_b))
+
+
+def cfg_msg(msg_class, msg_id, rate):
+    """
+    :param rate: int Send the message every `rate` navigation solutions on
+      the port this is written to, or 0 to stop it
+    :return: bytes A UBX CFG-MSG message
+    """
+    return ubx_frame(CLASS_CFG, ID_CFG_MSG,
+                     struct.pack("<BBB", msg_class, msg_id, rate))
+
+
+def pvt_config(keep=()):
+    """
+    :param keep: iterable of str NMEA sentences to leave on
+    :return: list of bytes UBX messages turning NAV-PVT on, and the standard
+      NMEA sentences not in keep off
+    """
+    keep = set(keep)
+    messages = [cfg_msg(CLASS_NAV, ID_NAV_PVT, 1)]
+    messages += [cfg_msg(CLASS_NMEA, msg_id, 0)
+                 for name, msg_id in sorted(NMEA_IDS.items())
+                 if name not in keep]
+    return messages
+
+
+def decode_nav_pvt(payload):
+    """
+    :param payload: bytes The payload of a NAV-PVT message
+    :return: dict Its fields up to pDOP, in the receiver's units
+    """
+    return dict(zip(NAV_PVT_FIELDS, NAV_PVT.unpack_from(payload)))
+
+
+def pvt_from_fields(fields):
+    """
+    :param fields: dict NAV-PVT fields, from decode_nav_pvt or attributes of
+      a message decoded elsewhere
+    :return: Pvt The fix (None until the receiver knows the time) and
+      velocity
+    """
+    fix = None
+    if fields["valid"] & VALID_TIME:
+        if fields["valid"] & VALID_DATE:
+            # nano corrects the rounded second, and can be negative
+            when = datetime.datetime(
+                fields["year"], fields["month"], fields["day"],
+                fields["hour"], fields["min"], fields["sec"],
+                tzinfo=datetime.timezone.utc) + \
+                datetime.timedelta(microseconds=fields["nano"] // 1000)
+            timestamp = when.timetz()
+        else:
+            timestamp = datetime.time(
+                fields["hour"], fields["min"], fields["sec"],
+                tzinfo=datetime.timezone.utc)
+        fix = Fix(fields["lat"] * 1e-7, fields["lon"] * 1e-7,
+                  fields["hMSL"] / 1000.0, timestamp)
+    return Pvt(fix,
+               fields["gSpeed"] * 0.0036,  # mm/s to km/h
+               (fields["headMot"] * 1e-5) % 360,
+               bool(fields["flags"] & GNSS_FIX_OK) and fields["fixType"] > 1,
+               fields)
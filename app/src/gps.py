@@ -1,9 +1,10 @@
 import datetime
 import logging
+import math
 import os
-from collections import deque
-from functools import partialmethod
+import threading
 from random import randint
+from time import time
 
 import numpy as np
 import pynmea2
@@ -11,8 +12,14 @@ import serial
 from pyubx import Manager
 
 try:
+    from gnss import (NmeaFilter, SENTENCES, CLASS_NAV, ID_NAV_PVT,
+                      NAV_PVT_FIELDS, decode_nav_pvt, pvt_config,
+                      pvt_from_fields)
     from utility import get_pn_uuid, UTC
 except ImportError:
+    from app.src.gnss import (NmeaFilter, SENTENCES, CLASS_NAV, ID_NAV_PVT,
+                              NAV_PVT_FIELDS, decode_nav_pvt, pvt_config,
+                              pvt_from_fields)
     from app.src.utility import get_pn_uuid, UTC
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,10 +33,225 @@ logfile.setFormatter(formatter)
 logger.addHandler(logfile)
 
 
+class VelocityWindow(object):
+    """
+    The last `maxlen` velocities in ring arrays of timestamp, speed, track
+    and sin(track), with running sums of speed and sin(track) over the ones
+    no older than `avg_seconds` before the newest.
+
+    Both windows only ever lose their oldest entries, so every append moves
+    their start forward and keeps the sums current in amortized O(1), and
+    the checks in CoordinateService read them in O(1). That needs
+    timestamps in order, so a timestamp older than the newest (the system
+    clock was stepped back, say by NTP after boot) starts the window over.
+
+    The rings are lists, not NumPy arrays: everything here touches one
+    element at a time, where lists are several times faster.
+    """
+
+    def __init__(self, maxlen, avg_seconds, inst_seconds):
+        """
+        :param maxlen: int Max velocities kept, whatever their age
+        :param avg_seconds: float Age of the oldest velocity averaged over
+        :param inst_seconds: float Age of the velocity compared against
+        """
+        self.maxlen = maxlen
+        self.avg_seconds = avg_seconds
+        self.inst_seconds = inst_seconds
+        self.ts = [0.0] * maxlen
+        self.spd = [0.0] * maxlen
+        self.trk = [0.0] * maxlen
+        self.sin = [0.0] * maxlen
+        self.clear()
+
+    def clear(self):
+        # Positions count appends since the last clear; slot = pos % maxlen
+        self.end = 0
+        self.avg_start = 0
+        self.inst_start = 0
+        self.spd_sum = 0.0
+        self.sin_sum = 0.0
+
+    def __len__(self):
+        return min(self.end, self.maxlen)
+
+    def append(self, ts, speed, track):
+        """
+        :param ts: float Epoch seconds
+        :param speed: float km/h
+        :param track: float Degrees (true)
+        """
+        maxlen = self.maxlen
+        if self.end and ts < self.ts[(self.end - 1) % maxlen]:
+            self.clear()  # Clock stepped back
+        if self.end >= maxlen:  # Overwriting the oldest
+            self._expire_avg(self.end - maxlen + 1)
+            self.inst_start = max(self.inst_start, self.end - maxlen + 1)
+        slot = self.end % maxlen
+        self.ts[slot] = ts
+        self.spd[slot] = speed
+        self.trk[slot] = track
+        self.sin[slot] = sine = math.sin(math.radians(track))
+        self.spd_sum += speed
+        self.sin_sum += sine
+        self.end += 1
+
+        ts_list = self.ts
+        start = self.avg_start
+        while ts_list[start % maxlen] < ts - self.avg_seconds:
+            start += 1
+        self._expire_avg(start)
+        start = self.inst_start
+        while ts_list[start % maxlen] < ts - self.inst_seconds:
+            start += 1
+        self.inst_start = start
+
+    def _expire_avg(self, start):
+        while self.avg_start < start:
+            slot = self.avg_start % self.maxlen
+            self.spd_sum -= self.spd[slot]
+            self.sin_sum -= self.sin[slot]
+            self.avg_start += 1
+        if self.avg_start == self.end - 1:
+            # Only the newest left; drop the rounding error summed so far
+            slot = self.avg_start % self.maxlen
+            self.spd_sum = self.spd[slot]
+            self.sin_sum = self.sin[slot]
+
+    def newest(self):
+        """:return: tuple (ts, speed, track, sin(track)) of the newest"""
+        slot = (self.end - 1) % self.maxlen
+        return self.ts[slot], self.spd[slot], self.trk[slot], self.sin[slot]
+
+    def oldest_inst(self):
+        """:return: tuple (speed, track) of the oldest within inst_seconds"""
+        slot = self.inst_start % self.maxlen
+        return self.spd[slot], self.trk[slot]
+
+    def avg_speed(self):
+        return self.spd_sum / (self.end - self.avg_start)
+
+    def avg_sin(self):
+        """:return: float Mean sin(track) over avg_seconds, like avg_sin()"""
+        return round(self.sin_sum / (self.end - self.avg_start), 4)
+
+
+class FixTrack(object):
+    """
+    Recent fixes in ring arrays, in the order they arrived, for looking up
+    where the node was at some moment since.
+
+    Fixes are indexed by when they arrived on this machine's clock, the same
+    clock the BLE scanner stamps sightings with, rather than by the
+    receiver's UTC time of day; that puts them a few tens of milliseconds
+    late, which is nothing next to the fix's own error.
+
+    Lookups binary-search the arrival times, so they have to be in order.
+    On a Pi without a real-time clock, NTP or GPS time steps the clock
+    after boot; a fix arriving earlier than the newest one starts the
+    track over.
+
+    The GPS thread appends while the node's thread looks up, so both hold
+    a lock.
+    """
+
+    def __init__(self, maxlen=3000, max_gap=5.0):
+        """
+        :param maxlen: int Max fixes kept (5 minutes at 10 Hz)
+        :param max_gap: float Max seconds between a time and the fixes used
+          for it; fixes further apart aren't interpolated between
+        """
+        self.maxlen = maxlen
+        self.max_gap = max_gap
+        self.ts = [0.0] * maxlen
+        self.lat = [0.0] * maxlen
+        self.lon = [0.0] * maxlen
+        self.alt = [0.0] * maxlen
+        self.end = 0  # Fixes appended; slot = position % maxlen
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.end, self.maxlen)
+
+    def append(self, ts, lat, lon, alt):
+        """
+        :param ts: float Epoch seconds the fix arrived
+        :param alt: float Meters, or None if unknown
+        """
+        with self._lock:
+            if self.end and ts < self.ts[(self.end - 1) % self.maxlen]:
+                self.end = 0  # Clock stepped back
+            slot = self.end % self.maxlen
+            self.ts[slot] = ts
+            self.lat[slot] = lat
+            self.lon[slot] = lon
+            self.alt[slot] = alt
+            self.end += 1
+
+    def position_at(self, t):
+        """
+        :param t: float Epoch seconds
+        :return: list [lat, lon, alt] interpolated between the fixes on
+          either side of t, or the nearest one if only it is within max_gap,
+          or None if neither is
+        """
+        with self._lock:
+            first = max(0, self.end - self.maxlen)
+            lo, hi = first, self.end
+            # Binary search for the first fix after t
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.ts[mid % self.maxlen] <= t:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            before = self._slot(lo - 1) if lo > first else None
+            after = self._slot(lo) if lo < self.end else None
+        if before is not None and after is not None and \
+                after[0] - before[0] <= self.max_gap:
+            return _interpolate(before, after, t)
+        nearest = min((fix for fix in (before, after) if fix is not None),
+                      key=lambda fix: abs(fix[0] - t), default=None)
+        if nearest is None or abs(nearest[0] - t) > self.max_gap:
+            return None
+        return list(nearest[1:])
+
+    def _slot(self, position):
+        slot = position % self.maxlen
+        return self.ts[slot], self.lat[slot], self.lon[slot], self.alt[slot]
+
+
+def _interpolate(before, after, t):
+    span = after[0] - before[0]
+    w = (t - before[0]) / span if span > 0 else 0.0
+    d_lon = after[2] - before[2]
+    if d_lon > 180:  # Across the antimeridian
+        d_lon -= 360
+    elif d_lon < -180:
+        d_lon += 360
+    lon = before[2] + w * d_lon
+    lon = (lon + 180) % 360 - 180
+    alt = None
+    if before[3] is not None and after[3] is not None:
+        alt = before[3] + w * (after[3] - before[3])
+    return [before[1] + w * (after[1] - before[1]), lon, alt]
+
+
 class CoordinateService(Manager):
     def __init__(self, ser, debug=False, maxlen_vel=11, vel_avg_seconds=10,
                  vel_inst_seconds=10, s_i_max=55, s_a_max=55, t_i_max=30,
-                 t_a_max=12.5, ref_spd=40, ref_spd_mod=20, gen_fake_vel=False):
+                 t_a_max=12.5, ref_spd=40, ref_spd_mod=20, gen_fake_vel=False,
+                 sentences=SENTENCES, ubx_pvt=False, track_len=3000,
+                 track_max_gap=5.0):
+        """
+        :param sentences: iterable of str NMEA sentence types to decode;
+          GGA and VTG are used here, others go to onSentence()
+        :param ubx_pvt: bool Configure the receiver to send UBX NAV-PVT for
+          position and velocity, and only the other NMEA sentences wanted
+        :param track_len: int Max recent fixes kept for position_at()
+        :param track_max_gap: float Max seconds position_at() interpolates
+          or extrapolates over
+        """
         if not debug:
             logger.setLevel(logging.INFO)
         else:
@@ -52,17 +274,26 @@ class CoordinateService(Manager):
         self._dumpNMEA = False
         self.latest_fix = None
         self.latest_vel = None
+        self.track = FixTrack(track_len, track_max_gap)
         self.msg_alarm = 0
+        self.on_alarm = None  # Called from this thread when msg_alarm is set
         logger.info("Manager set up. Initializing variables...")
 
         self.gen_fake_vel = gen_fake_vel
 
+        # Only wanted sentences get parsed; see gnss.py
+        self.nmea_filter = NmeaFilter(sentences)
+        self.ubx_pvt = ubx_pvt
+        if ubx_pvt:
+            self._configure_pvt(ser, sentences)
+
         # Initialize values for velocity checking
         # we need enough values to satisfy average requirements - assume 1/sec
         maxlen_vel = max(maxlen_vel, vel_avg_seconds + 1)
-        self.vel_array = deque(maxlen=maxlen_vel)  # velocity = (speed, track)
         self.vel_avg_seconds = vel_avg_seconds  # how long to consider in avgs
         self.vel_inst_seconds = vel_inst_seconds  # time ago to calc inst diff
+        self.velocities = VelocityWindow(maxlen_vel, vel_avg_seconds,
+                                         vel_inst_seconds)
 
         # Initialize parameters against which to check velocity
         self.s_i_max = s_i_max  # speed-instant trigger
@@ -95,38 +326,6 @@ class CoordinateService(Manager):
         else:
             return 360 - abs_diff
 
-    @staticmethod
-    def _vel_proc(vel_dict, v_or_k, index, funcname):
-        """
-        :param v_or_k: str Either 'keys' or 'values' - what do we want?
-        :param index: int The index of the key/value we want (typically 0 or 1)
-        :param vel_dict: dict The velocity dict: { timestamp: ( speed, track ) }
-        :return: float The requested value
-        """
-        # Check errors / log
-        if not isinstance(vel_dict, dict):
-            logger.error("***{} was passed a non-dict parameter") \
-                .format(funcname)
-            return -1
-        if v_or_k not in ["values", "keys"]:
-            logger.error("***{} was passed {}, not 'keys' or 'values'") \
-                .format(funcname, v_or_k)
-            return -1
-        # Do actual work
-        try:
-            if v_or_k == "keys":
-                return list(getattr(vel_dict, v_or_k)())[index]
-            else:
-                return list(getattr(vel_dict, v_or_k)())[0][index]
-        except KeyError:
-            logger.error("***{} encountered KeyError for {}" \
-                         .format(funcname, vel_dict))
-            return -1
-
-    _spd = partialmethod(_vel_proc, v_or_k="values", index=0, funcname="_spd")
-    _trk = partialmethod(_vel_proc, v_or_k="values", index=1, funcname="_trk")
-    _ts = partialmethod(_vel_proc, v_or_k="keys", index=0, funcname="_ts")
-
     @staticmethod
     def avg_sin(angles):
         """
@@ -145,25 +344,27 @@ class CoordinateService(Manager):
             logger.error("*****Error computing new t_a_max for value {}"
                          .format(new_max))
 
+    def _raise_alarm(self):
+        """Ask for a message now, waking the Node if it's listening."""
+        self.msg_alarm = 1
+        if self.on_alarm is not None:
+            self.on_alarm()
+
     def _check_velocity(self):
-        try:
-            now = list(self.vel_array[0])[0]  # Get first key (timestamp)
-        except IndexError:
+        window = self.velocities
+        if not len(window):
             return
 
         def speed_alarm():
-            s_val = self._spd(self.vel_array[0])  # { now: (speed, track) }
+            s_val = window.newest()[1]
             self.spd_holder = s_val
             """
             This gets the least-recent speed adhering to the vel_inst_seconds.
             The idea is to check less recently than the fastest rate of msgs.
             It will be the same for track (below).
             """
-            s_i_check_val = [self._spd(x) for x in self.vel_array if
-                             self._ts(x) >= (now - self.vel_inst_seconds)][-1]
-            s_a_check_list = [self._spd(x) for x in self.vel_array if
-                              self._ts(x) >= (now - self.vel_avg_seconds)]
-            s_a_check_val = sum(s_a_check_list) / len(s_a_check_list)
+            s_i_check_val = window.oldest_inst()[0]
+            s_a_check_val = window.avg_speed()
             alarm = (abs(s_val - s_i_check_val) > self.s_i_max or
                      abs(s_val - s_a_check_val) > self.s_a_max)
             return alarm
@@ -182,23 +383,21 @@ class CoordinateService(Manager):
                 current_t_i_max = self.t_i_max
                 logger.exception("***Error calculating speed-dependent t_i_max")
 
-            t_val = self._trk(self.vel_array[0])  # { now: (speed, track) }
-            t_i_check_val = [self._trk(x) for x in self.vel_array if
-                             self._ts(x) >= (now - self.vel_inst_seconds)][-1]
-            # Compute average heading over time
-            t_a_check_val = self.avg_sin([self._trk(x) for x in self.vel_array if
-                                          self._ts(x) >= (now - self.vel_avg_seconds)])
+            _, _, t_val, t_sin = window.newest()
+            t_i_check_val = window.oldest_inst()[1]
+            # Average heading over time, as the mean of the sines
+            t_a_check_val = window.avg_sin()
             alarm = (self.hdg_diff(t_val, t_i_check_val) > current_t_i_max or
-                     abs(np.sin(np.radians(t_val)) - t_a_check_val) > self.t_a_max)
+                     abs(t_sin - t_a_check_val) > self.t_a_max)
             return alarm
 
         try:
             # speed at rest 0-2.5
             if speed_alarm() or (self.spd_holder > 2.5 and track_alarm()):
                 try:
-                    self.msg_alarm = 1
                     self.latest_vel = self._constr_vel()
-                    self.vel_array.clear()
+                    self.velocities.clear()
+                    self._raise_alarm()
                 except:
                     logger.exception("***Error getting velocity alarms")
         except KeyError:
@@ -212,29 +411,92 @@ class CoordinateService(Manager):
                              "***velocity error***\n"
                              "********************")
 
+    def _configure_pvt(self, ser, sentences):
+        logger.info("Configuring the receiver for UBX NAV-PVT...")
+        # NAV-PVT stands in for GGA and VTG
+        keep = set(sentences) - {"GGA", "VTG"}
+        try:
+            for message in pvt_config(keep):
+                ser.write(message)
+            ser.flush()
+        except Exception:
+            logger.exception("***Error configuring NAV-PVT - "
+                             "staying on NMEA")
+            self.ubx_pvt = False
+
+    def _add_velocity(self, speed, track):
+        if self.gen_fake_vel:  # To test other stuff
+            speed = 50 + randint(-25, 25)
+            track = 180 + randint(-35, 35)
+        if speed and track:
+            # now = timestamp in seconds
+            now = datetime.datetime.timestamp(datetime.datetime.now(tz=UTC))
+            self.velocities.append(now, speed, track)
+            self._check_velocity()
+
     # Override onNMEA from parent class to do work
     def onNMEA(self, buffer):
-        msg = pynmea2.parse(buffer)
-        if msg.__class__ is pynmea2.GGA:  # position msg
+        if isinstance(buffer, (bytes, bytearray)):
+            buffer = buffer.decode("ascii", "replace")
+        kind = self.nmea_filter.sentence_type(buffer)
+        if kind is None:
+            return  # Not wanted, or damaged
+        try:
+            msg = pynmea2.parse(buffer)
+        except pynmea2.ParseError:
+            logger.debug("***Unparseable {} sentence: {}".format(kind, buffer))
+            return
+        if kind == "GGA" and not self.ubx_pvt:  # position msg
             if msg.gps_qual > 0:
-                self.latest_fix = msg
-        elif msg.__class__ is pynmea2.VTG:  # velocity msg
+                self._set_fix(msg)
+        elif kind == "VTG" and not self.ubx_pvt:  # velocity msg
             try:
-                speed = msg.spd_over_grnd_kmph
-                track = msg.true_track
-                if self.gen_fake_vel:  # To test other stuff
-                    speed = 50 + randint(-25, 25)
-                    track = 180 + randint(-35, 35)
-                if speed and track:
-                    # now = timestamp in seconds
-                    now = datetime.datetime.timestamp(datetime.datetime.now(tz=UTC))
-                    self.vel_array.appendleft({now: (speed, track)})
-                    self._check_velocity()
+                self._add_velocity(msg.spd_over_grnd_kmph, msg.true_track)
             except AttributeError:
                 logger.exception("***Bad properties for VTG Sentence***")
         else:
-            # Potential to expand to more message types here
-            pass
+            self.onSentence(msg)
+
+    def onSentence(self, msg):
+        """Override to handle the other sentences asked for."""
+        pass
+
+    # Override onUBX from parent class to do work
+    def onUBX(self, obj):
+        """
+        :param obj: A NAV-PVT message decoded by pyubx, or its raw payload
+        """
+        if isinstance(obj, (bytes, bytearray)):
+            fields = decode_nav_pvt(obj)
+        elif type(obj).__name__ == "PVT":
+            fields = {name: getattr(obj, name) for name in NAV_PVT_FIELDS}
+        else:
+            return
+        pvt = pvt_from_fields(fields)
+        if pvt.fix_ok and pvt.fix is not None:
+            self._set_fix(pvt.fix)
+            self._add_velocity(pvt.speed, pvt.track)
+
+    def onUBXError(self, msgClass, msgId, errMsg):
+        if (msgClass, msgId) == (CLASS_NAV, ID_NAV_PVT):
+            logger.warning("***Bad NAV-PVT message: {}".format(errMsg))
+
+    def _set_fix(self, fix):
+        """:param fix: A GGA sentence, or a Fix from NAV-PVT"""
+        self.latest_fix = fix
+        try:
+            self.track.append(time(), fix.latitude, fix.longitude,
+                              fix.altitude)
+        except (TypeError, ValueError):
+            logger.debug("***Fix without a usable position: {}".format(fix))
+
+    def position_at(self, t):
+        """
+        Where the node was at some recent moment, from the fixes around it.
+        :param t: float Epoch seconds, like a BLE sighting's timestamp
+        :return: list [lat, lon, alt], or None without fixes close enough
+        """
+        return self.track.position_at(t)
 
     def get_latest_fix(self):
         if self.latest_fix is not None:
@@ -254,14 +516,14 @@ class CoordinateService(Manager):
             return 0
 
     def _constr_vel(self):
-        try:
-            for k, v in self.vel_array[0].items():
-                return (
-                    v[0], v[1],  # speed in kph, track direction (true)
-                    datetime.datetime.fromtimestamp(k, tz=UTC)  # Python DT obj
-                )
-        except IndexError:
+        if not len(self.velocities):
             return 0
+        try:
+            ts, speed, track, _ = self.velocities.newest()
+            return (
+                speed, track,  # speed in kph, track direction (true)
+                datetime.datetime.fromtimestamp(ts, tz=UTC)  # Python DT obj
+            )
         except Exception:
             logger.exception("\n"
                              "********************\n"
@@ -0,0 +1,122 @@
+import sys
+import threading
+from array import array
+
+
+class BeaconRing(object):
+    """
+    Fixed-capacity ring buffer of sightings for a single beacon.
+
+    RSSI values are stored as signed bytes and timestamps as epoch seconds
+    in a double array. When the ring is full the oldest sighting is
+    overwritten.
+    """
+    __slots__ = ("rssi", "ts", "start", "size", "capacity", "overwritten",
+                 "packet")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.rssi = array('b', bytes(capacity))
+        self.ts = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+        self.overwritten = 0
+        self.packet = None  # Latest packet seen from this beacon
+
+    def append(self, rssi, timestamp):
+        if self.size < self.capacity:
+            idx = self.start + self.size
+            if idx >= self.capacity:
+                idx -= self.capacity
+            self.size += 1
+        else:
+            idx = self.start
+            self.start = (self.start + 1) % self.capacity
+            self.overwritten += 1
+        # Clamp to int8 - real RSSI values are always well inside this
+        self.rssi[idx] = min(max(rssi, -128), 127)
+        self.ts[idx] = timestamp
+
+    def drain(self):
+        """
+        Return the sightings oldest-first and empty the ring.
+        :return: tuple (array of rssi, array of timestamps)
+        """
+        end = self.start + self.size
+        if end <= self.capacity:
+            rssi = self.rssi[self.start:end]
+            ts = self.ts[self.start:end]
+        else:
+            end -= self.capacity
+            rssi = self.rssi[self.start:] + self.rssi[:end]
+            ts = self.ts[self.start:] + self.ts[:end]
+        self.start = 0
+        self.size = 0
+        return rssi, ts
+
+
+class InViewStore(object):
+    """
+    Thread-safe store of the beacons in view of a scanner.
+
+    Appends are O(1). `drain` hands back everything seen since the last
+    drain and is O(beacons). Memory is capped at roughly
+    max_beacons * capacity * 9 bytes: each beacon keeps at most `capacity`
+    sightings, and new beacons are refused once `max_beacons` are tracked.
+    Beacons that were not seen between two drains are forgotten.
+    """
+
+    def __init__(self, capacity=64, max_beacons=2048):
+        """
+        :param capacity: int Max sightings kept per beacon between drains
+        :param max_beacons: int Max beacons tracked between drains
+        """
+        self.capacity = max(int(capacity), 1)
+        self.max_beacons = max(int(max_beacons), 1)
+        self._lock = threading.Lock()
+        self._rings = {}
+        self.dropped = 0  # Sightings refused because max_beacons was hit
+
+    def __len__(self):
+        return len(self._rings)
+
+    def append(self, bt_addr, rssi, timestamp, packet=None):
+        """
+        :param bt_addr: str Beacon MAC address
+        :param rssi: int Received signal strength
+        :param timestamp: float Epoch seconds of the sighting
+        :param packet: obj Latest packet from the beacon
+        """
+        with self._lock:
+            ring = self._rings.get(bt_addr)
+            if ring is None:
+                if len(self._rings) >= self.max_beacons:
+                    self.dropped += 1
+                    return
+                ring = self._rings[sys.intern(bt_addr)] = \
+                    BeaconRing(self.capacity)
+            ring.append(rssi, timestamp)
+            ring.packet = packet
+
+    def drain(self):
+        """
+        Snapshot and empty the store.
+        :return: dict { bt_addr: (rssi_array, ts_array, packet), ... }
+        """
+        snapshot = {}
+        with self._lock:
+            for bt_addr, ring in list(self._rings.items()):
+                if not ring.size:
+                    del self._rings[bt_addr]  # Not seen since last drain
+                    continue
+                rssi, ts = ring.drain()
+                snapshot[bt_addr] = (rssi, ts, ring.packet)
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._rings = {}
+
+    def memory_cap(self):
+        """:return: int Approximate max bytes used by sighting storage"""
+        return self.max_beacons * self.capacity * (1 + 8)
@@ -1,237 +1,610 @@
-import dateutil.parser
-
-from collections import defaultdict, deque
-from datetime import timedelta
-from statistics import mean, harmonic_mean as hmean
-
-from pubnub.callbacks import SubscribeCallback
-# from pubnub.enums import PNStatusCategory
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
+import math
+import threading
+import traceback
+from collections import defaultdict
+from time import monotonic, time
 
 try:
+    from app.src.batching import is_batch, unbatch
+    from app.src.calibration import CALIBRATION_FILE, CalibrationTable, \
+        beacon_type
+    from app.src.metrics import REGISTRY, serve_metrics, timed
+    from app.src.registry import NODE_SNAPSHOT, NodeRegistry
+    from app.src.ranging import SlidingWindow, format_timestamp, \
+        parse_timestamp
+    from app.src.tracing import ingest_trace, stamp
+    from app.src.tracking import BeaconTracker
+    from app.src.transport import is_pubnub, make_transport
     from app.src.trilateration import TrilaterationSolver
+    from app.src.wire import WireDecoder
 except ModuleNotFoundError as e:
+    from batching import is_batch, unbatch
+    from calibration import CALIBRATION_FILE, CalibrationTable, \
+        beacon_type
+    from metrics import REGISTRY, serve_metrics, timed
+    from registry import NODE_SNAPSHOT, NodeRegistry
+    from ranging import SlidingWindow, format_timestamp, \
+        parse_timestamp
+    from tracing import ingest_trace, stamp
+    from tracking import BeaconTracker
+    from transport import is_pubnub, make_transport
     from trilateration import TrilaterationSolver
-
-
-class MaxLenDeque(deque):
-    def __init__(self, maxlen=30):
-        super(MaxLenDeque, self).__init__(maxlen=maxlen)
-
-
-class BeaconLocator(SubscribeCallback):
-    def __init__(self, pub_key, sub_key):
-        pnconfig = PNConfiguration()
-        pnconfig.subscribe_key = sub_key
-        pnconfig.publish_key = pub_key
-        pnconfig.ssl = False
-
-        self.pubnub = PubNub(pnconfig)
-        self.node_map = defaultdict(tuple)
-        self.known_nodes = []
-        self.get_nodes()
-
-        # Holds messages from the 'ranged' topic
-        self.raw_log = defaultdict(MaxLenDeque)
-        self.ranged_log = defaultdict(MaxLenDeque)
-        self.max_time_diff = timedelta(seconds=5)
-
-        # n_matrix = {
-        #     "indoors": 3.7,
-        #     "free_air": 2,
-        # }
-        # beacon_matrix = {
-        #     "bluecharm": -59.8,
-        # }
-        # Settings for inside RAIN
-        self.n = 3.1  # Path loss exponent = 1.6-1.8 w/LOS to beacon indoors
-        self.measured_rssi = -46  # Beacon-specific measured RSSI @ 1m
-
-        # Settings for inside a normal house
-        # self.n = 2.7
-        # self.measured_rssi = -59.8
-
-        self.solver = TrilaterationSolver()
+    from wire import WireDecoder
+
+
+class BeaconLocator(object):
+    def __init__(self, pub_key, sub_key, estimator="harmonic",
+                 solver_method="L-BFGS-B", tick=None, max_rate=None,
+                 min_move=0.0, node_map=None, node_snapshot=NODE_SNAPSHOT,
+                 transport=None, track=None, calibration=CALIBRATION_FILE):
+        """
+        :param pub_key: str PubNub publish key
+        :param sub_key: str PubNub subscribe key
+        :param estimator: str How to average RSSI; see SlidingWindow.ESTIMATORS
+        :param solver_method: str TrilaterationSolver method
+        :param tick: float If set, locate all beacons updated in each tick of
+          this many seconds in one batch, instead of on every message
+        :param max_rate: float Max located messages per second per beacon.
+          Implies tick mode, with a tick of 1 / max_rate if none is given.
+        :param min_move: float Don't publish a location that is less than
+          this many meters from the last one published for the beacon
+        :param node_map: dict Known node coordinates, { name: (x, y) }.
+          If not given they are read from node_snapshot, or from the
+          'nodes' channel history if there is no snapshot yet.
+        :param node_snapshot: str File to persist known nodes to
+        :param transport: Transport or str Where messages come from and go
+          to; see make_transport. PubNub with pub_key and sub_key by default.
+        :param track: str If set, track beacons with this filter (see
+          tracking.FILTERS) and publish the filtered position, only solving
+          to start a track
+        :param calibration: CalibrationTable or str Path-loss parameters,
+          or a file to load them from; defaults apply if it doesn't exist
+        """
+        self.transport = self._make_transport(transport, pub_key, sub_key)
+        # Scanners may send compact or JSON 'raw_channel' messages
+        self.decoder = WireDecoder()
+        if node_map is None:
+            self.nodes = NodeRegistry(snapshot_path=node_snapshot)
+            if len(self.nodes):
+                # Start from the snapshot; catch up on history in background
+                refresh = threading.Thread(target=self.get_nodes)
+                refresh.daemon = True
+                refresh.start()
+            else:
+                self.get_nodes()
+        else:
+            self.nodes = NodeRegistry()
+            self.nodes.update(node_map)
+
+        # Sliding windows per beacon, per node: { bt_addr: { node: window } }
+        # RSSI windows hold -rssi so every sample is positive
+        self.rssi_windows = defaultdict(dict)
+        self.range_windows = defaultdict(dict)
+        self.max_time_diff = 5.0  # seconds
+        # harmonic mean (vs arithmatic mean) dampens the wild swings
+        self.estimator = estimator
+
+        # Path loss exponent and RSSI @ 1m per node and beacon type
+        if not isinstance(calibration, CalibrationTable):
+            calibration = CalibrationTable.load(calibration)
+        self.calibration = calibration
+
+        self.solver = TrilaterationSolver(method=solver_method)
+        self.tracker = BeaconTracker(track) if track else None
+
+        # Tick mode: beacons waiting to be located,
+        #  { bt_addr: (msg_timestamp, min_time) }
+        if max_rate and not tick:
+            tick = 1.0 / max_rate
+        self.tick = tick
+        # Whether beacons are located in batches instead of per message
+        self.deferred = bool(tick)
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.min_move = min_move
+        self._dirty = {}
+        # Latest unpublished 'ranged' message, { (bt_addr, node): message }
+        self._ranged = {}
+        # Last location published, { bt_addr: (monotonic time, coords) }
+        self._published = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._ticker = None
+
+        REGISTRY.gauge("locator_beacons", "Beacons with range windows",
+                       lambda: len(self.range_windows))
+        REGISTRY.gauge("locator_nodes", "Known nodes",
+                       lambda: len(self.nodes))
+        REGISTRY.gauge("locator_dirty_beacons",
+                       "Beacons waiting for the next tick",
+                       lambda: len(self._dirty))
+        if self.tracker:
+            REGISTRY.gauge("locator_tracks", "Beacon tracks",
+                           lambda: len(self.tracker.tracks))
+            REGISTRY.gauge("locator_track_rejected_total",
+                           "Ranges rejected by the tracking gate",
+                           lambda: self.tracker.rejected, kind="counter")
+
+    @staticmethod
+    def _make_transport(transport, pub_key, sub_key):
+        return make_transport(transport, pub_key, sub_key)
 
     def get_nodes(self):
-        nodes_msgs = self.pubnub \
-            .history() \
-            .channel("nodes") \
-            .count(100).sync()
-        for m in nodes_msgs.result.messages:
-            message = m.entry
-            try:
-                node = message['name']
-                self.node_map[node] = (
-                    message["coords"]["x"], message["coords"]["y"]
-                )
-                if node not in self.known_nodes:
-                    self.known_nodes.append(node)
-            except Exception as e:
-                pass
-
-    def _publish_range(self, bt_addr, rssi, timestamp, distance, node):
+        try:
+            self.nodes.load_history(self.transport)
+        except Exception as e:
+            pass
+
+    def _publish_range(self, bt_addr, rssi, timestamp, distance, node,
+                       trace=None):
         message = [bt_addr, rssi, timestamp, distance, node]
-        self.pubnub.publish() \
-            .channel('ranged') \
-            .message(message) \
-            .should_store(True) \
-            .pn_async(self._publish_callback)
+        if trace is not None:
+            message.append(stamp(trace, "out"))
+        self._publish('ranged', message)
 
-    def _publish_location(self, bt_addr, timestamp, coords, meta=None):
+    def _publish_location(self, bt_addr, timestamp, coords, meta=None,
+                          trace=None):
         if meta is None:
             meta = {}
+        if trace is not None:
+            # Already a copy, stamped when solved
+            trace["out"] = time()
+            meta["trace"] = trace
         message = [bt_addr, timestamp, coords, meta]
-        self.pubnub.publish() \
-            .channel('located') \
-            .message(message) \
-            .should_store(True) \
-            .pn_async(self._publish_callback)
+        self._publish('located', message)
+
+    def _publish(self, channel, message):
+        REGISTRY.inc("locator_published_total", labels={"channel": channel})
+        self.transport.publish(channel, message, self._publish_callback)
 
     def _publish_callback(self, result, status):
+        if status.is_error():
+            REGISTRY.inc("locator_publish_errors_total",
+                         labels={"category": status.category.name})
         # Check whether request successfully completed or not
         # Try to handle errors intelligently...
         pass  # Pretty intelligent, huh?
 
-    def _range(self, message, channel):
+    def _average_rssi(self, message):
+        """
+        Add a sighting to its RSSI window.
+        :return: tuple (epoch seconds, average RSSI over the window)
+        """
         bt_addr = message[0]
         node_name = message[5]
-        raw_log_slot = self.raw_log[bt_addr]
-        ranged_log_slot = self.ranged_log[bt_addr]
-
-        raw_log_slot.appendleft(message)
+        # Parse once here; windows and eviction work on epoch seconds
+        timestamp = parse_timestamp(message[4])
+
+        rssi_window = self.rssi_windows[bt_addr].get(node_name)
+        if rssi_window is None:
+            rssi_window = self.rssi_windows[bt_addr][node_name] = \
+                SlidingWindow()
+        rssi_window.add(timestamp, max(-message[1], 1))
+        rssi_window.evict(timestamp - self.max_time_diff)
+        # Average RSSI for the node over the allowable time period is
+        #  used for range calculations for dampening
+        return timestamp, -rssi_window.estimate(self.estimator)
+
+    @timed("locator_range_seconds", "Time ranging one sighting message")
+    def _range(self, message, channel, trace=None):
+        timestamp, avg_rssi = self._average_rssi(message)
+        # Calculate distance from bt_rssi, calibrated per node and beacon
+        beacon = beacon_type(message[2])
+        distance = self.calibration.distance(avg_rssi, message[5], beacon)
+        raw_distance = None
+        if self.tracker:
+            raw_distance = self.calibration.distance(message[1], message[5],
+                                                     beacon)
+        self._add_range(message, timestamp, avg_rssi, distance, raw_distance,
+                        trace)
+
+    @timed("locator_range_batch_seconds", "Time ranging one batch message")
+    def _range_batch(self, sightings, trace=None):
+        """
+        Range a batch of sightings, converting all their RSSI values to
+         distances in one vectorized call.
+        :param trace: dict The batch's trace context, see tracing.py
+        """
+        averaged = [self._average_rssi(sighting) for sighting in sightings]
+        calibration = self.calibration
+        node_ids = [calibration.node_id(s[5]) for s in sightings]
+        beacon_ids = [calibration.beacon_id(beacon_type(s[2]))
+                      for s in sightings]
+        rssi = [avg_rssi for _, avg_rssi in averaged]
+        if self.tracker:
+            # Raw ranges for the filter ride along in the same call
+            rssi += [s[1] for s in sightings]
+            node_ids += node_ids
+            beacon_ids += beacon_ids
+        distances = calibration.rssi_to_distance(rssi, node_ids,
+                                                 beacon_ids).tolist()
+        count = len(sightings)
+        for i, sighting in enumerate(sightings):
+            timestamp, avg_rssi = averaged[i]
+            raw_distance = distances[count + i] if self.tracker else None
+            self._add_range(sighting, timestamp, avg_rssi, distances[i],
+                            raw_distance, trace)
+
+    def _add_range(self, message, timestamp, avg_rssi, distance,
+                   raw_distance=None, trace=None):
+        bt_addr = message[0]
+        node_name = message[5]
+        iso_time = message[4] if isinstance(message[4], str) \
+            else format_timestamp(timestamp)
         # Find earliest acceptable time to consider in location
-        msg_dt = dateutil.parser.parse(message[4])
-        min_time = msg_dt - self.max_time_diff
-        # Find average RSSI for the node over the allowable time period and
-        #  use this average value for range calculations for dampening
-        # applicable_rssi = [
-        #     msg[1] for msg in raw_log_slot
-        #     if dateutil.parser.parse(msg[4]) >= min_time
-        #     and msg[5] == node_name  # matching node_name
-        # ]
-        # avg_rssi = mean(applicable_rssi)
-
-        applicable_rssi = [
-            -msg[1] for msg in raw_log_slot
-            if dateutil.parser.parse(msg[4]) >= min_time
-               and msg[5] == node_name  # matching node_name
-        ]
-        # harmonic mean (vs arithmatic mean) dampens the wild swings
-        avg_rssi = -hmean(applicable_rssi)
+        min_time = timestamp - self.max_time_diff
+        if trace is not None:
+            trace = dict(trace, rx=timestamp)
 
-        # print(applicable_rssi)
-        # print("{}: {}".format(node_name, avg_rssi))
-
-        # Calculate distance from bt_rssi, assuming tx_power and n
-        distance = 10 ** ((self.measured_rssi - avg_rssi) / (10 * self.n))
+        if raw_distance is not None and node_name in self.nodes:
+            # The filter does its own smoothing, so it gets the raw range
+            self.tracker.update(bt_addr, timestamp, self.nodes[node_name],
+                                raw_distance)
 
         # message[4] is timestamp in messages from 'raw_channel'
         # message[5] is node name in messages from 'raw_channel'
-        ranged_message = [bt_addr, avg_rssi, message[4], distance, message[5]]
-        self._publish_range(*ranged_message)
-        ranged_log_slot.appendleft(ranged_message)
-
-        # Do location and publish if appropriate
-        self._locate(ranged_log_slot, bt_addr, message[4], min_time)
+        ranged_message = [bt_addr, avg_rssi, iso_time, distance, node_name,
+                          trace]
+        if self.deferred:
+            # Only the latest range per node goes out, on the next tick
+            self._ranged[(bt_addr, node_name)] = ranged_message
+        else:
+            self._publish_range(*ranged_message)
 
-    def _locate(self, ranged_log_slot, bt_addr, msg_timestamp, min_time):
-        # log_slot is a list of 'ranged' messages like:
-        # # [bt_addr, bt_rssi, timestamp, distance, nodename]
-        # check stack of messages for those within time constraints
-        applicable_msgs = [msg for msg in ranged_log_slot
-                           if dateutil.parser.parse(msg[2]) >= min_time]
+        range_window = self.range_windows[bt_addr].get(node_name)
+        if range_window is None:
+            range_window = self.range_windows[bt_addr][node_name] = \
+                SlidingWindow()
+        range_window.add(timestamp, distance)
 
-        nodes = list(set([msg[4] for msg in applicable_msgs]))
+        # Do location and publish if appropriate
+        self._locate(bt_addr, iso_time, min_time, trace)
+
+    def _gather(self, bt_addr, min_time):
+        """
+        Collect the ranges to locate a beacon with.
+        :return: tuple (locations, distances, counts, meta) with one entry
+          per known node, or None if there aren't enough nodes
+        """
+        # Drop ranges outside the time constraints, and nodes with none left
+        windows = self.range_windows[bt_addr]
+        for node in list(windows):
+            windows[node].evict(min_time)
+            if not windows[node]:
+                del windows[node]
+
+        nodes = list(windows)
         node_count = len(nodes)
         for node in nodes:
-            if node not in self.known_nodes:
+            if node not in self.nodes and not self.nodes.is_unknown(node):
                 self.get_nodes()
-
-        if node_count > 1:
-            # Get the average range for each node
-            averaged = defaultdict(list)
-            for msg in applicable_msgs:
-                averaged[msg[4]].append(msg)
-            use_these = []
-            # Apply the average to all messages from the node
-            for nodename, msg_list in averaged.items():
-                observed = [msg[3] for msg in msg_list]
-                for msg in msg_list:
-                    msg[3] = mean(observed)
-                use_these.extend(msg_list)
-            locations, distances = zip(*[
-                (self.node_map[msg[4]], msg[3])
-                for msg in use_these
-                if msg[4] in self.known_nodes
-            ])
-
-            # print("***")
-            # print(use_these)
-            # print(locations)
-            # print(distances)
-
-            # do best location possible w/ available nodes/messages
-            result = self.solver.best_point(locations, distances)
-            coords = result['coords']
-            meta = {"avg_err": result['avg_err'],
-                    "message_count": len(applicable_msgs),
-                    "node_count": node_count,
-                    "nodes": str(nodes)}
-
-            # publish location (with error and/or other metadata if possible)
-            self._publish_location(bt_addr, msg_timestamp, coords, meta)
-
-    def status(self, pubnub, status):
-        pass
-
-    def presence(self, pubnub, presence):
-        pass
-
-    def message(self, pubnub, msg):
-        message = msg.message
-        channel = msg.channel
+                if node not in self.nodes:
+                    self.nodes.mark_unknown(node)
+
+        if node_count < 2:
+            return None
+
+        # Use the average range for each node, counted once for every
+        #  message from that node, so busier nodes weigh more
+        locations = []
+        distances = []
+        counts = []
+        for node, window in windows.items():
+            if node in self.nodes:
+                locations.append(self.nodes[node])
+                distances.append(window.mean())
+                counts.append(len(window))
+        if not locations:
+            return None
+
+        meta = {"message_count": sum(len(w) for w in windows.values()),
+                "node_count": node_count,
+                "nodes": str(nodes)}
+        return locations, distances, counts, meta
+
+    @timed("locator_locate_seconds", "Time locating after one sighting")
+    def _locate(self, bt_addr, msg_timestamp, min_time, trace=None):
+        if self.deferred:
+            # Located with every other beacon updated this tick
+            self._dirty[bt_addr] = (msg_timestamp, min_time, trace)
+            return
+
+        gathered = self._gather(bt_addr, min_time)
+        if gathered is None:
+            return
+        locations, distances, counts, meta = gathered
+
+        timestamp = min_time + self.max_time_diff
+        tracked = self._tracked(bt_addr, timestamp, gathered)
+        if tracked is not None:
+            self._publish_moved(bt_addr, msg_timestamp, *tracked,
+                                trace=stamp(trace, "solve"))
+            return
+
+        # do best location possible w/ available nodes/messages
+        result = self.solver.best_point(
+            [loc for loc, c in zip(locations, counts) for _ in range(c)],
+            [dist for dist, c in zip(distances, counts) for _ in range(c)],
+            initial_guess=self.tracker.guess(bt_addr) if self.tracker
+            else None)
+        trace = stamp(trace, "solve")
+        meta = dict(avg_err=result['avg_err'], **meta)
+        if self.tracker:
+            track = self.tracker.start(bt_addr, timestamp, result['coords'],
+                                       result['avg_err'])
+            meta.update(self.tracker.describe(track))
+
+        # publish location (with error and/or other metadata if possible)
+        self._publish_moved(bt_addr, msg_timestamp, result['coords'], meta,
+                            trace)
+
+    def _tracked(self, bt_addr, timestamp, gathered):
+        """
+        :return: tuple (coords, meta) from the beacon's track, or None if it
+          has no live track and needs solving
+        """
+        if not self.tracker:
+            return None
+        track = self.tracker.get(bt_addr, timestamp)
+        if track is None:
+            return None
+        locations, distances, counts, meta = gathered
+        coords = track.position()
+        meta = dict(avg_err=self.solver.avg_err(coords, locations, distances,
+                                                counts),
+                    **meta)
+        meta.update(self.tracker.describe(track))
+        return coords, meta
+
+    def _moved(self, bt_addr, coords):
+        """
+        :return: bool Whether coords are at least min_move meters from the
+          last location published for the beacon
+        """
+        if not self.min_move or bt_addr not in self._published:
+            return True
+        last = self._published[bt_addr][1]
+        return math.hypot(coords[0] - last[0],
+                          coords[1] - last[1]) >= self.min_move
+
+    def _publish_moved(self, bt_addr, msg_timestamp, coords, meta, trace,
+                       now=None):
+        """
+        Publish a location, unless it's within min_move of the last one.
+        :param now: float Monotonic time to record it as published at
+        """
+        if not self._moved(bt_addr, coords):
+            return  # Suppressed - hasn't gone anywhere
+        self._published[bt_addr] = (monotonic() if now is None else now,
+                                    coords)
+        self._publish_location(bt_addr, msg_timestamp, coords, meta, trace)
+
+    @timed("locator_tick_seconds", "Time locating every beacon in a tick")
+    def _locate_dirty(self):
+        """
+        Locate every beacon updated since the last tick in one batch.
+        Beacons located less than min_interval ago stay dirty for a later
+         tick, so each is published at most max_rate times per second.
+        """
+        work = self._collect_dirty()
+        if work is None:
+            return
+        beacons, tracked, ranged, guesses = work
+        result = self._solve_dirty(beacons, guesses)
+        self._finish_dirty(beacons, tracked, ranged, result, time())
+
+    def _collect_dirty(self):
+        """
+        Take the beacons due to be located and gather their ranges.
+        :return: tuple (beacons to solve, tracked beacons with positions,
+          'ranged' messages to publish, solver guesses), or None if there's
+          nothing to locate or publish
+        """
+        now = monotonic()
+        with self._lock:
+            beacons = []
+            tracked = []
+            due = set()
+            for bt_addr, (msg_timestamp, min_time, trace) in \
+                    list(self._dirty.items()):
+                last = self._published.get(bt_addr)
+                if last is not None and now - last[0] < self.min_interval:
+                    continue  # Debounced - try again next tick
+                del self._dirty[bt_addr]
+                due.add(bt_addr)
+                gathered = self._gather(bt_addr, min_time)
+                if gathered is None:
+                    continue
+                timestamp = min_time + self.max_time_diff
+                located = self._tracked(bt_addr, timestamp, gathered)
+                if located is not None:
+                    tracked.append((bt_addr, msg_timestamp) + located +
+                                   (stamp(trace, "solve"),))
+                else:
+                    beacons.append((bt_addr, msg_timestamp, timestamp,
+                                    gathered, trace))
+
+            # Ranges go out for every due beacon, even one too few nodes
+            #   can see to locate
+            ranged = [msg for key, msg in self._ranged.items()
+                      if key[0] in due]
+            for msg in ranged:
+                del self._ranged[(msg[0], msg[4])]
+            # Lost tracks warm-start the solver where they left off
+            guesses = None
+            if self.tracker and beacons:
+                guesses = [self.tracker.guess(beacon[0]) or
+                           (math.nan, math.nan) for beacon in beacons]
+        if not beacons and not tracked and not ranged:
+            return None
+        return beacons, tracked, ranged, guesses
+
+    def _solve_dirty(self, beacons, guesses):
+        """
+        Solve the beacons from _collect_dirty. Touches no locator state, so
+         it can run on another thread.
+        :return: dict The best_points result, or None if there are none
+        """
+        if not beacons:
+            return None
+        return self.solver.best_points([beacon[3][:3] for beacon in beacons],
+                                       initial_guesses=guesses)
+
+    def _finish_dirty(self, beacons, tracked, ranged, result, solved):
+        """
+        Publish what _collect_dirty and _solve_dirty found.
+        :param solved: float Epoch seconds the solver finished
+        """
+        for msg in ranged:
+            self._publish_range(*msg)
+
+        for i, (bt_addr, msg_timestamp, timestamp, gathered, trace) in \
+                enumerate(beacons):
+            coords = tuple(float(c) for c in result['coords'][i])
+            meta = dict(avg_err=float(result['avg_err'][i]), **gathered[3])
+            if self.tracker:
+                with self._lock:
+                    track = self.tracker.start(bt_addr, timestamp, coords,
+                                               meta['avg_err'])
+                meta.update(self.tracker.describe(track))
+            tracked.append((bt_addr, msg_timestamp, coords, meta,
+                            stamp(trace, "solve", solved)))
+
+        now = monotonic()
+        for bt_addr, msg_timestamp, coords, meta, trace in tracked:
+            self._publish_moved(bt_addr, msg_timestamp, coords, meta, trace,
+                                now)
+
+    def _run_ticker(self):
+        deadline = monotonic()
+        while True:
+            deadline += self.tick
+            if self._stopped.wait(max(0.0, deadline - monotonic())):
+                return
+            try:
+                self._locate_dirty()
+            except Exception:
+                traceback.print_exc()
+
+    def handle(self, channel, message, received=None):
+        """
+        Subscribe handler for 'raw_channel' and 'nodes' messages.
+        :param received: float Epoch seconds the message arrived, if it
+          waited in a queue before getting here (default now)
+        """
+        REGISTRY.inc("locator_messages_total", labels={"channel": channel})
         if channel == 'raw_channel':
-            self._range(message, channel)
+            ingest = time() if received is None else received
+            with self._lock:
+                message = self.decoder.decode(message)
+                if is_batch(message):
+                    # One message per node per window from BatchPublisher
+                    trace = ingest_trace(message, ingest)
+                    if trace is not None and "tx" in trace:
+                        REGISTRY.observe("locator_ingest_lag_seconds",
+                                         trace["ingest"] - trace["tx"])
+                    self._range_batch(list(unbatch(message)), trace)
+                else:
+                    self._range(message, channel)
         elif channel == 'nodes':
-            self.get_nodes()
+            self.nodes.apply(message)
         else:
             pass
 
+    def start_ticker(self):
+        if self.tick and self._ticker is None:
+            self._stopped.clear()
+            self._ticker = threading.Thread(target=self._run_ticker)
+            self._ticker.daemon = True
+            self._ticker.start()
+
     def start(self):
-        self.pubnub.add_listener(self)
-        self.pubnub.subscribe() \
-            .channels(['raw_channel', 'nodes']) \
-            .execute()
+        self.start_ticker()
+        self.transport.subscribe(['raw_channel', 'nodes'], self.handle)
 
     def stop(self):
-        self.pubnub.unsubscribe_all()
+        self.transport.unsubscribe_all()
+        self._stopped.set()
+        self._ticker = None
 
 
 if __name__ == '__main__':
+    import argparse
     import os
-    import sys
 
-    if len(sys.argv) == 1:
-        try:
-            sys.argv.append(os.environ['PUB_KEY'])
-            sys.argv.append(os.environ['SUB_KEY'])
-        except KeyError:
-            print("Set the PUB_KEY and SUB_KEY arguments!")
-            print('-  export PUB_KEY="<pub_key_here>"')
-            print("Alternatively, run locate.py with those args, like:")
-            print("-  python locate.py <pub_key> <sub_key>")
-            quit()
-    elif len(sys.argv) != 3:
-        print("Run locate.py with two arguments: ")
-        print("-  pub_key: a PubNub publishing key.")
-        print("-  sub_key: a PubNub subscription key.")
-        print("It looks like: ")
+    parser = argparse.ArgumentParser(
+        description='Locate BLE beacons from scanner messages.'
+    )
+    parser.add_argument(
+        'pub_key', nargs='?', default=os.environ.get('PUB_KEY'),
+        help='A PubNub publishing key (default: $PUB_KEY)'
+    )
+    parser.add_argument(
+        'sub_key', nargs='?', default=os.environ.get('SUB_KEY'),
+        help='A PubNub subscription key (default: $SUB_KEY)'
+    )
+    parser.add_argument(
+        '--solver', default='L-BFGS-B',
+        help='Trilateration method: gauss-newton or a scipy method'
+    )
+    parser.add_argument(
+        '--tick', type=float, default=None,
+        help='Locate updated beacons in one batch every TICK seconds'
+    )
+    parser.add_argument(
+        '--max_rate', type=float, default=None,
+        help='Max location updates per second for each beacon'
+    )
+    parser.add_argument(
+        '--min_move', type=float, default=0.0,
+        help='Skip location updates that moved less than this (meters)'
+    )
+    parser.add_argument(
+        '--track', choices=['kalman', 'particle'], default=None,
+        help='Track beacons with a filter, publishing filtered positions'
+    )
+    parser.add_argument(
+        '--calibration', default=CALIBRATION_FILE,
+        help='Path-loss calibration table (see calibration.py)'
+    )
+    parser.add_argument(
+        '--metrics_port', type=int, default=os.environ.get('METRICS_PORT'),
+        help='Serve Prometheus metrics on this port (default: '
+             '$METRICS_PORT); with --workers, worker i uses port + 1 + i'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Worker processes to shard beacons across'
+    )
+    parser.add_argument(
+        '--transport', default=os.environ.get('TRANSPORT'),
+        help='pubnub (default), or a local broker like tcp://host:port '
+             'or unix:///path (default: $TRANSPORT)'
+    )
+    args = parser.parse_args()
+
+    if is_pubnub(args.transport) and (not args.pub_key or not args.sub_key):
+        print("Set the PUB_KEY and SUB_KEY arguments!")
+        print('-  export PUB_KEY="<pub_key_here>"')
+        print("Alternatively, run locate.py with those args, like:")
         print("-  python locate.py <pub_key> <sub_key>")
         quit()
 
-    print(sys.argv)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
 
-    locator = BeaconLocator(sys.argv[1], sys.argv[2])
+    locator_kwargs = dict(solver_method=args.solver, tick=args.tick,
+                          max_rate=args.max_rate, min_move=args.min_move,
+                          transport=args.transport, track=args.track,
+                          calibration=args.calibration)
+    if args.workers > 1:
+        try:
+            from app.src.locate_sharded import ShardedLocator
+        except ModuleNotFoundError as e:
+            from locate_sharded import ShardedLocator
+        locator = ShardedLocator(args.pub_key, args.sub_key,
+                                 workers=args.workers,
+                                 metrics_port=args.metrics_port,
+                                 **locator_kwargs)
+    else:
+        locator = BeaconLocator(args.pub_key, args.sub_key, **locator_kwargs)
     locator.start()
@@ -0,0 +1,285 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+try:
+    from app.src.locate import BeaconLocator
+    from app.src.metrics import REGISTRY
+    from app.src.transport import is_pubnub, make_async_transport
+except ModuleNotFoundError as e:
+    from locate import BeaconLocator
+    from metrics import REGISTRY
+    from transport import is_pubnub, make_async_transport
+
+
+class AsyncBeaconLocator(BeaconLocator):
+    """
+    BeaconLocator as a pipeline of asyncio tasks joined by bounded queues:
+
+      transport -> ingest queue -> range task -> dirty beacons
+        -> solve task (solver in an executor) -> publish queue
+        -> publish task -> transport
+
+    Beacons are always located in batches, like BeaconLocator's tick mode,
+    but a new batch starts as soon as the last one is solved (or `tick`
+    seconds after it started, if set). While a batch is being solved,
+    ranging carries on and beacons updated meanwhile wait for the next one,
+    so a slow solver means bigger batches rather than a growing backlog.
+
+    A full publish queue holds up the solve task, and a full ingest queue
+    holds up the transport (see AsyncTransport), so memory stays bounded
+    under overload. Node history is fetched in the background, never inside
+    message handling.
+
+    All locator state is touched from the event loop only; the solver works
+    on copies gathered before it starts.
+    """
+
+    def __init__(self, pub_key, sub_key, queue_size=1000,
+                 publish_queue_size=10000, executor=None, tick=None,
+                 **locator_kwargs):
+        """
+        :param queue_size: int Max messages waiting to be ranged
+        :param publish_queue_size: int Max messages waiting to be published
+        :param executor: concurrent.futures.Executor Runs the solver
+          (default: one worker thread)
+        :param tick: float Min seconds between the starts of batches
+        :param locator_kwargs: dict See BeaconLocator; transport is a URL or
+          a Transport or AsyncTransport, with PubNub's asyncio client by
+          default
+        """
+        self.loop = None
+        self._nodes_wanted = False
+        self._nodes_fetch = None
+        BeaconLocator.__init__(self, pub_key, sub_key, tick=tick,
+                               **locator_kwargs)
+        self.deferred = True
+        self.queue_size = queue_size
+        self.publish_queue_size = publish_queue_size
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="solver")
+        self.inbox = None
+        self.outbox = None
+        self._pending = []  # Published by the last stage, not queued yet
+        self._wake = None
+        self._solving = None
+        self._tasks = []
+
+        REGISTRY.gauge("locator_ingest_queue_depth",
+                       "Messages waiting to be ranged",
+                       lambda: self.inbox.qsize())
+        REGISTRY.gauge("locator_publish_queue_depth",
+                       "Messages waiting to be published",
+                       lambda: self.outbox.qsize())
+        REGISTRY.gauge("locator_ingest_dropped_total",
+                       "Messages dropped because the ingest queue was full",
+                       lambda: self.transport.dropped, kind="counter")
+
+    @staticmethod
+    def _make_transport(transport, pub_key, sub_key):
+        return make_async_transport(transport, pub_key, sub_key)
+
+    def get_nodes(self):
+        """Fetch the 'nodes' history in the background."""
+        self._nodes_wanted = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._fetch_nodes)
+
+    def _fetch_nodes(self):
+        if not self._nodes_wanted or self._nodes_fetch is not None:
+            return
+        self._nodes_wanted = False
+        self._nodes_fetch = asyncio.ensure_future(self._load_history())
+
+    async def _load_history(self):
+        try:
+            self.nodes.apply_history(await self.transport.history("nodes"))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._nodes_fetch = None
+        # Asked for again while this fetch was running
+        self._fetch_nodes()
+
+    def _publish(self, channel, message):
+        REGISTRY.inc("locator_published_total", labels={"channel": channel})
+        self._pending.append((channel, message))
+
+    async def _flush_pending(self):
+        pending = self._pending
+        self._pending = []
+        for item in pending:
+            await self.outbox.put(item)
+
+    async def _range_task(self):
+        while True:
+            channel, message, received = await self.inbox.get()
+            try:
+                self.handle(channel, message, received)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.inbox.task_done()
+            if self._dirty:
+                self._wake.set()
+
+    async def _solve_task(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            started = self.loop.time()
+            try:
+                await self.locate_dirty()
+            except Exception:
+                traceback.print_exc()
+            if self._dirty:
+                # Debounced by max_rate; look again when they may be due
+                self.loop.call_later(self.min_interval, self._wake.set)
+            if self.tick:
+                await asyncio.sleep(max(0.0, started + self.tick -
+                                        self.loop.time()))
+
+    async def locate_dirty(self):
+        """Locate every beacon updated since the last batch."""
+        async with self._solving:
+            work = self._collect_dirty()
+            if work is None:
+                return
+            beacons, tracked, ranged, guesses = work
+            result = None
+            if beacons:
+                result = await self.loop.run_in_executor(
+                    self.executor, self._solve_dirty, beacons, guesses)
+            self._finish_dirty(beacons, tracked, ranged, result, time())
+            await self._flush_pending()
+
+    async def _publish_task(self):
+        while True:
+            channel, message = await self.outbox.get()
+            try:
+                await self.transport.publish(channel, message)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.outbox.task_done()
+
+    async def start(self):
+        """Start the pipeline on the running event loop and subscribe."""
+        self.loop = asyncio.get_running_loop()
+        self.inbox = asyncio.Queue(self.queue_size)
+        self.outbox = asyncio.Queue(self.publish_queue_size)
+        self._wake = asyncio.Event()
+        self._solving = asyncio.Lock()
+        self._tasks = [asyncio.ensure_future(coro) for coro in
+                       (self._range_task(), self._solve_task(),
+                        self._publish_task())]
+        self._fetch_nodes()
+        self.transport.subscribe(['raw_channel', 'nodes'], self.inbox)
+
+    async def stop(self):
+        """Finish what's queued, publish it, and stop."""
+        self.transport.unsubscribe_all()
+        await self.transport.drain()
+        await self.inbox.join()
+        await self.locate_dirty()
+        await self.outbox.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.transport.close()
+        self.executor.shutdown(wait=False)
+
+    async def run(self):
+        """Start, then run until cancelled."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    try:
+        from app.src.calibration import CALIBRATION_FILE
+        from app.src.metrics import serve_metrics
+    except ModuleNotFoundError as e:
+        from calibration import CALIBRATION_FILE
+        from metrics import serve_metrics
+
+    parser = argparse.ArgumentParser(
+        description='Locate BLE beacons from scanner messages, with asyncio.'
+    )
+    parser.add_argument(
+        'pub_key', nargs='?', default=os.environ.get('PUB_KEY'),
+        help='A PubNub publishing key (default: $PUB_KEY)'
+    )
+    parser.add_argument(
+        'sub_key', nargs='?', default=os.environ.get('SUB_KEY'),
+        help='A PubNub subscription key (default: $SUB_KEY)'
+    )
+    parser.add_argument(
+        '--solver', default='L-BFGS-B',
+        help='Trilateration method: gauss-newton or a scipy method'
+    )
+    parser.add_argument(
+        '--tick', type=float, default=None,
+        help='Min seconds between location batches'
+    )
+    parser.add_argument(
+        '--max_rate', type=float, default=None,
+        help='Max location updates per second for each beacon'
+    )
+    parser.add_argument(
+        '--min_move', type=float, default=0.0,
+        help='Skip location updates that moved less than this (meters)'
+    )
+    parser.add_argument(
+        '--track', choices=['kalman', 'particle'], default=None,
+        help='Track beacons with a filter, publishing filtered positions'
+    )
+    parser.add_argument(
+        '--calibration', default=CALIBRATION_FILE,
+        help='Path-loss calibration table (see calibration.py)'
+    )
+    parser.add_argument(
+        '--queue_size', type=int, default=1000,
+        help='Max messages waiting to be ranged'
+    )
+    parser.add_argument(
+        '--metrics_port', type=int, default=os.environ.get('METRICS_PORT'),
+        help='Serve Prometheus metrics on this port (default: $METRICS_PORT)'
+    )
+    parser.add_argument(
+        '--transport', default=os.environ.get('TRANSPORT'),
+        help='pubnub (default), or a local broker like tcp://host:port '
+             'or unix:///path (default: $TRANSPORT)'
+    )
+    args = parser.parse_args()
+
+    if is_pubnub(args.transport) and (not args.pub_key or not args.sub_key):
+        print("Set the PUB_KEY and SUB_KEY arguments!")
+        print('-  export PUB_KEY="<pub_key_here>"')
+        print("Alternatively, run locate_async.py with those args, like:")
+        print("-  python locate_async.py <pub_key> <sub_key>")
+        quit()
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    async def main():
+        locator = AsyncBeaconLocator(
+            args.pub_key, args.sub_key, solver_method=args.solver,
+            tick=args.tick, max_rate=args.max_rate, min_move=args.min_move,
+            transport=args.transport, track=args.track,
+            calibration=args.calibration, queue_size=args.queue_size)
+        await locator.run()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
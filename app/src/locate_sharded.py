@@ -0,0 +1,193 @@
+import bisect
+import hashlib
+import multiprocessing
+import traceback
+
+try:
+    from app.src.batching import is_batch
+    from app.src.locate import BeaconLocator
+    from app.src.metrics import REGISTRY, serve_metrics
+    from app.src.tracing import TRACE_KEY, ingest_trace
+    from app.src.registry import NODE_SNAPSHOT, NodeRegistry
+    from app.src.transport import make_transport
+    from app.src.wire import WireDecoder
+except ModuleNotFoundError as e:
+    from batching import is_batch
+    from locate import BeaconLocator
+    from metrics import REGISTRY, serve_metrics
+    from tracing import TRACE_KEY, ingest_trace
+    from registry import NODE_SNAPSHOT, NodeRegistry
+    from transport import make_transport
+    from wire import WireDecoder
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping beacon addresses to shards.
+
+    Each shard owns `replicas` points on the ring, so beacons spread evenly
+    and changing the shard count only moves about 1/K of them.
+    """
+
+    def __init__(self, shards, replicas=64):
+        """
+        :param shards: int Number of shards
+        :param replicas: int Points on the ring per shard
+        """
+        points = sorted(
+            (_hash("shard-{}-{}".format(shard, replica)), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+        self._cache = {}
+
+    def shard_for(self, bt_addr):
+        """
+        :param bt_addr: str Beacon MAC address
+        :return: int Index of the shard that owns the beacon
+        """
+        shard = self._cache.get(bt_addr)
+        if shard is None:
+            idx = bisect.bisect(self._keys, _hash(bt_addr)) % len(self._keys)
+            shard = self._cache[bt_addr] = self._shards[idx]
+        return shard
+
+
+def run_worker(queue, pub_key, sub_key, node_map, locator_kwargs,
+               metrics_port=None):
+    """
+    Worker process: owns the ranging/location state for its beacons and
+      publishes 'ranged' and 'located' messages itself.
+    :param queue: multiprocessing.Queue Of (channel, message), None to stop
+    :param node_map: dict Known node coordinates, { name: (x, y) }
+    :param locator_kwargs: dict Extra BeaconLocator arguments
+    :param metrics_port: int Serve this worker's metrics on this port
+    """
+    if metrics_port:
+        # Registries are per process, so each worker serves its own
+        serve_metrics(metrics_port)
+    locator = BeaconLocator(pub_key, sub_key, node_map=node_map,
+                            **locator_kwargs)
+    locator.start_ticker()
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        try:
+            locator.handle(*item)
+        except Exception:
+            traceback.print_exc()
+    locator.stop()
+
+
+class ShardedLocator(object):
+    """
+    Subscribe once and fan 'raw_channel' messages out to worker processes,
+      each running its own BeaconLocator for the beacons it owns.
+
+    Beacons are assigned to workers by consistent hashing of bt_addr. Batch
+      messages are split so each worker only gets its own beacons. 'nodes'
+      messages go to every worker.
+
+    Workers make their own transport, so with a local broker `transport`
+      must be a tcp:// or unix:// URL, not memory:// or a Transport object.
+    """
+
+    def __init__(self, pub_key, sub_key, workers=2, queue_size=10000,
+                 node_snapshot=NODE_SNAPSHOT, transport=None,
+                 metrics_port=None, **locator_kwargs):
+        """
+        :param workers: int Number of worker processes
+        :param queue_size: int Max messages waiting per worker; when full,
+          ingest blocks until the worker catches up
+        :param node_snapshot: str File to persist known nodes to
+        :param transport: str Transport URL, see make_transport
+        :param metrics_port: int If set, worker i serves its metrics (the
+          per-stage timings) on metrics_port + 1 + i; the parent's own go
+          on metrics_port, served by the caller
+        :param locator_kwargs: dict Passed to each worker's BeaconLocator
+        """
+        self.pub_key = pub_key
+        self.sub_key = sub_key
+        self.workers = max(int(workers), 1)
+        self.queue_size = queue_size
+        self.metrics_port = metrics_port
+        self.locator_kwargs = dict(locator_kwargs, transport=transport)
+        self.ring = HashRing(self.workers)
+        self.queues = []
+        self.processes = []
+
+        self.transport = make_transport(transport, pub_key, sub_key)
+        self.nodes = NodeRegistry(snapshot_path=node_snapshot)
+        # Compact messages are unpacked here so they can be split by beacon
+        self.decoder = WireDecoder()
+
+    def start_workers(self, node_map=None):
+        if node_map is None:
+            # Read the nodes once here so workers don't each fetch them
+            if not len(self.nodes):
+                self.nodes.load_history(self.transport)
+            node_map = dict(self.nodes.coords)
+        # Spawn, not fork - the parent has transport threads running
+        context = multiprocessing.get_context("spawn")
+        for worker in range(self.workers):
+            queue = context.Queue(self.queue_size)
+            metrics_port = None
+            if self.metrics_port:
+                metrics_port = int(self.metrics_port) + 1 + worker
+            process = context.Process(
+                target=run_worker,
+                args=(queue, self.pub_key, self.sub_key, node_map,
+                      self.locator_kwargs, metrics_port))
+            process.daemon = True
+            process.start()
+            REGISTRY.gauge("locator_worker_queue_depth",
+                           "Messages waiting for a worker", queue.qsize,
+                           labels={"worker": worker})
+            self.queues.append(queue)
+            self.processes.append(process)
+
+    def route(self, channel, message):
+        if channel == 'raw_channel':
+            message = self.decoder.decode(message)
+            if is_batch(message):
+                if TRACE_KEY in message:
+                    # Ingest is timed here, before any wait in a worker's
+                    #   queue
+                    message = dict(message,
+                                   **{TRACE_KEY: ingest_trace(message)})
+                shards = {}
+                for bt_addr, slot in message["beacons"].items():
+                    shard = self.ring.shard_for(bt_addr)
+                    if shard not in shards:
+                        shards[shard] = dict(message, beacons={})
+                    shards[shard]["beacons"][bt_addr] = slot
+                for shard, part in shards.items():
+                    self.queues[shard].put((channel, part))
+            else:
+                shard = self.ring.shard_for(message[0])
+                self.queues[shard].put((channel, message))
+        elif channel == 'nodes':
+            self.nodes.apply(message)
+            for queue in self.queues:
+                queue.put((channel, message))
+
+    def start(self):
+        if not self.processes:
+            self.start_workers()
+        self.transport.subscribe(['raw_channel', 'nodes'], self.route)
+
+    def stop(self, timeout=5.0):
+        self.transport.unsubscribe_all()
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        self.queues = []
+        self.processes = []
@@ -0,0 +1,261 @@
+import functools
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import monotonic
+
+# Histograms are log-linear, like HDR histograms: every power of two from
+#   MIN_VALUE up is split into SUB_BUCKETS equal buckets, so any recorded
+#   value is off by at most 1 / SUB_BUCKETS (12.5%) relative.
+MIN_VALUE = 1e-6  # 1 microsecond, for timings in seconds
+OCTAVES = 28  # Up to about 268 seconds
+SUB_BUCKETS = 8
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    """A value read from a callback when scraped, like a queue depth."""
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    @property
+    def value(self):
+        try:
+            return self.fn()
+        except Exception:
+            return float("nan")
+
+
+class Histogram(object):
+    __slots__ = ("counts", "total", "count", "_lock")
+
+    def __init__(self):
+        self.counts = [0] * (OCTAVES * SUB_BUCKETS + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(value):
+        """:return: int Index of the bucket holding value"""
+        if value < MIN_VALUE:
+            return 0
+        mantissa, exponent = math.frexp(value / MIN_VALUE)
+        index = (exponent - 1) * SUB_BUCKETS + \
+            int((mantissa - 0.5) * 2 * SUB_BUCKETS) + 1
+        return min(index, OCTAVES * SUB_BUCKETS)
+
+    @staticmethod
+    def upper_bound(index):
+        """:return: float The largest value in bucket index"""
+        if index == 0:
+            return MIN_VALUE
+        octave, sub = divmod(index - 1, SUB_BUCKETS)
+        return MIN_VALUE * 2 ** octave * (1 + (sub + 1) / float(SUB_BUCKETS))
+
+    def observe(self, value):
+        index = self.bucket(value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def percentile(self, fraction):
+        """:return: float Upper bound of the bucket holding the percentile"""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.upper_bound(index)
+        return self.upper_bound(len(counts) - 1)
+
+
+class MetricsRegistry(object):
+    """
+    Named counters, gauges and histograms, exported in the Prometheus text
+      format.
+
+    Timers and counters check `enabled` first, so while no metrics endpoint
+    is running the instrumented code pays one attribute lookup per call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # name -> (kind, help, { labels tuple: metric })
+        self._families = {}
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (kind, help_text, {})
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+        return metric
+
+    def counter(self, name, help_text="", labels=None):
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text="", labels=None):
+        return self._get("histogram", name, help_text, labels, Histogram)
+
+    def gauge(self, name, help_text, fn, labels=None, kind="gauge"):
+        """
+        Register (or replace) a metric read from fn() at scrape time.
+        :param kind: str "gauge", or "counter" for a total kept elsewhere
+        """
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help_text, {}))
+            family[2][key] = Gauge(fn)
+
+    def inc(self, name, amount=1, labels=None):
+        """Increment a counter, if metrics are enabled."""
+        if self.enabled:
+            self.counter(name, labels=labels).inc(amount)
+
+    def observe(self, name, value, labels=None):
+        """Record a histogram value, if metrics are enabled."""
+        if self.enabled:
+            self.histogram(name, labels=labels).observe(value)
+
+    def render(self):
+        """:return: str All metrics in the Prometheus text format"""
+        with self._lock:
+            families = sorted((name, kind, help_text, dict(metrics))
+                              for name, (kind, help_text, metrics)
+                              in self._families.items())
+        lines = []
+        for name, kind, help_text, metrics in families:
+            if help_text:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key, metric in sorted(metrics.items()):
+                labels = dict(key)
+                if kind == "histogram":
+                    lines += _render_histogram(name, labels, metric)
+                else:
+                    lines.append("{}{} {}".format(
+                        name, _labels(labels), _number(metric.value)))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())) + "}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+
+def _render_histogram(name, labels, histogram):
+    with histogram._lock:
+        counts = list(histogram.counts)
+        total = histogram.total
+        count = histogram.count
+    lines = []
+    # Only octave edges are exported, to keep scrapes small
+    cumulative = counts[0]
+    for octave in range(OCTAVES):
+        start = octave * SUB_BUCKETS + 1
+        cumulative += sum(counts[start:start + SUB_BUCKETS])
+        le = MIN_VALUE * 2 ** (octave + 1)
+        lines.append("{}_bucket{} {}".format(
+            name, _labels(dict(labels, le="{:g}".format(le))), cumulative))
+    lines.append("{}_bucket{} {}".format(
+        name, _labels(dict(labels, le="+Inf")), count))
+    lines.append("{}_sum{} {}".format(name, _labels(labels), repr(total)))
+    lines.append("{}_count{} {}".format(name, _labels(labels), count))
+    return lines
+
+
+REGISTRY = MetricsRegistry()
+
+
+def timed(name, help_text="", registry=REGISTRY):
+    """
+    Decorator recording how long each call takes into a histogram, when
+      metrics are enabled.
+    """
+    def decorate(fn):
+        histogram = registry.histogram(name, help_text)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            start = monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(monotonic() - start)
+        return wrapper
+    return decorate
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the logs
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_metrics(port, host="0.0.0.0", registry=REGISTRY):
+    """
+    Enable metrics and serve them at http://host:port/metrics from a
+      daemon thread.
+    :return: HTTPServer The server; call shutdown() to stop it
+    """
+    registry.enabled = True
+    handler = type("MetricsHandler", (_MetricsHandler,),
+                   {"registry": registry})
+    server = _MetricsServer((host, int(port)), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
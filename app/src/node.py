@@ -1,23 +1,29 @@
 import datetime
 import json
 import logging
+import logging.handlers
 import os
 import threading
 import time
 import uuid
+from time import monotonic
 from timeit import default_timer as timer
 
 from pubnub.enums import PNStatusCategory
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
 
 try:
     import gps
     import scan
+    from metrics import REGISTRY
+    from spool import Spool, SpoolForwarder
+    from transport import is_pubnub, make_transport
     from utility import get_pn_uuid, UTC, sloppy_smaller
 except ImportError:
     import app.src.gps as gps
     import app.src.scan as scan
+    from app.src.metrics import REGISTRY
+    from app.src.spool import Spool, SpoolForwarder
+    from app.src.transport import is_pubnub, make_transport
     from app.src.utility import get_pn_uuid, UTC, sloppy_smaller
 
 # ScanService needs a node name to publish and configure via PubNub.
@@ -33,7 +39,13 @@ FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(FILE_DIR, "..", "..", "logs")
 STR_DATE = datetime.datetime.now().strftime("%y%m%d_%H%M")
 MSG_LOG = os.path.join(LOG_DIR, 'messages-{}.log'.format(STR_DATE))
+# Every message sent is archived in MSG_LOG, rotated to MSG_LOG.1, ... so
+#   the archive stays under about (MSG_LOG_BACKUPS + 1) * MSG_LOG_BYTES
+MSG_LOG_BYTES = 16 * 1024 * 1024
+MSG_LOG_BACKUPS = 4
 NODE_LOG = os.path.join(LOG_DIR, "node.log")
+# Messages wait here until PubNub has them, across restarts
+SPOOL_DIR = os.path.join(LOG_DIR, "spool")
 
 logger = logging.getLogger('node')
 logfile = logging.FileHandler(NODE_LOG)
@@ -41,9 +53,92 @@ formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s:: %(message)
 logfile.setFormatter(formatter)
 logger.addHandler(logfile)
 
+# One JSON message per line, through a file handle that stays open
+msg_logger = logging.getLogger('node.messages')
+msg_logger.setLevel(logging.INFO)
+msg_logger.propagate = False
+msg_logfile = logging.handlers.RotatingFileHandler(
+    MSG_LOG, maxBytes=MSG_LOG_BYTES, backupCount=MSG_LOG_BACKUPS, delay=True)
+msg_logfile.setFormatter(logging.Formatter('%(message)s'))
+msg_logger.addHandler(msg_logfile)
+
+
+class MessageScheduler(object):
+    """
+    Decides when the node sends its next message: every `interval` seconds,
+    or as soon as an alarm is raised, but never within `min_gap` seconds of
+    the last one.
+
+    The node's thread sleeps in wait() until one of those is due. Alarms
+    come from other threads (the GPS service) and wake it at once,
+    so nothing polls. Periodic deadlines advance by whole intervals from
+    the previous deadline rather than from when the thread woke up, so they
+    don't drift; an alarm message restarts the period, like it always has.
+    """
+
+    def __init__(self, interval, min_gap=1.0):
+        """
+        :param interval: float Seconds between messages without alarms
+        :param min_gap: float Min seconds between any two messages
+        """
+        self.interval = interval
+        self.min_gap = min_gap
+        self._cond = threading.Condition()
+        self._alarm = False
+        self._stopped = False
+        self._last = None
+        self._deadline = None
+
+    def start(self):
+        """Start the clock, with an alarm so the first message comes soon."""
+        with self._cond:
+            now = monotonic()
+            self._last = now  # Give the scanner min_gap to see something
+            self._deadline = now + self.interval
+            self._alarm = True
+
+    def alarm(self):
+        """Ask for a message now. Safe to call from any thread."""
+        with self._cond:
+            self._alarm = True
+            self._cond.notify_all()
+
+    def stop(self):
+        """Make wait() return False, now and from then on."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def wait(self):
+        """
+        Block until the next message is due.
+        :return: bool True when it is, or False once stopped
+        """
+        with self._cond:
+            while not self._stopped:
+                now = monotonic()
+                periodic = now >= self._deadline
+                earliest = self._last + self.min_gap
+                if (self._alarm or periodic) and now >= earliest:
+                    if self._alarm and not periodic:
+                        self._deadline = now + self.interval
+                    else:
+                        # Skip deadlines missed while busy, keeping the phase
+                        missed = (now - self._deadline) // self.interval
+                        self._deadline += (missed + 1) * self.interval
+                    self._alarm = False
+                    self._last = now
+                    return True
+                if self._alarm or periodic:
+                    self._cond.wait(earliest - now)
+                else:
+                    self._cond.wait(self._deadline - now)
+            return False
+
 
 class Node(threading.Thread):
-    def __init__(self, gps_device, pub_key=None, sub_key=None, interval=300, debug=False):
+    def __init__(self, gps_device, pub_key=None, sub_key=None, interval=300, debug=False,
+                 transport=None, ubx_pvt=False):
         if not debug:
             logger.setLevel(logging.INFO)
         else:
@@ -65,10 +160,10 @@ class Node(threading.Thread):
             print("*** Debug messages are not complete messages.")
 
         self.switch = True
-        self.msg_alarm = 0
+        self.scheduler = MessageScheduler(self.interval)
 
         # This is the alternative to keeping secrets on the Pi
-        while pub_key is None or sub_key is None:
+        while is_pubnub(transport) and (pub_key is None or sub_key is None):
             if pub_key is None:
                 while True:
                     p1 = input("Enter your publishing key: ")
@@ -88,22 +183,28 @@ class Node(threading.Thread):
 
         # Set up PubNub for publishing stream data
         # In the future we would outsource our publishing to separate layer
-        logger.info("Connecting to PubNub")
-        pnconfig = PNConfiguration()
-        pnconfig.subscribe_key = sub_key
-        pnconfig.publish_key = pub_key
-        pnconfig.uuid = NODE
-        pnconfig.ssl = False
+        logger.info("Connecting to {}".format(transport or "PubNub"))
         try:
-            self.pubnub = PubNub(pnconfig)
-            logger.info("Connected with SSL set to {}".format(pnconfig.ssl))
+            self.transport = make_transport(transport, pub_key, sub_key,
+                                            uuid=NODE)
+            logger.info("Connected")
         except Exception:
-            self.pubnub = None
-            logger.warning("No PubNub connection. Running offline-only mode.")
+            self.transport = None
+            logger.warning("No connection. Running offline-only mode.")
+
+        # Debug messages are only archived, so there's nothing to forward
+        self.forwarder = None
+        if not self.debug:
+            logger.info("Opening spool {}".format(SPOOL_DIR))
+            self.forwarder = SpoolForwarder(Spool(SPOOL_DIR), self.transport,
+                                            callback=self._publish_callback)
+            self.forwarder.register_metrics("node_spool")
 
         logger.info("Setting up GPS service")
-        self.gps_svc = gps.CoordinateService(gps_device, debug=debug)
+        self.gps_svc = gps.CoordinateService(gps_device, debug=debug,
+                                              ubx_pvt=ubx_pvt)
         self.gps_svc.daemon = True
+        self.gps_svc.on_alarm = self.scheduler.alarm
 
         logger.info("Setting up BLE scanning service")
         self.scan_svc = scan.BleMonitor(debug=debug)
@@ -112,20 +213,19 @@ class Node(threading.Thread):
         logger.info("Node initialized - ready for start")
 
     def _publish_callback(self, result, status):
+        REGISTRY.inc("node_publish_total", labels={
+            "result": status.category.name if status.is_error() else "ok"})
+        # The forwarder has already acked or kept the message in the spool
         if not status.is_error():
-            # Successful publish event - set for local message deletion
-            self.scan_svc.reset_in_view(
-                status_to_remove="retrieved",
-                new_status='published'
-            )
+            # Successful publish event - sightings were already drained
+            pass
         elif status.category == PNStatusCategory.PNAccessDeniedCategory:
-            # Store message
             logger.warning("Publish failed with PNAccessDenied")
         elif status.category == PNStatusCategory.PNBadRequestCategory:
             # Maybe bad keys, or an SDK error
             logger.warning("Publish failed with PNABadRequestCategory")
         elif status.category == PNStatusCategory.PNTimeoutCategory:
-            # Store message and retry later
+            # Spooled; replayed once publishing works again
             logger.warning("Publish failed with PNTimeoutCategory")
 
     def _log_and_publish(self, log=True):
@@ -140,8 +240,9 @@ class Node(threading.Thread):
             self.expected = now + datetime.timedelta(seconds=30)
 
         msg_id = str(uuid.uuid1())
-        msgs = self.scan_svc.retrieve_in_view(reset=True,
-                                              set_status='retrieved')
+        # Each sighting gets where the node was when it was seen
+        msgs = self.scan_svc.retrieve_in_view(
+            position_at=self.gps_svc.position_at)
 
         logging.debug("--setting msg vars")
         if location:
@@ -183,8 +284,7 @@ class Node(threading.Thread):
             }
 
             if log:
-                with open(MSG_LOG, 'a') as msg_log:
-                    msg_log.writelines([json.dumps(main_msg), "\n"])
+                msg_logger.info(json.dumps(main_msg))
 
         except Exception:
             logger.exception("\n"
@@ -194,13 +294,9 @@ class Node(threading.Thread):
             main_msg = None
 
         logging.debug("--pushing")
-        if not self.debug and self.pubnub and main_msg:
-            self.pubnub.publish() \
-                .channel('node_raw') \
-                .message(main_msg) \
-                .should_store(True) \
-                .meta({"msg_id": msg_id}) \
-                .pn_async(self._publish_callback)
+        if self.forwarder and main_msg:
+            # Spooled first; published now if online, or replayed later
+            self.forwarder.send(msg_id, 'node_raw', main_msg)
         else:
             logger.debug(("OFFLINE MSG", {
                 "gps": self.gps_svc.get_latest_fix(),
@@ -228,40 +324,20 @@ class Node(threading.Thread):
                 logger.info("GPS fix acquired")
                 break
 
+        if self.forwarder:
+            logger.info("Starting spool forwarder")
+            self.forwarder.start()
+
         logger.info("Starting BLE scanner")
         self.scan_svc.start()
         logger.info("BLE scanner started")
 
-        clock = timer()  # Start a clock and publish a message on a timer
-        self.msg_alarm = 1  # Set to 1 to start with a message
-
-        """old_mod and new_mod get compared. Every X seconds (where X is
-        the interval) we will notice the new_mod fall below the
-        old_mod (ie: we passed another factor of interval). That's
-        when we should fire the message off! This method is nice
-        because it doesn't wander over time like threading.Timer or
-        a simple implementation of time.sleep."""
-        old_mod = 0.0
-        while self.switch:
-            elapsed = timer() - clock
-            new_mod = elapsed % self.interval
-            if new_mod < old_mod and not self.msg_alarm:
-                self.msg_alarm = 1
-            old_mod = new_mod
-
-            if (self.msg_alarm or
-                self.gps_svc.msg_alarm or
-                self.scan_svc.msg_alarm) and elapsed >= 1:  # max of ~1 msg/sec
-                self._log_and_publish()
-                # reset for a fresh check - do it first to let clock build
-                # messages come at various times; reset now vs. at mod check
-                clock = timer()
-                self.msg_alarm = 0
-                self.gps_svc.msg_alarm = 0
-                self.scan_svc.msg_alarm = 0
-                old_mod = 0.0  # reset at latest possible
-
-            time.sleep(0.1)
+        # Publish on a timer, or sooner on a GPS alarm (max ~1 msg/sec)
+        self.scheduler.start()
+        while self.switch and self.scheduler.wait():
+            # Reset first, so alarms raised while publishing aren't lost
+            self.gps_svc.msg_alarm = 0
+            self._log_and_publish()
 
     def terminate(self):
         logger.info("Shutting down GPS service")
@@ -270,5 +346,9 @@ class Node(threading.Thread):
         self.scan_svc.terminate()
         logger.info("Shutting down node")
         self.switch = False
+        self.scheduler.stop()
         self.join(3.0)
+        if self.forwarder:
+            logger.info("Closing spool")
+            self.forwarder.stop()
         logger.info("done")
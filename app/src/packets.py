@@ -0,0 +1,50 @@
+# The scan callback keeps references to the packet objects it receives,
+#   and they are only encoded here once a message is actually built.
+
+# Per-class list of the properties worth encoding, filled on first use
+_FIELDS = {}
+
+
+def _fields(cls):
+    fields = _FIELDS.get(cls)
+    if fields is None:
+        fields = tuple(
+            name for name in sorted(dir(cls))
+            if not name.startswith('_') and name != 'properties'
+            and isinstance(getattr(cls, name, None), property)
+        )
+        _FIELDS[cls] = fields
+    return fields
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return "{}".format(value)
+
+
+def encode_packet(packet):
+    """
+    Encode a beacontools packet (or properties dict) as a JSON-able dict,
+      like {"type": "EddystoneUIDFrame", "namespace": "...", ...}
+    :param packet: obj A beacontools packet, a properties dict, or None
+    :return: dict or None
+    """
+    if packet is None:
+        return None
+    if isinstance(packet, dict):
+        return _jsonable(packet)
+
+    encoded = {"type": type(packet).__name__}
+    for name in _fields(type(packet)):
+        try:
+            encoded[name] = _jsonable(getattr(packet, name))
+        except Exception:
+            continue  # Some properties only make sense for some subtypes
+    return encoded
@@ -0,0 +1,108 @@
+from collections import deque
+from datetime import datetime
+
+import dateutil.parser
+
+try:
+    from utility import UTC
+except ImportError:
+    from app.src.utility import UTC
+
+
+def parse_timestamp(value):
+    """
+    Convert a message timestamp to epoch seconds, once, at ingest.
+    :param value: str ISO 8601 timestamp, or epoch seconds as int or float
+    :return: float Epoch seconds
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (AttributeError, ValueError):  # Python < 3.7, or not ISO
+        return dateutil.parser.parse(value).timestamp()
+
+
+def format_timestamp(timestamp):
+    """
+    :param timestamp: float Epoch seconds
+    :return: str ISO 8601 timestamp in UTC
+    """
+    return datetime.fromtimestamp(timestamp, UTC).isoformat()
+
+
+class SlidingWindow(object):
+    """
+    Time-bounded window of samples with running sums.
+
+    Adding and evicting a sample are O(1), and so are the estimators, since
+    they read from the running sums instead of the samples. Samples are
+    expected in (roughly) increasing time order.
+    """
+    __slots__ = ("samples", "total", "recip_total", "maxlen")
+
+    ESTIMATORS = ("harmonic", "mean", "last")
+
+    def __init__(self, maxlen=1000):
+        """
+        :param maxlen: int Hard cap on samples, whatever their age
+        """
+        self.samples = deque()  # (timestamp, value)
+        self.total = 0.0
+        self.recip_total = 0.0
+        self.maxlen = maxlen
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, timestamp, value):
+        """
+        :param timestamp: float Epoch seconds of the sample
+        :param value: float A strictly positive value
+        """
+        self.samples.append((timestamp, value))
+        self.total += value
+        self.recip_total += 1.0 / value
+        if len(self.samples) > self.maxlen:
+            self._pop()
+
+    def _pop(self):
+        _, value = self.samples.popleft()
+        if self.samples:
+            self.total -= value
+            self.recip_total -= 1.0 / value
+        else:
+            # Start fresh so float error can't build up over time
+            self.total = 0.0
+            self.recip_total = 0.0
+
+    def evict(self, min_time):
+        """
+        Drop samples older than min_time.
+        :param min_time: float Epoch seconds
+        """
+        samples = self.samples
+        while samples and samples[0][0] < min_time:
+            self._pop()
+
+    def mean(self):
+        return self.total / len(self.samples)
+
+    def harmonic_mean(self):
+        return len(self.samples) / self.recip_total
+
+    def last(self):
+        return self.samples[-1][1]
+
+    def estimate(self, estimator="harmonic"):
+        """
+        :param estimator: str One of SlidingWindow.ESTIMATORS
+        :return: float The estimated value over the window
+        """
+        if estimator == "harmonic":
+            return self.harmonic_mean()
+        elif estimator == "mean":
+            return self.mean()
+        elif estimator == "last":
+            return self.last()
+        raise ValueError("Unknown estimator {}".format(estimator))
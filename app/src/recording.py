@@ -0,0 +1,308 @@
+import gzip
+import json
+import os
+import threading
+from time import monotonic, sleep, time
+
+try:
+    from ranging import parse_timestamp
+except ImportError:
+    from app.src.ranging import parse_timestamp
+
+# A recording is two files:
+#   session.rec      gzip members, one per chunk, each holding JSON lines
+#                    {"t": epoch seconds received, "ch": channel, "m": message}
+#   session.rec.idx  JSON lines, one per chunk,
+#                    {"offset": byte offset of the member, "t0": first t,
+#                     "t1": last t, "count": records in the chunk}
+# Both are only ever appended to. Concatenated gzip members are a valid gzip
+#   file, so a recording reads fine without its index; the index just lets a
+#   replay seek straight to a start time.
+INDEX_SUFFIX = ".idx"
+RECORDED_CHANNELS = ('raw_channel', 'nodes')
+
+
+class Recorder(object):
+    """
+    Append messages to a recording, one compressed chunk at a time.
+
+    record() has the same signature as a transport subscribe handler, so a
+    Recorder can subscribe to channels directly. Records are held in memory
+    until the chunk is `chunk_seconds` old or `chunk_records` long, so a
+    crash loses at most one chunk.
+    """
+
+    def __init__(self, path, chunk_seconds=10.0, chunk_records=5000):
+        """
+        :param path: str Recording file; appended to if it exists
+        :param chunk_seconds: float Max age of a chunk before it's written
+        :param chunk_records: int Max records in a chunk before it's written
+        """
+        self.path = path
+        self.chunk_seconds = chunk_seconds
+        self.chunk_records = chunk_records
+        self._lock = threading.Lock()
+        self._lines = []
+        self._t0 = None
+        self._t1 = None
+        self._opened = 0.0  # monotonic time of the first record in chunk
+        self.count = 0
+
+    def record(self, channel, message, timestamp=None):
+        """
+        :param channel: str Channel the message was sent on
+        :param message: The message, as sent
+        :param timestamp: float Epoch seconds it was seen (default now)
+        """
+        if timestamp is None:
+            timestamp = time()
+        line = json.dumps({"t": round(timestamp, 3), "ch": channel,
+                           "m": message}, separators=(",", ":"))
+        with self._lock:
+            if not self._lines:
+                self._t0 = timestamp
+                self._opened = monotonic()
+            self._lines.append(line)
+            self._t1 = timestamp
+            self.count += 1
+            if (len(self._lines) >= self.chunk_records or
+                    monotonic() - self._opened >= self.chunk_seconds):
+                self._write()
+
+    def flush(self):
+        """Write the current chunk now."""
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if not self._lines:
+            return
+        data = gzip.compress(("\n".join(self._lines) + "\n").encode("utf-8"))
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        # The index goes second, so it never points past the data
+        with open(self.path + INDEX_SUFFIX, "a") as f:
+            f.write(json.dumps({"offset": offset, "t0": round(self._t0, 3),
+                                "t1": round(self._t1, 3),
+                                "count": len(self._lines)}) + "\n")
+        self._lines = []
+
+    def close(self):
+        self.flush()
+
+
+def read_index(path):
+    """:return: list The index entries of a recording, oldest first"""
+    try:
+        with open(path + INDEX_SUFFIX) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def read_records(path, start=None, end=None, channels=None):
+    """
+    :param start: float Skip records before this epoch time
+    :param end: float Stop at records after this epoch time
+    :param channels: tuple Only these channels (default all)
+    :return: generator of tuple (epoch seconds, channel, message)
+    """
+    offset = 0
+    if start is not None:
+        for entry in read_index(path):
+            if entry["t1"] >= start:
+                offset = entry["offset"]
+                break
+    with open(path, "rb") as raw:
+        raw.seek(offset)
+        with gzip.GzipFile(fileobj=raw) as f:
+            for line in f:
+                record = json.loads(line)
+                timestamp = record["t"]
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    return
+                if channels and record["ch"] not in channels:
+                    continue
+                yield timestamp, record["ch"], record["m"]
+
+
+def import_node_log(log_path, recorder):
+    """
+    Convert a Node message log (messages-*.log, or a rotated .log.N) or
+      spool segment (spool-*.log) into 'raw_channel' records, one legacy list
+      message per sighting.
+    :return: int Number of sightings recorded
+    """
+    count = 0
+    with open(log_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if "op" in message:
+                if message["op"] != "put":
+                    continue  # A spool ack
+                message = message["m"]
+            node_name = message.get("device_uid")
+            raw = (message.get("in_view") or {}).get("raw") or {}
+            sightings = sorted(
+                ((parse_timestamp(s["time"]), bt_addr, s)
+                 for bt_addr, slot in raw.items() for s in slot),
+                key=lambda item: item[0])
+            for timestamp, bt_addr, sighting in sightings:
+                recorder.record('raw_channel',
+                                [bt_addr, sighting["rssi"],
+                                 sighting.get("message"), None,
+                                 sighting["time"], node_name],
+                                timestamp)
+                count += 1
+    recorder.flush()
+    return count
+
+
+class Replayer(object):
+    """
+    Feed a recording to a handler(channel, message), such as
+      BeaconLocator.handle or a transport's publish, at the recorded pace
+      scaled by `speed`, or as fast as possible.
+    """
+
+    def __init__(self, path, speed=1.0, channels=RECORDED_CHANNELS):
+        """
+        :param path: str Recording file
+        :param speed: float Replay this many times faster than recorded;
+          None or 0 for as fast as possible
+        :param channels: tuple Only replay these channels
+        """
+        self.path = path
+        self.speed = speed
+        self.channels = channels
+        self._stopped = threading.Event()
+
+    def replay(self, handler, start=None, end=None):
+        """
+        :param start: float Epoch seconds in the recording to start at
+        :param end: float Epoch seconds in the recording to stop at
+        :return: dict Stats: records replayed, elapsed seconds, and the
+          worst lag behind schedule in seconds
+        """
+        self._stopped.clear()
+        count = 0
+        max_lag = 0.0
+        began = monotonic()
+        first = None
+        for timestamp, channel, message in read_records(
+                self.path, start, end, self.channels):
+            if self._stopped.is_set():
+                break
+            if self.speed:
+                if first is None:
+                    first = timestamp
+                due = began + (timestamp - first) / self.speed
+                wait = due - monotonic()
+                if wait > 0:
+                    sleep(wait)
+                else:
+                    max_lag = max(max_lag, -wait)
+            handler(channel, message)
+            count += 1
+        return {"records": count,
+                "elapsed": monotonic() - began,
+                "max_lag": max_lag}
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    try:
+        from transport import make_transport
+    except ImportError:
+        from app.src.transport import make_transport
+
+    parser = argparse.ArgumentParser(
+        description='Record and replay raw_channel and nodes traffic.'
+    )
+    commands = parser.add_subparsers(dest='command')
+    record = commands.add_parser('record', help='Record live traffic')
+    record.add_argument('path', help='Recording file to append to')
+    record.add_argument(
+        '--channels', nargs='+', default=list(RECORDED_CHANNELS),
+        help='Channels to record, like located for tracing.py '
+             '(default: raw_channel nodes)'
+    )
+    import_log = commands.add_parser(
+        'import', help='Convert a Node message log into a recording')
+    import_log.add_argument(
+        'log', help='Node messages-*.log file or spool/spool-*.log segment')
+    import_log.add_argument('path', help='Recording file to append to')
+    replay = commands.add_parser('replay', help='Replay a recording')
+    replay.add_argument('path', help='Recording file')
+    replay.add_argument(
+        '--speed', default='1',
+        help='Times faster than recorded, or "max" (default: 1)'
+    )
+    replay.add_argument(
+        '--locate', action='store_true',
+        help='Feed a BeaconLocator in this process instead of publishing'
+    )
+    info = commands.add_parser('info', help='Summarize a recording')
+    info.add_argument('path', help='Recording file')
+    for command in (record, replay):
+        command.add_argument(
+            '--transport', default=os.environ.get('TRANSPORT'),
+            help='pubnub (default), or a local broker like tcp://host:port'
+        )
+        command.add_argument('--pub', default=os.environ.get('PUB_KEY'))
+        command.add_argument('--sub', default=os.environ.get('SUB_KEY'))
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        recorder = Recorder(args.path)
+        transport = make_transport(args.transport, args.pub, args.sub)
+        transport.subscribe(args.channels, recorder.record)
+        print("Recording to {} - Ctrl-C to stop".format(args.path))
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+        transport.unsubscribe_all()
+        recorder.close()
+        print("Recorded {} messages".format(recorder.count))
+    elif args.command == 'import':
+        recorder = Recorder(args.path)
+        print("Imported {} sightings".format(
+            import_node_log(args.log, recorder)))
+    elif args.command == 'replay':
+        speed = None if args.speed == 'max' else float(args.speed)
+        if args.locate:
+            try:
+                from locate import BeaconLocator
+            except ImportError:
+                from app.src.locate import BeaconLocator
+            locator = BeaconLocator(None, None, node_map={},
+                                    transport=args.transport or "memory://")
+            handler = locator.handle
+        else:
+            transport = make_transport(args.transport, args.pub, args.sub)
+            handler = transport.publish
+        stats = Replayer(args.path, speed).replay(handler)
+        print(json.dumps(stats))
+    elif args.command == 'info':
+        index = read_index(args.path)
+        print(json.dumps({
+            "chunks": len(index),
+            "records": sum(entry["count"] for entry in index),
+            "start": index[0]["t0"] if index else None,
+            "end": index[-1]["t1"] if index else None,
+            "bytes": os.path.getsize(args.path),
+        }))
+    else:
+        parser.print_help()
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from time import monotonic
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+NODE_SNAPSHOT = os.path.join(FILE_DIR, "..", "..", "nodes.json")
+
+
+def parse_node(message):
+    """
+    :param message: dict A 'nodes' channel message, like
+      {"name": "node_name", "coords": {"x": 3, "y": 3}}
+    :return: tuple (name, (x, y)), or None if the message is malformed
+    """
+    try:
+        return message['name'], (float(message["coords"]["x"]),
+                                 float(message["coords"]["y"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class NodeRegistry(object):
+    """
+    Known scanner nodes and their coordinates.
+
+    Lookups are dict/set based. 'nodes' messages are applied one at a time
+    as they arrive, with no history fetch. Names that turned out to be
+    unknown even after a fetch are remembered for `negative_ttl` seconds, so
+    a misconfigured scanner can't trigger a history fetch per message.
+    If `snapshot_path` is set the registry is saved there on every change
+    and loaded from there on start.
+    """
+
+    def __init__(self, snapshot_path=None, negative_ttl=60.0):
+        """
+        :param snapshot_path: str JSON file to persist the registry to
+        :param negative_ttl: float Seconds to remember an unknown node name
+        """
+        self.snapshot_path = snapshot_path
+        self.negative_ttl = negative_ttl
+        self.coords = {}
+        self._unknown = {}  # name -> monotonic time the entry expires
+        self._lock = threading.Lock()
+        if snapshot_path:
+            self.load()
+
+    def __contains__(self, name):
+        return name in self.coords
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, name):
+        return self.coords[name]
+
+    def update(self, node_map, save=True):
+        """
+        :param node_map: dict { name: (x, y), ... }
+        :param save: bool Write the snapshot if anything changed
+        :return: bool Whether anything changed
+        """
+        changed = False
+        with self._lock:
+            for name, coords in node_map.items():
+                coords = (float(coords[0]), float(coords[1]))
+                self._unknown.pop(name, None)
+                if self.coords.get(name) != coords:
+                    self.coords[name] = coords
+                    changed = True
+        if changed and save:
+            self.save()
+        return changed
+
+    def apply(self, message):
+        """
+        Apply a single 'nodes' channel message.
+        :return: bool Whether anything changed
+        """
+        node = parse_node(message)
+        if node is None:
+            return False
+        return self.update(dict([node]))
+
+    def load_history(self, transport, count=100):
+        """
+        Read the 'nodes' channel history. This blocks on the network.
+        :param transport: Transport To read the history from
+        """
+        self.apply_history(transport.history("nodes", count))
+
+    def apply_history(self, entries):
+        """
+        Apply 'nodes' channel messages all at once, saving at most once.
+        :param entries: list Messages, oldest first
+        """
+        node_map = {}
+        for entry in entries:
+            node = parse_node(entry)
+            if node is not None:
+                node_map[node[0]] = node[1]
+        self.update(node_map)
+
+    def is_unknown(self, name):
+        """:return: bool Whether name was recently looked for and not found"""
+        expires = self._unknown.get(name)
+        if expires is None:
+            return False
+        if monotonic() >= expires:
+            self._unknown.pop(name, None)
+            return False
+        return True
+
+    def mark_unknown(self, name):
+        self._unknown[name] = monotonic() + self.negative_ttl
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as f:
+                node_map = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.update(node_map, save=False)
+        return True
+
+    def save(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            node_map = dict(self.coords)
+        # Write then rename, so a crash can't leave a half-written file
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(node_map, f)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError:
+            pass
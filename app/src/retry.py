@@ -0,0 +1,195 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+from collections import OrderedDict
+from functools import partial
+from time import monotonic
+
+from pubnub.enums import PNStatusCategory
+
+try:
+    from metrics import REGISTRY
+except ImportError:
+    from app.src.metrics import REGISTRY
+
+# Child of the 'scan' logger so records land in scan.log
+logger = logging.getLogger('scan.retry')
+
+# These won't get better by trying again
+PERMANENT_ERRORS = (
+    PNStatusCategory.PNAccessDeniedCategory,
+    PNStatusCategory.PNBadRequestCategory,
+)
+
+
+class RetryQueue(threading.Thread):
+    """
+    Publish messages and retry failed ones with exponential backoff.
+
+    Every message gets an ID that is bound into its publish callback, so
+    results are matched to the right message no matter what order they
+    arrive in. Failed messages wait in a heap keyed by next retry time and
+    are re-sent from this thread, never from the publish callback thread.
+
+    At most `max_pending` messages are held (in flight or waiting). When a
+    new message arrives at the bound, the oldest one is dropped.
+    """
+
+    def __init__(self, send_fn, max_pending=1000, max_attempts=8,
+                 base_delay=1.0, max_delay=60.0, jitter=0.5):
+        """
+        :param send_fn: callable Like send_fn(channel, message, callback),
+          where callback(result, status) is a PubNub-style publish callback
+        :param max_pending: int Max messages in flight or waiting for retry
+        :param max_attempts: int Max publish attempts before giving up
+        :param base_delay: float Delay in seconds before the first retry
+        :param max_delay: float Cap on the delay between retries
+        :param jitter: float Delay is scaled by a random factor of 1 +/- jitter
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.send_fn = send_fn
+        self.max_pending = max(int(max_pending), 1)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = min(max(jitter, 0.0), 1.0)
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._ids = itertools.count()
+        # msg_id -> [channel, message, attempts]; insertion order is age
+        self._pending = OrderedDict()
+        self._heap = []  # (retry_at, msg_id)
+
+        self.counters = {
+            "submitted": 0,
+            "published": 0,
+            "retried": 0,
+            "dropped_overflow": 0,
+            "dropped_attempts": 0,
+            "dropped_rejected": 0,
+        }
+
+    def submit(self, channel, message):
+        """
+        Publish a message, retrying later if needed.
+        :param channel: str Channel name
+        :param message: obj JSON-serializable message
+        :return: int The message ID
+        """
+        with self._cond:
+            while len(self._pending) >= self.max_pending:
+                dropped_id, _ = self._pending.popitem(last=False)
+                self.counters["dropped_overflow"] += 1
+                logger.warning("Retry queue full; dropped message {}"
+                               .format(dropped_id))
+            msg_id = next(self._ids)
+            self._pending[msg_id] = [channel, message, 1]
+            self.counters["submitted"] += 1
+        self._send(msg_id, channel, message)
+        return msg_id
+
+    def _send(self, msg_id, channel, message):
+        try:
+            self.send_fn(channel, message,
+                         partial(self._callback, msg_id, monotonic()))
+        except Exception:
+            logger.exception("Publish of message {} raised".format(msg_id))
+            with self._cond:
+                self._schedule(msg_id)
+
+    def _callback(self, msg_id, sent, result, status):
+        REGISTRY.observe("publish_seconds", monotonic() - sent,
+                         {"result": "error" if status.is_error() else "ok"})
+        with self._cond:
+            if msg_id not in self._pending:
+                return  # Dropped while in flight
+            if not status.is_error():
+                del self._pending[msg_id]
+                self.counters["published"] += 1
+            elif status.category in PERMANENT_ERRORS:
+                del self._pending[msg_id]
+                self.counters["dropped_rejected"] += 1
+                logger.error("Message {} rejected by PubNub: {}"
+                             .format(msg_id, status.category))
+            else:
+                self._schedule(msg_id)
+
+    def _schedule(self, msg_id):
+        """Put a failed message in the retry heap. Call with lock held."""
+        entry = self._pending.get(msg_id)
+        if entry is None:
+            return
+        attempts = entry[2]
+        if attempts >= self.max_attempts:
+            del self._pending[msg_id]
+            self.counters["dropped_attempts"] += 1
+            logger.warning("Giving up on message {} after {} attempts"
+                           .format(msg_id, attempts))
+            return
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        heapq.heappush(self._heap, (monotonic() + delay, msg_id))
+        self._cond.notify()
+
+    def _next_due(self):
+        """Pop the next due retry, or return the wait time. Lock held."""
+        while self._heap:
+            retry_at, msg_id = self._heap[0]
+            if msg_id not in self._pending:
+                heapq.heappop(self._heap)  # Dropped since it was scheduled
+                continue
+            wait = retry_at - monotonic()
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self._heap)
+            return msg_id, 0
+        return None, None
+
+    def run(self):
+        while True:
+            with self._cond:
+                msg_id, wait = self._next_due()
+                while self._running and msg_id is None:
+                    self._cond.wait(wait)
+                    msg_id, wait = self._next_due()
+                if not self._running:
+                    return
+                entry = self._pending[msg_id]
+                entry[2] += 1
+                channel, message = entry[0], entry[1]
+                self.counters["retried"] += 1
+            self._send(msg_id, channel, message)
+
+    def depth(self):
+        """:return: int Count of messages in flight or waiting for retry"""
+        with self._cond:
+            return len(self._pending)
+
+    def register_metrics(self, prefix):
+        """Export depth and counters as metrics named prefix_..."""
+        REGISTRY.gauge(prefix + "_pending", "Messages in flight or waiting "
+                       "for retry", self.depth)
+        for name in self.counters:
+            REGISTRY.gauge(prefix + "_messages_total", "Messages by outcome",
+                           partial(self.counters.get, name),
+                           labels={"outcome": name}, kind="counter")
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats["pending"] = len(self._pending)
+            stats["waiting"] = sum(1 for _, msg_id in self._heap
+                                   if msg_id in self._pending)
+        return stats
+
+    def stop(self, timeout=2.0):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
@@ -2,19 +2,32 @@
 
 import logging
 import os
-from collections import defaultdict
-from datetime import datetime, timedelta
-from time import sleep
+from datetime import datetime
+from time import time
 
 from beacontools.scanner import Monitor
 from pubnub.enums import PNStatusCategory
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
 
 try:
+    from batching import BatchPublisher
+    from inview import InViewStore
+    from metrics import REGISTRY, timed
+    from packets import encode_packet
+    from retry import RetryQueue
+    from tracing import stamping
+    from transport import is_pubnub, make_transport
     from utility import get_pn_uuid, UTC
+    from wire import WireEncoder
 except ImportError:
+    from app.src.batching import BatchPublisher
+    from app.src.inview import InViewStore
+    from app.src.metrics import REGISTRY, timed
+    from app.src.packets import encode_packet
+    from app.src.retry import RetryQueue
+    from app.src.tracing import stamping
+    from app.src.transport import is_pubnub, make_transport
     from app.src.utility import get_pn_uuid, UTC
+    from app.src.wire import WireEncoder
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(FILE_DIR, "..", "..", "logs")
@@ -27,9 +40,49 @@ logfile.setFormatter(formatter)
 logger.addHandler(logfile)
 
 
+def render_in_view(snapshot, position_at=None):
+    """
+    Turn an InViewStore snapshot into per-sighting dicts for a message.
+    :param snapshot: dict { bt_addr: (rssi_array, ts_array, packet), ... }
+    :param position_at: callable Epoch seconds -> [lat, lon, alt] or None,
+      like CoordinateService.position_at, to give each sighting a "location"
+    :return: dict { bt_addr: [ {"device_id", "rssi", "message", "time"}, ... ] }
+    """
+    rendered = {}
+    for bt_addr, (rssi, ts, packet) in snapshot.items():
+        message = encode_packet(packet)
+        sightings = rendered[bt_addr] = [
+            {"device_id": bt_addr,
+             "rssi": r,
+             "message": message,
+             "time": datetime.fromtimestamp(t, UTC).isoformat()}
+            for r, t in zip(rssi, ts)
+        ]
+        if position_at is not None:
+            for sighting, t in zip(sightings, ts):
+                sighting["location"] = position_at(t)
+    return rendered
+
+
+def register_in_view_metrics(in_view):
+    REGISTRY.gauge("scan_in_view_beacons", "Beacons with undrained sightings",
+                   lambda: len(in_view))
+    REGISTRY.gauge("scan_in_view_dropped_total",
+                   "Sightings refused because max_beacons was hit",
+                   lambda: in_view.dropped, kind="counter")
+
+
+def register_batch_metrics(batcher):
+    REGISTRY.gauge("scan_batch_sightings", "Sightings waiting in the batch",
+                   batcher.pending)
+
+
 class BleMonitor(Monitor):
     def __init__(self, pub_key=None, sub_key=None, publish=False,
-                 node_name=None, node_coords=(0, 0), debug=False):
+                 node_name=None, node_coords=(0, 0), debug=False,
+                 batch_window=1.0, batch_size=500, in_view_capacity=64,
+                 in_view_max_beacons=2048, transport=None,
+                 wire_format="compact", trace_rate=0.0):
         if not debug:
             logger.setLevel(logging.INFO)
             logfile.setLevel(logging.INFO)
@@ -46,29 +99,39 @@ class BleMonitor(Monitor):
         self.msg_alarm = 0
 
         # For tracking beacons in view of scanner over time
-        self.in_view = []
+        self.in_view = InViewStore(capacity=in_view_capacity,
+                                   max_beacons=in_view_max_beacons)
+        register_in_view_metrics(self.in_view)
 
         if self.publish:
-            logger.info("Beginning PubNub setup...")
-            if not pub_key or not sub_key or not node_name:
+            logger.info("Beginning transport setup...")
+            if is_pubnub(transport) and (not pub_key or not sub_key or
+                                      not node_name):
                 logger.warning("Missing required PubNub keys!")
                 logger.warning("Setting up service for demo only...")
                 pub_key = "demo"
                 sub_key = "demo"
                 self.node_name = "demo"
-            pnconfig = PNConfiguration()
-            pnconfig.subscribe_key = sub_key
-            pnconfig.publish_key = pub_key
-            pnconfig.uuid = get_pn_uuid()
-            pnconfig.ssl = False
-
-            self.pubnub = PubNub(pnconfig)
-            logger.info("PubNub setup complete.")
+            self.transport = make_transport(transport, pub_key, sub_key,
+                                            uuid=get_pn_uuid())
+            self.encoder = WireEncoder(wire_format)
+            self.send = stamping(
+                self.encoder.tracking(self.transport.publish))
+            self.batcher = BatchPublisher(self._publish_batch, self.node_name,
+                                          window=batch_window,
+                                          max_sightings=batch_size,
+                                          trace_rate=trace_rate)
+            self.batcher.start()
+            register_batch_metrics(self.batcher)
+            logger.info("Transport setup complete.")
         else:
-            logger.info("Skipping PubNub setup (publish==False).")
+            logger.info("Skipping transport setup (publish==False).")
 
     @staticmethod
     def _publish_callback(result, status):
+        REGISTRY.inc("scan_publish_total",
+                     labels={"result": status.category.name if
+                             status.is_error() else "ok"})
         # Check whether request successfully completed or not
         if not status.is_error():
             pass  # Message successfully published to specified channel.
@@ -79,159 +142,103 @@ class BleMonitor(Monitor):
         elif status.category == PNStatusCategory.PNTimeoutCategory:
             logger.error("PubNub publish request timed out.")
 
+    def _publish_batch(self, message):
+        self.send('raw_channel', self.encoder.encode(message),
+                  self._publish_callback)
+
+    @timed("scan_on_receive_seconds", "Time in the BLE scan callback")
     def _on_receive(self, bt_addr, rssi, packet, properties):
-        now = datetime.now(UTC)
-
-        # Running log of the last message from each beacon seen since start
-        # of this service.
-        self.in_view.append(
-            {
-                "device_id": bt_addr,
-                "rssi": rssi,
-                "message": "{}".format(packet),
-                "time": now.isoformat(),
-                "status": "unpublished"
-            }
-        )
+        now = time()
+
+        # Sightings since the last retrieve_in_view, capped per beacon
+        self.in_view.append(bt_addr, rssi, now, packet)
 
         if self.publish:
-            # The actual message body
-            message = [bt_addr,
-                       rssi,
-                       "{}".format(packet),
-                       "{}".format(properties),
-                       now.isoformat(),
-                       self.node_name]
-
-            self.pubnub.publish() \
-                .channel('raw_channel') \
-                .message(message) \
-                .should_store(True) \
-                .pn_async(self._publish_callback)
-
-    def retrieve_in_view(self, fetch_status='unpublished',
-                         set_status='retrieved',
-                         reset=False):
-        temp_msgs = defaultdict(list)
-        for msg in self.in_view:
-            if msg['status'] == fetch_status:
-                device_id = msg['device_id']
-                temp_msgs[device_id].append(msg)
-                msg['status'] = set_status
-        if reset:
-            self.reset_in_view()
-        return temp_msgs
-
-    def reset_in_view(self, hard=False, status_to_remove='published',
-                      new_status=None):
-        if hard:
-            self.in_view = []
-        if new_status:
-            for msg in self.in_view:
-                if msg['status'] == status_to_remove:
-                    msg['status'] = new_status
-        else:
-            self.in_view = [msg for msg in self.in_view
-                            if msg['status'] != status_to_remove]
+            # Coalesced into one message per window by the batcher
+            self.batcher.add(bt_addr, rssi, packet, properties, now)
+
+    def retrieve_in_view(self, position_at=None):
+        """
+        Drain the sightings seen since the last call.
+        :param position_at: callable See render_in_view
+        :return: dict { bt_addr: [ sighting_dict, ... ], ... }
+        """
+        return render_in_view(self.in_view.drain(), position_at)
+
+    def reset_in_view(self):
+        self.in_view.clear()
+
+    def terminate(self):
+        if self.publish:
+            self.batcher.stop()
+        Monitor.terminate(self)
 
 
 class ScanService(object):
-    def __init__(self, pub_key, sub_key, publish=True, node_name=None, node_coords=(0, 0)):
+    def __init__(self, pub_key, sub_key, publish=True, node_name=None,
+                 node_coords=(0, 0), batch_window=1.0, batch_size=500,
+                 max_pending=1000, in_view_capacity=64,
+                 in_view_max_beacons=2048, transport=None,
+                 wire_format="compact", recorder=None, trace_rate=0.0):
+        """
+        :param transport: Transport or str Where to publish; see
+          make_transport. PubNub with pub_key and sub_key by default.
+        :param wire_format: str "compact" or "json"; see wire.WireEncoder
+        :param recorder: recording.Recorder Also record everything published
+        :param trace_rate: float Fraction of batches to trace; see tracing.py
+        """
         self.publish = publish
         self.node_name = node_name
         self.node_coords = node_coords
-        self.msg_queue = []
         self.scanner = None
+        self.recorder = recorder
 
-        # For tracking beacons in view of scanner over time
-        self.in_view = []
-
-        pnconfig = PNConfiguration()
-        pnconfig.subscribe_key = sub_key
-        pnconfig.publish_key = pub_key
-        pnconfig.ssl = False
+        # One 'raw_channel' message per window instead of per advertisement
+        self.encoder = WireEncoder(wire_format)
+        self.batcher = BatchPublisher(self._publish_batch, node_name,
+                                      window=batch_window,
+                                      max_sightings=batch_size,
+                                      trace_rate=trace_rate)
 
-        self.pubnub = PubNub(pnconfig)
-
-    def _publish_callback(self, result, status):
-        # Check whether request successfully completed or not
-        if not status.is_error():
-            del self.msg_queue[0]  # Message successfully published to specified channel.
-        elif status.category == PNStatusCategory.PNAccessDeniedCategory:
-            del self.msg_queue[0]
-        elif status.category == PNStatusCategory.PNBadRequestCategory:
-            # Maybe bad keys, or an SDK error
-            del self.msg_queue[0]
-        elif status.category == PNStatusCategory.PNTimeoutCategory:
-            # Republish with exponential backoff
-            msg_tuple = self.msg_queue[0]
-            message = msg_tuple[0]
-            timestamp = msg_tuple[1]
-            retry_time = msg_tuple[2]
+        # For tracking beacons in view of scanner over time
+        self.in_view = InViewStore(capacity=in_view_capacity,
+                                   max_beacons=in_view_max_beacons)
 
-            while datetime.now() > retry_time:
-                sleep(0.5)
+        self.transport = make_transport(transport, pub_key, sub_key)
 
-            del self.msg_queue[0]
+        # Publishes batches and retries failures off the callback thread
+        self.retry = RetryQueue(
+            stamping(self.encoder.tracking(self.transport.publish)),
+            max_pending=max_pending)
 
-            now = datetime.now()
-            retry_time = now + timedelta(seconds=(now - timestamp).total_seconds())
-            self.msg_queue.append((message, timestamp, retry_time))
+        register_in_view_metrics(self.in_view)
+        register_batch_metrics(self.batcher)
+        self.retry.register_metrics("scan_retry")
 
-            self.pubnub.publish() \
-                .channel('raw_channel') \
-                .message(message) \
-                .pn_async(self._publish_callback)
+    def _publish_batch(self, message):
+        message = self.encoder.encode(message)
+        if self.recorder:
+            self.recorder.record('raw_channel', message)
+        self.retry.submit('raw_channel', message)
 
+    @timed("scan_on_receive_seconds", "Time in the BLE scan callback")
     def _on_receive(self, bt_addr, rssi, packet, additional_info):
-        now = datetime.now(UTC)
-
-        # Running log of the last message from each beacon seen since start
-        # of this service.
-        self.in_view.append(
-            {
-                "device_id": bt_addr,
-                "rssi": rssi,
-                "message": "{}".format(packet),
-                "time": now.isoformat(),
-                "status": "unpublished"
-            }
-        )
+        now = time()
+
+        # Sightings since the last retrieve_in_view, capped per beacon
+        self.in_view.append(bt_addr, rssi, now, packet)
 
         if not self.publish:
             pass
         else:
-            # The actual message body
-            message = [bt_addr,
-                       rssi,
-                       "{}".format(packet),
-                       "{}".format(additional_info),
-                       now.isoformat(),
-                       self.node_name]
-            retry_time = now + timedelta(seconds=5)
-            self.msg_queue.append((message, now, retry_time))
-
-            self.pubnub.publish() \
-                .channel('raw_channel') \
-                .message(message) \
-                .should_store(True) \
-                .pn_async(self._publish_callback)
-
-    def retrieve_in_view(self, reset=False):
-        temp_msgs = defaultdict(list)
-        for msg in self.in_view:
-            device_id = msg['device_id']
-            temp_msgs[device_id].append(msg)
-            msg['status'] = "published"
-        if reset:
-            self.reset_in_view()
-        return temp_msgs
-
-    def reset_in_view(self, hard=False):
-        if hard:
-            self.in_view = []
-        else:
-            self.in_view = [msg for msg in self.in_view if msg['status'] == 'unpublished']
+            # Coalesced into one message per window by the batcher
+            self.batcher.add(bt_addr, rssi, packet, additional_info, now)
+
+    def retrieve_in_view(self):
+        return render_in_view(self.in_view.drain())
+
+    def reset_in_view(self):
+        self.in_view.clear()
 
     def scan(self):
         init_message = {"name": self.node_name,
@@ -239,18 +246,24 @@ class ScanService(object):
                             "x": self.node_coords[0],
                             "y": self.node_coords[1]
                         }}
-        self.pubnub.publish() \
-            .channel('nodes') \
-            .message(init_message) \
-            .should_store(True) \
-            .sync()
+        self.transport.publish_sync('nodes', init_message)
+        if self.recorder:
+            self.recorder.record('nodes', init_message)
         # print("{} at coords {}".format(self.node_name, self.node_coords))
+        if self.publish:
+            self.retry.start()
+            self.batcher.start()
         self.scanner = Monitor(self._on_receive, 0, None, None)
         # self.scanner = BeaconScanner(self._on_receive)
         self.scanner.start()
 
     def stop(self):
         self.scanner.terminate()
+        if self.publish:
+            self.batcher.stop()
+            self.retry.stop()
+        if self.recorder:
+            self.recorder.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,323 @@
+import math
+from time import monotonic, sleep, time
+
+import numpy
+
+try:
+    from batching import BATCH_VERSION
+    from calibration import CalibrationTable
+    from wire import WireEncoder
+except ImportError:
+    from app.src.batching import BATCH_VERSION
+    from app.src.calibration import CalibrationTable
+    from app.src.wire import WireEncoder
+
+# Weakest RSSI a scanner still reports, in dBm
+SENSITIVITY = -100.0
+
+
+def node_name(i):
+    return "sim-node-{:03d}".format(i)
+
+
+def beacon_addr(i):
+    return "5e:00:00:{:02x}:{:02x}:{:02x}".format(
+        (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+
+
+def place_nodes(count, width, height):
+    """
+    Spread nodes over the area in a grid, as evenly as the count allows.
+    :return: dict { name: (x, y) }
+    """
+    columns = max(int(math.ceil(math.sqrt(count * width / height))), 1)
+    rows = int(math.ceil(count / float(columns)))
+    nodes = {}
+    for i in range(count):
+        row, column = divmod(i, columns)
+        nodes[node_name(i)] = ((column + 0.5) * width / columns,
+                               (row + 0.5) * height / rows)
+    return nodes
+
+
+class Simulator(object):
+    """
+    Virtual scanners and moving beacons, for load and accuracy testing.
+
+    Beacons follow the random waypoint model: each walks straight to a
+    random point in the area at its own speed, then picks another. RSSI is
+    the log-distance model BeaconLocator inverts, with log-normal
+    shadowing. Each step of `window` seconds gives one BatchPublisher-style
+    'raw_channel' message per node that heard anything, and the true
+    beacon positions for that step.
+    """
+
+    def __init__(self, nodes=50, beacons=5000, width=100.0, height=100.0,
+                 rate=10000, window=1.0, shadowing=4.0, speed=1.0,
+                 calibration=None, wire_format="json", start=None,
+                 seed=None):
+        """
+        :param nodes: int Number of scanner nodes
+        :param beacons: int Number of beacons
+        :param width: float Area width in meters
+        :param height: float Area height in meters
+        :param rate: float Sightings per second across all nodes, before
+          those shadowed below SENSITIVITY are dropped
+        :param window: float Seconds of sightings in each node's message
+        :param shadowing: float Standard deviation of the RSSI noise, in dB
+        :param speed: float Mean beacon walking speed in m/s
+        :param calibration: CalibrationTable Path-loss parameters (default:
+          the locator's defaults)
+        :param wire_format: str "json" or "compact"; see wire.WireEncoder
+        :param start: float Epoch seconds of the first step (default now)
+        :param seed: int Random seed, for repeatable runs
+        """
+        self.rng = numpy.random.default_rng(seed)
+        self.width = width
+        self.height = height
+        self.rate = rate
+        self.window = window
+        self.shadowing = shadowing
+        self.calibration = calibration or CalibrationTable()
+        self.encoders = {}
+        self.wire_format = wire_format
+        self.time = time() if start is None else start
+
+        self.nodes = place_nodes(nodes, width, height)
+        self.node_names = list(self.nodes)
+        self.node_coords = numpy.array([self.nodes[n] for n in
+                                        self.node_names])
+        self.beacon_addrs = [beacon_addr(i) for i in range(beacons)]
+
+        size = numpy.array([width, height])
+        self.positions = self.rng.random((beacons, 2)) * size
+        self.targets = self.rng.random((beacons, 2)) * size
+        self.speeds = self.rng.uniform(0.5, 1.5, beacons) * speed
+
+        # Path-loss parameters per node, broadcast over beacons
+        params = numpy.array([self.calibration.params(n)
+                              for n in self.node_names])
+        self.n = params[None, :, 0]
+        self.measured_rssi = params[None, :, 1]
+        self.sightings = 0
+
+    def node_messages(self):
+        """:return: list 'nodes' messages, as ble_placement.py sends them"""
+        return [{"name": name, "coords": {"x": x, "y": y}}
+                for name, (x, y) in self.nodes.items()]
+
+    def _move(self, dt):
+        heading = self.targets - self.positions
+        remaining = numpy.hypot(heading[:, 0], heading[:, 1])
+        travel = self.speeds * dt
+        arrived = travel >= remaining
+        scale = numpy.where(arrived, 1.0,
+                            travel / numpy.maximum(remaining, 1e-9))
+        self.positions += heading * scale[:, None]
+        if arrived.any():
+            count = int(arrived.sum())
+            self.targets[arrived] = self.rng.random((count, 2)) * \
+                numpy.array([self.width, self.height])
+
+    def step(self):
+        """
+        Simulate one window.
+        :return: tuple (list of 'raw_channel' messages, dict of true
+          positions { bt_addr: (x, y) } mid-window)
+        """
+        start = self.time
+        self._move(self.window / 2.0)
+        truth = self.positions.copy()
+
+        diff = truth[:, None, :] - self.node_coords[None, :, :]
+        distances = numpy.maximum(numpy.hypot(diff[..., 0], diff[..., 1]),
+                                  0.1)
+        mean_rssi = self.measured_rssi - 10 * self.n * numpy.log10(distances)
+        audible = numpy.flatnonzero(mean_rssi > SENSITIVITY)
+
+        messages = []
+        if len(audible):
+            count = self.rng.poisson(self.rate * self.window)
+            picks = numpy.sort(self.rng.choice(audible, count))
+            rssi = numpy.rint(mean_rssi.flat[picks] +
+                              self.rng.normal(0, self.shadowing, count))
+            stamps = numpy.round(start + numpy.sort(
+                self.rng.random(count)) * self.window, 3)
+            beacon_index, node_index = numpy.divmod(picks,
+                                                    len(self.node_names))
+            batches = {}
+            for b, n, r, t in zip(beacon_index.tolist(), node_index.tolist(),
+                                  rssi.tolist(), stamps.tolist()):
+                if r < SENSITIVITY:
+                    continue  # Shadowed out
+                beacons = batches.get(n)
+                if beacons is None:
+                    beacons = batches[n] = {}
+                slot = beacons.get(b)
+                if slot is None:
+                    slot = beacons[b] = {"s": [], "packet": None,
+                                         "properties": None}
+                slot["s"].append([int(r), t])
+                self.sightings += 1
+            for n, beacons in sorted(batches.items()):
+                name = self.node_names[n]
+                batch = {"v": BATCH_VERSION,
+                         "node": name,
+                         "beacons": dict((self.beacon_addrs[b], slot)
+                                         for b, slot in beacons.items())}
+                encoder = self.encoders.get(name)
+                if encoder is None:
+                    encoder = self.encoders[name] = \
+                        WireEncoder(self.wire_format)
+                message = encoder.encode(batch)
+                # Handed straight to the handler, so as good as published
+                encoder.confirm(message)
+                messages.append(message)
+
+        self._move(self.window / 2.0)
+        self.time += self.window
+        return messages, dict(zip(self.beacon_addrs,
+                                  map(tuple, truth.tolist())))
+
+    def run(self, handler, duration, realtime=False, on_step=None):
+        """
+        Send the nodes, then `duration` seconds of sightings, to
+          handler(channel, message).
+        :param realtime: bool Pace steps to the wall clock instead of going
+          as fast as possible
+        :param on_step: callable Called with each step's true positions
+        :return: dict Stats: steps, messages and sightings sent, elapsed
+          seconds
+        """
+        sightings = self.sightings
+        for message in self.node_messages():
+            handler('nodes', message)
+        steps = int(math.ceil(duration / self.window))
+        sent = 0
+        began = monotonic()
+        for i in range(steps):
+            messages, truth = self.step()
+            if on_step:
+                on_step(truth)
+            for message in messages:
+                handler('raw_channel', message)
+            sent += len(messages)
+            if realtime:
+                wait = began + (i + 1) * self.window - monotonic()
+                if wait > 0:
+                    sleep(wait)
+        return {"steps": steps, "messages": sent,
+                "sightings": self.sightings - sightings,
+                "elapsed": monotonic() - began}
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+
+    try:
+        from transport import is_pubnub, make_transport
+    except ImportError:
+        from app.src.transport import is_pubnub, make_transport
+
+    parser = argparse.ArgumentParser(
+        description='Simulate scanner nodes and moving beacons.'
+    )
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--beacons', type=int, default=5000)
+    parser.add_argument('--size', type=float, default=100.0,
+                        help='Side of the square area in meters')
+    parser.add_argument('--rate', type=float, default=10000,
+                        help='Sightings per second across all nodes')
+    parser.add_argument('--window', type=float, default=1.0,
+                        help='Seconds of sightings per node message')
+    parser.add_argument('--shadowing', type=float, default=4.0,
+                        help='RSSI noise standard deviation in dB')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Simulated seconds')
+    parser.add_argument('--wire_format', choices=['json', 'compact'],
+                        default='json')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument(
+        '--realtime', action='store_true',
+        help='Send at the simulated pace instead of as fast as possible'
+    )
+    parser.add_argument(
+        '--locate', action='store_true',
+        help='Feed a BeaconLocator in this process and report accuracy'
+    )
+    parser.add_argument(
+        '--locate_args', default='{}',
+        help='JSON of extra BeaconLocator arguments, like {"tick": 1}'
+    )
+    parser.add_argument(
+        '--truth', help='Write true positions per step to this JSON lines file'
+    )
+    parser.add_argument(
+        '--transport', default=os.environ.get('TRANSPORT'),
+        help='pubnub (default), or a local broker like tcp://host:port'
+    )
+    parser.add_argument('--pub', default=os.environ.get('PUB_KEY'))
+    parser.add_argument('--sub', default=os.environ.get('SUB_KEY'))
+    args = parser.parse_args()
+    if not args.locate and is_pubnub(args.transport) and \
+            not (args.pub and args.sub):
+        parser.error("Send somewhere: --locate, --transport (memory:// to "
+                     "discard), or PUB_KEY and SUB_KEY")
+
+    sim = Simulator(nodes=args.nodes, beacons=args.beacons, width=args.size,
+                    height=args.size, rate=args.rate, window=args.window,
+                    shadowing=args.shadowing, wire_format=args.wire_format,
+                    seed=args.seed)
+
+    latest = {}
+    errors = []
+    truth_file = open(args.truth, "w") if args.truth else None
+
+    def on_step(truth):
+        latest.clear()
+        latest.update(truth)
+        if truth_file:
+            truth_file.write(json.dumps({"t": sim.time, "truth": truth}) +
+                             "\n")
+
+    if args.locate:
+        try:
+            from locate import BeaconLocator
+        except ImportError:
+            from app.src.locate import BeaconLocator
+
+        def on_located(channel, message):
+            truth = latest.get(message[0])
+            if truth is not None:
+                errors.append(math.hypot(message[2][0] - truth[0],
+                                         message[2][1] - truth[1]))
+
+        transport = make_transport("memory://simulate")
+        transport.subscribe(['located'], on_located)
+        locator = BeaconLocator(None, None, node_map={},
+                                transport="memory://simulate",
+                                **json.loads(args.locate_args))
+        locator.start()
+        handler = locator.handle
+    else:
+        handler = make_transport(args.transport, args.pub, args.sub).publish
+
+    stats = sim.run(handler, args.duration, realtime=args.realtime,
+                    on_step=on_step)
+    if args.locate:
+        locator.stop()
+        if locator.tick:
+            locator._locate_dirty()
+    if truth_file:
+        truth_file.close()
+    stats["sightings_per_second"] = stats["sightings"] / \
+        max(stats["elapsed"], 1e-9)
+    if errors:
+        errors.sort()
+        stats.update(located=len(errors),
+                     error_mean=sum(errors) / len(errors),
+                     error_p50=errors[len(errors) // 2],
+                     error_p90=errors[int(len(errors) * 0.9)])
+    print(json.dumps(stats, indent=2))
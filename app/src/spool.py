@@ -0,0 +1,493 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from time import monotonic, sleep
+
+try:
+    from metrics import REGISTRY
+    from retry import PERMANENT_ERRORS
+except ImportError:
+    from app.src.metrics import REGISTRY
+    from app.src.retry import PERMANENT_ERRORS
+
+# Child of the 'node' logger so records land in node.log
+logger = logging.getLogger('node.spool')
+
+# A spool is a directory of segments, spool-00000001.log, ..., each holding
+#   JSON lines of
+#     {"op": "put", "id": message_uid, "ch": channel, "m": message}
+#     {"op": "ack", "id": message_uid}
+# Only the newest segment is written to, and only by appending. The oldest
+#   segment is deleted once every message put in it has been acked. Acks
+#   for a segment can be in any newer one, which is why segments are only
+#   ever deleted oldest first.
+SEGMENT_NAME = "spool-{:08d}.log"
+
+
+def _segment_seq(name):
+    """:return: int The sequence number of a segment file name, or None"""
+    if not (name.startswith("spool-") and name.endswith(".log")):
+        return None
+    try:
+        return int(name[len("spool-"):-len(".log")])
+    except ValueError:
+        return None
+
+
+class Spool(object):
+    """
+    Durable store of messages that haven't been acknowledged yet.
+
+    Writes are buffered in memory until `buffer_bytes` pile up or flush()
+    is called, and only hit the disk for certain on flush(sync=True), so a
+    crash loses at most what was written since the last flush. A torn line
+    at the end of a segment is skipped on recovery.
+    """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 max_bytes=256 * 1024 * 1024, buffer_bytes=64 * 1024):
+        """
+        :param directory: str Where the segments go; created if needed
+        :param segment_bytes: int Start a new segment past this size
+        :param max_bytes: int Drop the oldest segment, acked or not, when
+          the spool grows past this size
+        :param buffer_bytes: int Write the buffer out past this size
+        """
+        self.directory = directory
+        self.segment_bytes = max(int(segment_bytes), 1)
+        self.max_bytes = max_bytes
+        self.buffer_bytes = buffer_bytes
+
+        self._lock = threading.Lock()
+        # msg_id -> (segment seq, offset, length); insertion order is age
+        self._index = OrderedDict()
+        self._unacked = {}  # seq -> unacked messages put in that segment
+        self._sizes = OrderedDict()  # seq -> bytes, oldest first
+        self._total = 0
+        self._buffer = []
+        self._buffered = 0
+        self._unsynced = False
+        self._file = None
+        self.seq = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        # Never append to a segment that may end in a torn line
+        self._open(self.seq + 1)
+        self._trim()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, SEGMENT_NAME.format(seq))
+
+    def _recover(self):
+        segments = sorted(seq for seq in map(_segment_seq,
+                                              os.listdir(self.directory))
+                          if seq is not None)
+        for seq in segments:
+            self._unacked[seq] = 0
+            offset = 0
+            with open(self._path(seq), "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None  # Torn write from a crash
+                    if isinstance(record, dict):
+                        if record.get("op") == "put":
+                            self._index_put(record["id"], seq, offset,
+                                            len(line))
+                        elif record.get("op") == "ack":
+                            self._index_ack(record["id"])
+                    offset += len(line)
+            self._sizes[seq] = offset
+            self._total += offset
+            self.seq = seq
+        if self._index:
+            logger.info("Spool has {} unacknowledged messages".format(
+                len(self._index)))
+
+    def _index_put(self, msg_id, seq, offset, length):
+        if msg_id in self._index:
+            self._index_ack(msg_id)  # Spooled again; the newest copy wins
+        self._index[msg_id] = (seq, offset, length)
+        self._unacked[seq] += 1
+
+    def _index_ack(self, msg_id):
+        entry = self._index.pop(msg_id, None)
+        if entry is None:
+            return False
+        self._unacked[entry[0]] -= 1
+        return True
+
+    def _open(self, seq):
+        self.seq = seq
+        self._file = open(self._path(seq), "ab")
+        self._sizes[seq] = 0
+        self._unacked[seq] = 0
+
+    def _append(self, record):
+        """
+        Buffer a record in the current segment. Call with lock held.
+        :return: tuple (seq, offset, length) of the record
+        """
+        line = (json.dumps(record, separators=(",", ":")) + "\n") \
+            .encode("utf-8")
+        if self._sizes[self.seq] and \
+                self._sizes[self.seq] + len(line) > self.segment_bytes:
+            self._rotate()
+        seq = self.seq
+        offset = self._sizes[seq]
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self._sizes[seq] += len(line)
+        self._total += len(line)
+        if self._buffered >= self.buffer_bytes:
+            self._write()
+        return seq, offset, len(line)
+
+    def _write(self):
+        """Write the buffer to the current segment. Call with lock held."""
+        if not self._buffer:
+            return
+        self._file.write(b"".join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+        self._buffered = 0
+        self._unsynced = True
+
+    def _sync(self):
+        self._write()
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._open(self.seq + 1)
+        self._trim()
+
+    def _trim(self):
+        """Delete old segments that are all acked, or over max_bytes."""
+        while len(self._sizes) > 1:
+            oldest = next(iter(self._sizes))
+            if self._unacked[oldest] > 0:
+                if self._total <= self.max_bytes:
+                    break
+                dropped = 0
+                while self._index:
+                    msg_id, entry = next(iter(self._index.items()))
+                    if entry[0] != oldest:
+                        break
+                    self._index_ack(msg_id)
+                    dropped += 1
+                self.dropped += dropped
+                logger.warning("Spool over {} bytes; dropped {} unsent "
+                               "messages".format(self.max_bytes, dropped))
+            os.remove(self._path(oldest))
+            self._total -= self._sizes.pop(oldest)
+            del self._unacked[oldest]
+
+    def put(self, msg_id, channel, message):
+        """
+        :param msg_id: str Unique message ID, like the message_uid
+        :param channel: str Channel to publish the message on
+        :param message: obj JSON-serializable message
+        """
+        with self._lock:
+            seq, offset, length = self._append(
+                {"op": "put", "id": msg_id, "ch": channel, "m": message})
+            self._index_put(msg_id, seq, offset, length)
+            if self._total > self.max_bytes:
+                self._trim()
+
+    def ack(self, msg_id):
+        """
+        Mark a message delivered, so it won't be replayed.
+        :return: bool Whether the message was waiting
+        """
+        with self._lock:
+            if not self._index_ack(msg_id):
+                return False
+            self._append({"op": "ack", "id": msg_id})
+            self._trim()
+            return True
+
+    def pending(self, count, skip=()):
+        """
+        :param count: int Max messages to return
+        :param skip: set IDs to leave out, like those in flight
+        :return: list of tuple (msg_id, channel, message), oldest first
+        """
+        with self._lock:
+            entries = []
+            for msg_id, entry in self._index.items():
+                if len(entries) >= count:
+                    break
+                if msg_id not in skip:
+                    entries.append(entry)
+            if entries and entries[-1][0] == self.seq:
+                self._write()  # Some are still in the buffer
+            messages = []
+            files = {}
+            try:
+                for seq, offset, length in entries:
+                    f = files.get(seq)
+                    if f is None:
+                        f = files[seq] = open(self._path(seq), "rb")
+                    f.seek(offset)
+                    record = json.loads(f.read(length))
+                    messages.append((record["id"], record["ch"],
+                                     record["m"]))
+            finally:
+                for f in files.values():
+                    f.close()
+        return messages
+
+    def flush(self, sync=False):
+        """Write buffered records out, and fsync them if sync is set."""
+        with self._lock:
+            if sync:
+                self._sync()
+            else:
+                self._write()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def size(self):
+        """:return: int Bytes on disk, and buffered for it"""
+        return self._total
+
+
+class SpoolForwarder(threading.Thread):
+    """
+    Publish messages through a Spool, so none are lost out of coverage.
+
+    Every message is spooled first, then published, and acked in the spool
+    when the publish succeeds. After a failed publish the node is taken to
+    be offline: new messages are only spooled, and a single message is
+    retried as a probe after an exponentially growing delay. Once a publish
+    succeeds again, the backlog is read back in batches of `batch_size` and
+    replayed oldest first, at most `rate` messages per second and at most
+    `batch_size` in flight at a time.
+
+    This thread also writes out the spool's buffer every `flush_interval`
+    seconds and fsyncs it every `fsync_interval` seconds.
+    """
+
+    def __init__(self, spool, transport, callback=None, batch_size=50,
+                 rate=20.0, flush_interval=1.0, fsync_interval=5.0,
+                 retry_interval=5.0, max_retry_interval=300.0,
+                 in_flight_timeout=60.0):
+        """
+        :param spool: Spool Where messages wait until acknowledged
+        :param transport: Transport To publish with, or None to only spool
+        :param callback: callable Also called with every publish result,
+          like callback(result, status)
+        :param batch_size: int Messages read and in flight at a time
+        :param rate: float Max replayed messages per second
+        :param flush_interval: float Seconds between buffer writes
+        :param fsync_interval: float Seconds between fsyncs
+        :param retry_interval: float First delay before probing after a
+          failure; doubles up to max_retry_interval
+        :param in_flight_timeout: float Seconds to wait for a publish result
+          before the message may be replayed
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.spool = spool
+        self.transport = transport
+        self.callback = callback
+        self.batch_size = max(int(batch_size), 1)
+        self.rate = rate
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.in_flight_timeout = in_flight_timeout
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._in_flight = {}  # msg_id -> monotonic time sent
+        self.online = True
+        self._backoff = retry_interval
+        self._probe_at = 0.0
+
+        self.counters = {"sent": 0, "replayed": 0, "acked": 0,
+                         "failed": 0, "rejected": 0}
+
+    def send(self, msg_id, channel, message):
+        """Spool a message, and publish it now if online."""
+        self.spool.put(msg_id, channel, message)
+        if self.transport is not None and self.online:
+            self.counters["sent"] += 1
+            self._publish(msg_id, channel, message)
+
+    def _publish(self, msg_id, channel, message):
+        with self._cond:
+            self._in_flight[msg_id] = monotonic()
+        try:
+            self.transport.publish(channel, message,
+                                   partial(self._callback, msg_id),
+                                   meta={"msg_id": msg_id})
+        except Exception:
+            logger.exception("Publish of message {} raised".format(msg_id))
+            with self._cond:
+                self._in_flight.pop(msg_id, None)
+                self._went_offline()
+
+    def _callback(self, msg_id, result, status):
+        with self._cond:
+            self._in_flight.pop(msg_id, None)
+            if not status.is_error():
+                self.spool.ack(msg_id)
+                self.counters["acked"] += 1
+                if not self.online:
+                    logger.info("Back online; replaying {} spooled messages"
+                                .format(len(self.spool)))
+                    self.online = True
+                    self._backoff = self.retry_interval
+                    self._cond.notify()
+            elif status.category in PERMANENT_ERRORS:
+                # Replaying would only be rejected again
+                self.spool.ack(msg_id)
+                self.counters["rejected"] += 1
+                logger.error("Message {} rejected by PubNub: {}"
+                             .format(msg_id, status.category))
+            else:
+                self.counters["failed"] += 1
+                self._went_offline()
+        if self.callback:
+            self.callback(result, status)
+
+    def _went_offline(self):
+        """Call with lock held."""
+        if self.online:
+            logger.warning("Publish failed; spooling until back online")
+            self.online = False
+        self._probe_at = monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.max_retry_interval)
+
+    def _replay(self):
+        """Send the next messages from the backlog, if it's time to."""
+        with self._cond:
+            now = monotonic()
+            for msg_id, sent in list(self._in_flight.items()):
+                if now - sent > self.in_flight_timeout:
+                    del self._in_flight[msg_id]  # Lost; replay it
+            if self.online:
+                room = self.batch_size - len(self._in_flight)
+            elif now >= self._probe_at:
+                room = 1 if not self._in_flight else 0
+                self._probe_at = now + self._backoff
+            else:
+                room = 0
+            if room <= 0 or len(self.spool) <= len(self._in_flight):
+                return
+            skip = set(self._in_flight)
+        for msg_id, channel, message in self.spool.pending(room, skip):
+            if not self._running or (self._in_flight and not self.online):
+                break
+            self.counters["replayed"] += 1
+            self._publish(msg_id, channel, message)
+            if self.rate:
+                sleep(1.0 / self.rate)
+
+    def run(self):
+        synced = monotonic()
+        while True:
+            with self._cond:
+                if self._running:
+                    self._cond.wait(self.flush_interval)
+                running = self._running
+            now = monotonic()
+            sync = now - synced >= self.fsync_interval or not running
+            try:
+                self.spool.flush(sync=sync)
+                if sync:
+                    synced = now
+                if running and self.transport is not None:
+                    self._replay()
+            except Exception:
+                logger.exception("Spool forwarding failed")
+            if not running:
+                return
+
+    def register_metrics(self, prefix):
+        """Export spool depth and counters as metrics named prefix_..."""
+        REGISTRY.gauge(prefix + "_messages", "Unacknowledged messages",
+                       self.spool.__len__)
+        REGISTRY.gauge(prefix + "_bytes", "Spool size on disk",
+                       self.spool.size)
+        REGISTRY.gauge(prefix + "_online", "Whether publishing works",
+                       lambda: int(self.online))
+        REGISTRY.gauge(prefix + "_dropped_total", "Messages dropped over "
+                       "the size limit", lambda: self.spool.dropped,
+                       kind="counter")
+        for name in self.counters:
+            REGISTRY.gauge(prefix + "_publish_total", "Publishes by outcome",
+                           partial(self.counters.get, name),
+                           labels={"outcome": name}, kind="counter")
+
+    def stop(self, timeout=2.0):
+        """Stop forwarding and close the spool, synced to disk."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
+        self.spool.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    try:
+        from transport import make_transport
+    except ImportError:
+        from app.src.transport import make_transport
+
+    parser = argparse.ArgumentParser(
+        description='Inspect or replay a Node spool directory.'
+    )
+    parser.add_argument('directory', help='Spool directory')
+    parser.add_argument(
+        '--drain', action='store_true',
+        help='Publish every unacknowledged message, then exit'
+    )
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='Max messages per second when draining')
+    parser.add_argument(
+        '--transport', default=os.environ.get('TRANSPORT'),
+        help='pubnub (default), or a local broker like tcp://host:port'
+    )
+    parser.add_argument('--pub', default=os.environ.get('PUB_KEY'))
+    parser.add_argument('--sub', default=os.environ.get('SUB_KEY'))
+    args = parser.parse_args()
+
+    spool = Spool(args.directory)
+    print(json.dumps({"messages": len(spool), "bytes": spool.size(),
+                      "segments": len(spool._sizes)}))
+    if args.drain:
+        forwarder = SpoolForwarder(
+            spool, make_transport(args.transport, args.pub, args.sub),
+            rate=args.rate, flush_interval=0.1)
+        forwarder.start()
+        try:
+            while len(spool) and forwarder.online:
+                sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        forwarder.stop()
+        print(json.dumps(dict(forwarder.counters, left=len(spool))))
@@ -0,0 +1,250 @@
+import math
+from time import time
+
+try:
+    from metrics import Histogram
+except ImportError:
+    from app.src.metrics import Histogram
+
+# A trace rides along with a sighting from the scanner to the dashboard as a
+#   dict of epoch seconds, one per stage it has passed:
+#     rx      the scanner saw the advertisement (the sighting's timestamp)
+#     tx      the scanner published the batch holding it
+#     ingest  the locator received the batch
+#     solve   the locator had a position for the beacon
+#     out     the locator published the 'ranged' or 'located' message
+#     seen    a subscriber, like the aggregation tool below, received it
+# Tracing is opt-in and sampled: a scanner with a trace_rate (see
+#   BatchPublisher) gives that fraction of its batches a message["trace"],
+#   stamped with tx each time it's sent. Only those carry traces onward,
+#   so untraced traffic stays the size it was. 'ranged' messages carry the
+#   trace as a sixth element and 'located' messages as meta["trace"].
+#
+# rx and tx come from the scanner's clock, ingest to out from the locator's
+#   and seen from the subscriber's, so hops between machines include their
+#   clock offset. Keep them NTP-synced, and mind negative hop counts.
+TRACE_KEY = "trace"
+STAGES = ("rx", "tx", "ingest", "solve", "out", "seen")
+
+# Quantiles reported per hop
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def stamp(trace, stage, when=None):
+    """
+    :param trace: dict A trace, or None if the message isn't traced
+    :param stage: str One of STAGES
+    :param when: float Epoch seconds (default now)
+    :return: dict A copy of trace with the stage stamped, or None
+    """
+    if trace is None:
+        return None
+    trace = dict(trace)
+    trace[stage] = time() if when is None else when
+    return trace
+
+
+def stamping(send_fn):
+    """
+    :param send_fn: callable Like send_fn(channel, message, callback)
+    :return: callable send_fn, stamping tx on traced messages as they're
+      sent, so retries count towards rx>tx rather than tx>ingest
+    """
+    def send(channel, message, callback=None):
+        if isinstance(message, dict) and TRACE_KEY in message:
+            # A copy, so every attempt has its own; rounded like sighting
+            #   times, so never earlier than them
+            message = dict(message, **{TRACE_KEY: dict(
+                message[TRACE_KEY], tx=round(time(), 3))})
+        return send_fn(channel, message, callback)
+    return send
+
+
+def ingest_trace(message, when=None):
+    """
+    Start the locator's part of a batch message's trace. A message routed
+      by a ShardedLocator keeps the router's ingest time.
+    :param message: dict A batch message
+    :return: dict The trace, with at least an ingest time, or None if the
+      message isn't traced
+    """
+    if TRACE_KEY not in message:
+        return None
+    trace = dict(message[TRACE_KEY] or ())
+    if "ingest" not in trace:
+        trace["ingest"] = time() if when is None else when
+    return trace
+
+
+def message_trace(channel, message):
+    """:return: dict The trace in a 'ranged' or 'located' message, or None"""
+    try:
+        if channel == 'located':
+            return message[3].get(TRACE_KEY)
+        if channel == 'ranged' and len(message) > 5:
+            return message[5]
+    except (AttributeError, IndexError, KeyError, TypeError):
+        pass
+    return None
+
+
+def hops(trace):
+    """
+    :return: list of tuple (hop name, seconds) between each pair of
+      consecutive stages in the trace, then "total" from first to last
+    """
+    present = [(stage, trace[stage]) for stage in STAGES
+               if trace.get(stage) is not None]
+    result = [("{}>{}".format(a, b), t_b - t_a)
+              for (a, t_a), (b, t_b) in zip(present, present[1:])]
+    if len(present) > 2:
+        result.append(("total", present[-1][1] - present[0][1]))
+    return result
+
+
+class TraceStats(object):
+    """
+    Per-channel, per-hop latency distributions of traced messages, kept in
+      log-linear histograms so long runs use constant memory.
+    """
+
+    def __init__(self):
+        # { channel: { hop: [Histogram, negative count, max] } }
+        self.channels = {}
+        self.untraced = 0
+
+    def add(self, channel, trace, seen=None):
+        """
+        :param trace: dict A message's trace, or None to count it untraced
+        :param seen: float Epoch seconds the message arrived, if known
+        """
+        if not trace:
+            self.untraced += 1
+            return
+        if seen is not None:
+            trace = stamp(trace, "seen", seen)
+        channel_hops = self.channels.setdefault(channel, {})
+        for hop, seconds in hops(trace):
+            entry = channel_hops.get(hop)
+            if entry is None:
+                entry = channel_hops[hop] = [Histogram(), 0, -math.inf]
+            if seconds < 0:
+                entry[1] += 1  # Clock skew; counted, not binned
+                continue
+            entry[0].observe(seconds)
+            entry[2] = max(entry[2], seconds)
+
+    def handle(self, channel, message):
+        """Subscribe handler: add a message's trace, seen now."""
+        self.add(channel, message_trace(channel, message), time())
+
+    def report(self):
+        """
+        :return: dict { channel: { hop: { "count", "negative", "mean",
+          "p50", "p90", "p99", "max" } } }, times in milliseconds
+        """
+        report = {}
+        for channel, channel_hops in sorted(self.channels.items()):
+            rows = report[channel] = {}
+            for hop, (histogram, negative, worst) in channel_hops.items():
+                row = rows[hop] = {"count": histogram.count,
+                                   "negative": negative}
+                if histogram.count:
+                    row["mean"] = histogram.total / histogram.count * 1e3
+                    for q in QUANTILES:
+                        # Bucket bounds can overshoot the largest value
+                        row["p{:g}".format(q * 100)] = \
+                            min(histogram.percentile(q), worst) * 1e3
+                    row["max"] = worst * 1e3
+        return report
+
+
+def format_report(report):
+    """:return: str The report as a table, hops in stage order"""
+    columns = ["mean"] + ["p{:g}".format(q * 100) for q in QUANTILES] + \
+        ["max"]
+    lines = []
+    for channel, rows in report.items():
+        lines.append("{:16} {:>8} {:>6}".format(channel, "count", "neg") +
+                     "".join("{:>10}".format(c + " ms") for c in columns))
+        for hop, row in sorted(rows.items(), key=lambda item: _order(item[0])):
+            lines.append("  {:14} {:8d} {:6d}".format(
+                hop, row["count"], row["negative"]) +
+                "".join("{:10.2f}".format(row[c]) if c in row
+                        else "{:>10}".format("-") for c in columns))
+    return "\n".join(lines)
+
+
+def _order(hop):
+    if hop == "total":
+        return (len(STAGES), 0)
+    start, end = hop.split(">")
+    return (STAGES.index(start), STAGES.index(end))
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    from time import sleep
+
+    try:
+        from recording import read_records
+        from transport import make_transport
+    except ImportError:
+        from app.src.recording import read_records
+        from app.src.transport import make_transport
+
+    parser = argparse.ArgumentParser(
+        description='Aggregate trace contexts of ranged and located '
+                    'messages into per-hop latency distributions.'
+    )
+    parser.add_argument(
+        '--recording',
+        help='Read a recording (see recording.py) instead of subscribing'
+    )
+    parser.add_argument(
+        '--channels', nargs='+', default=['located'],
+        choices=['located', 'ranged'], help='Channels to aggregate'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=None,
+        help='Seconds to listen for (default: until Ctrl-C)'
+    )
+    parser.add_argument('--out', help='Also write the report to this JSON file')
+    parser.add_argument(
+        '--transport', default=os.environ.get('TRANSPORT'),
+        help='pubnub (default), or a local broker like tcp://host:port'
+    )
+    parser.add_argument('--pub', default=os.environ.get('PUB_KEY'))
+    parser.add_argument('--sub', default=os.environ.get('SUB_KEY'))
+    args = parser.parse_args()
+
+    stats = TraceStats()
+    if args.recording:
+        # Recorded messages were seen when they were recorded
+        for seen, channel, message in read_records(
+                args.recording, channels=tuple(args.channels)):
+            stats.add(channel, message_trace(channel, message), seen)
+    else:
+        transport = make_transport(args.transport, args.pub, args.sub)
+        transport.subscribe(args.channels, stats.handle)
+        print("Listening on {} - Ctrl-C to stop".format(
+            ", ".join(args.channels)))
+        try:
+            if args.duration:
+                sleep(args.duration)
+            else:
+                while True:
+                    sleep(1)
+        except KeyboardInterrupt:
+            pass
+        transport.unsubscribe_all()
+
+    report = stats.report()
+    print(format_report(report))
+    if stats.untraced:
+        print("{} messages had no trace".format(stats.untraced))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,308 @@
+import math
+
+import numpy
+
+KALMAN = "kalman"
+PARTICLE = "particle"
+FILTERS = (KALMAN, PARTICLE)
+
+
+class KalmanTrack(object):
+    """
+    Constant-velocity extended Kalman filter for one beacon.
+
+    State is (x, y, vx, vy). Each range from a node is applied on its own as
+    a scalar measurement, so an update is a handful of float operations and
+    no matrix inverse. Kept in plain floats since 4x4 numpy arrays cost more
+    in call overhead than they save.
+    """
+    __slots__ = ("state", "cov", "time")
+
+    def __init__(self, timestamp, coords, variance, velocity_variance):
+        """
+        :param timestamp: float Epoch seconds of the starting fix
+        :param coords: tuple Starting (x, y)
+        :param variance: float Starting position variance in m^2
+        :param velocity_variance: float Starting velocity variance
+        """
+        self.state = [float(coords[0]), float(coords[1]), 0.0, 0.0]
+        self.cov = [[variance, 0.0, 0.0, 0.0],
+                    [0.0, variance, 0.0, 0.0],
+                    [0.0, 0.0, velocity_variance, 0.0],
+                    [0.0, 0.0, 0.0, velocity_variance]]
+        self.time = timestamp
+
+    def predict(self, timestamp, accel_noise):
+        """
+        Move the state forward to timestamp. Out of order messages (from
+          batches of different nodes) don't move it backward.
+        :param accel_noise: float Process noise, in (m/s^2)^2 per second
+        """
+        dt = timestamp - self.time
+        if dt <= 0:
+            return
+        self.time = timestamp
+        s = self.state
+        s[0] += dt * s[2]
+        s[1] += dt * s[3]
+
+        # cov = F cov F' + Q, with F = [[I, dt I], [0, I]]
+        p = self.cov
+        a = [[p[i][j] + dt * p[i + 2][j] for j in range(4)] if i < 2
+             else list(p[i]) for i in range(4)]
+        for row in a:
+            row[0] += dt * row[2]
+            row[1] += dt * row[3]
+        q3 = accel_noise * dt ** 3 / 3.0
+        q2 = accel_noise * dt ** 2 / 2.0
+        q1 = accel_noise * dt
+        a[0][0] += q3
+        a[1][1] += q3
+        a[0][2] += q2
+        a[2][0] += q2
+        a[1][3] += q2
+        a[3][1] += q2
+        a[2][2] += q1
+        a[3][3] += q1
+        self.cov = a
+
+    def correct(self, node, distance, variance, gate):
+        """
+        Apply one range measurement.
+        :param node: tuple (x, y) of the node that measured it
+        :param distance: float Measured range
+        :param variance: float Variance of the measured range
+        :param gate: float Reject measurements this many squared standard
+          deviations from the prediction
+        :return: bool Whether the measurement was used
+        """
+        s = self.state
+        p = self.cov
+        dx = s[0] - node[0]
+        dy = s[1] - node[1]
+        predicted = math.hypot(dx, dy)
+        if predicted < 1e-6:
+            return False  # Direction to the node is undefined
+        hx = dx / predicted
+        hy = dy / predicted
+
+        pht = [p[i][0] * hx + p[i][1] * hy for i in range(4)]
+        innovation_var = hx * pht[0] + hy * pht[1] + variance
+        innovation = distance - predicted
+        if innovation * innovation > gate * innovation_var:
+            return False
+
+        gain = [v / innovation_var for v in pht]
+        for i in range(4):
+            s[i] += gain[i] * innovation
+            row = p[i]
+            for j in range(4):
+                row[j] -= gain[i] * pht[j]
+        return True
+
+    def position(self):
+        return self.state[0], self.state[1]
+
+    def velocity(self):
+        return self.state[2], self.state[3]
+
+    def position_cov(self):
+        p = self.cov
+        xy = 0.5 * (p[0][1] + p[1][0])
+        return [[p[0][0], xy], [xy, p[1][1]]]
+
+
+class ParticleTrack(object):
+    """
+    Constant-velocity particle filter for one beacon, vectorized over its
+    particles. Slower than KalmanTrack but copes with multimodal positions,
+    like a beacon only two nodes can hear.
+    """
+    __slots__ = ("particles", "weights", "time", "rng")
+
+    def __init__(self, timestamp, coords, variance, velocity_variance,
+                 count=500, rng=None):
+        """
+        :param count: int Number of particles
+        :param rng: numpy.random.Generator Random source
+        """
+        self.rng = rng if rng is not None else numpy.random.default_rng()
+        self.particles = numpy.empty((count, 4))
+        self.particles[:, :2] = self.rng.normal(
+            coords, math.sqrt(variance), size=(count, 2))
+        self.particles[:, 2:] = self.rng.normal(
+            0.0, math.sqrt(velocity_variance), size=(count, 2))
+        self.weights = numpy.full(count, 1.0 / count)
+        self.time = timestamp
+
+    def predict(self, timestamp, accel_noise):
+        dt = timestamp - self.time
+        if dt <= 0:
+            return
+        self.time = timestamp
+        accel = self.rng.normal(0.0, math.sqrt(accel_noise / dt),
+                                size=(len(self.weights), 2))
+        self.particles[:, :2] += dt * self.particles[:, 2:] + \
+            0.5 * dt * dt * accel
+        self.particles[:, 2:] += dt * accel
+
+    def correct(self, node, distance, variance, gate):
+        predicted = numpy.hypot(self.particles[:, 0] - node[0],
+                                self.particles[:, 1] - node[1])
+        innovation = (distance - predicted) ** 2 / variance
+        if innovation.min() > gate:
+            return False
+        weights = self.weights * numpy.exp(-0.5 * innovation)
+        total = weights.sum()
+        if not total > 0:
+            return False
+        self.weights = weights / total
+        if 1.0 / (self.weights ** 2).sum() < 0.5 * len(self.weights):
+            self._resample()
+        return True
+
+    def _resample(self):
+        """Systematic resampling."""
+        count = len(self.weights)
+        positions = (self.rng.random() + numpy.arange(count)) / count
+        cumulative = numpy.cumsum(self.weights)
+        cumulative[-1] = 1.0
+        self.particles = self.particles[numpy.searchsorted(cumulative,
+                                                           positions)]
+        self.weights = numpy.full(count, 1.0 / count)
+
+    def position(self):
+        x, y = self.weights.dot(self.particles[:, :2])
+        return float(x), float(y)
+
+    def velocity(self):
+        vx, vy = self.weights.dot(self.particles[:, 2:])
+        return float(vx), float(vy)
+
+    def position_cov(self):
+        cov = numpy.cov(self.particles[:, :2], rowvar=False,
+                        aweights=self.weights)
+        return cov.tolist()
+
+
+class BeaconTracker(object):
+    """
+    Per-beacon position tracks, updated with each range measurement.
+
+    Tracks start from a trilateration fix (see start). After that every
+    range refines the track in O(1), and the filtered position can be read
+    without solving anything. A track is lost when it hasn't been
+    updated for `max_age` seconds or its position spread grows past
+    `max_variance`, and the next fix restarts it. Lost tracks are only
+    kept to warm-start that fix, and are dropped after `forget_after`.
+    """
+
+    def __init__(self, method=KALMAN, accel_noise=0.5, range_noise=0.3,
+                 gate=16.0, max_age=30.0, max_variance=100.0, particles=500,
+                 forget_after=None):
+        """
+        :param method: str One of FILTERS
+        :param accel_noise: float How hard beacons can change velocity,
+          in (m/s^2)^2 per second
+        :param range_noise: float Standard deviation of a range, as a
+          fraction of the range (RSSI ranging error grows with distance)
+        :param gate: float Reject ranges this many squared standard
+          deviations from the prediction
+        :param max_age: float Seconds without updates before a track is lost
+        :param max_variance: float Position variance (m^2) at which a track
+          is lost
+        :param particles: int Particles per beacon, for the particle filter
+        :param forget_after: float Seconds without updates before a lost
+          track is dropped altogether, so beacons that pass by don't hold
+          memory forever (default 10 * max_age)
+        """
+        if method not in FILTERS:
+            raise ValueError("Unknown tracking filter {}".format(method))
+        self.method = method
+        self.accel_noise = accel_noise
+        self.range_noise = range_noise
+        self.gate = gate
+        self.max_age = max_age
+        self.max_variance = max_variance
+        self.particles = particles
+        self.forget_after = forget_after if forget_after is not None \
+            else 10 * max_age
+        self.tracks = {}
+        self._swept = None  # Timestamp of the last sweep for old tracks
+        self.rejected = 0
+        self._rng = numpy.random.default_rng()
+
+    def __contains__(self, bt_addr):
+        return bt_addr in self.tracks
+
+    def start(self, bt_addr, timestamp, coords, error=1.0):
+        """
+        Start (or restart) a track from a trilateration fix.
+        :param error: float RMS range error of the fix, in meters
+        """
+        variance = max(float(error), 1.0) ** 2
+        if self.method == PARTICLE:
+            track = ParticleTrack(timestamp, coords, variance, 1.0,
+                                  count=self.particles, rng=self._rng)
+        else:
+            track = KalmanTrack(timestamp, coords, variance, 1.0)
+        self.tracks[bt_addr] = track
+        self._expire(timestamp)
+        return track
+
+    def update(self, bt_addr, timestamp, node, distance):
+        """
+        :param timestamp: float Epoch seconds of the measurement
+        :param node: tuple (x, y) of the node that measured it
+        :param distance: float Measured range
+        :return: bool Whether the beacon has a track it was applied to
+        """
+        self._expire(timestamp)
+        track = self.tracks.get(bt_addr)
+        if track is None:
+            return False
+        track.predict(timestamp, self.accel_noise)
+        variance = (self.range_noise * max(distance, 1.0)) ** 2
+        if not track.correct(node, distance, variance, self.gate):
+            self.rejected += 1
+        return True
+
+    def _expire(self, timestamp):
+        """Drop tracks not updated for forget_after seconds, now and then."""
+        if self._swept is not None and \
+                0 <= timestamp - self._swept < self.forget_after / 10.0:
+            return
+        self._swept = timestamp
+        oldest = timestamp - self.forget_after
+        for bt_addr in [bt_addr for bt_addr, track in self.tracks.items()
+                        if track.time < oldest]:
+            del self.tracks[bt_addr]
+
+    def get(self, bt_addr, timestamp):
+        """
+        :param timestamp: float Epoch seconds "now", for ageing the track
+        :return: obj The beacon's live track, or None if it has none
+        """
+        track = self.tracks.get(bt_addr)
+        if track is None:
+            return None
+        cov = track.position_cov()
+        if (timestamp - track.time > self.max_age or
+                cov[0][0] + cov[1][1] > self.max_variance):
+            return None  # Lost; kept as a guess until forget_after
+        return track
+
+    def guess(self, bt_addr):
+        """
+        :return: tuple Last tracked position, even from a lost track, to
+          warm-start trilateration; None if never tracked
+        """
+        track = self.tracks.get(bt_addr)
+        return track.position() if track is not None else None
+
+    @staticmethod
+    def describe(track):
+        """:return: dict Track details for the 'located' message meta"""
+        cov = track.position_cov()
+        return {"cov": [[round(v, 4) for v in row] for row in cov],
+                "velocity": [round(v, 4) for v in track.velocity()]}
@@ -0,0 +1,749 @@
+import asyncio
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import traceback
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from time import time
+
+from pubnub.callbacks import SubscribeCallback
+from pubnub.enums import PNStatusCategory
+from pubnub.pnconfiguration import PNConfiguration
+from pubnub.pubnub import PubNub
+
+# Frames on the local broker socket are a 4-byte big-endian length, then
+#   that many bytes of UTF-8 JSON.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME = 16 * 1024 * 1024
+HISTORY_LEN = 1000
+
+
+class LocalStatus(object):
+    """Quacks like a PubNub status, so publish callbacks work unchanged."""
+
+    def __init__(self, category=PNStatusCategory.PNAcknowledgmentCategory):
+        self.category = category
+
+    def is_error(self):
+        return self.category != PNStatusCategory.PNAcknowledgmentCategory
+
+
+OK = LocalStatus()
+TIMEOUT = LocalStatus(PNStatusCategory.PNTimeoutCategory)
+
+
+def is_pubnub(url):
+    """:return: bool Whether a transport URL means PubNub, which needs keys"""
+    return not url or url == "pubnub"
+
+
+class Transport(ABC):
+    """
+    Publish/subscribe/history, wherever the messages actually go.
+
+    Publish callbacks are PubNub-style, callback(result, status). Subscribe
+    handlers are called like handler(channel, message).
+    """
+
+    @abstractmethod
+    def publish(self, channel, message, callback=None, meta=None):
+        pass
+
+    @abstractmethod
+    def publish_sync(self, channel, message):
+        """:return: bool Whether the message was accepted"""
+
+    @abstractmethod
+    def subscribe(self, channels, handler):
+        pass
+
+    @abstractmethod
+    def history(self, channel, count=100):
+        """:return: list The last `count` messages on channel, oldest first"""
+
+    def unsubscribe_all(self):
+        pass
+
+    def close(self):
+        self.unsubscribe_all()
+
+
+class _Listener(SubscribeCallback):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def status(self, pubnub, status):
+        pass
+
+    def presence(self, pubnub, presence):
+        pass
+
+    def message(self, pubnub, msg):
+        self.handler(msg.channel, msg.message)
+
+
+class PubNubTransport(Transport):
+    def __init__(self, pub_key, sub_key, uuid=None, ssl=False):
+        pnconfig = PNConfiguration()
+        pnconfig.subscribe_key = sub_key
+        pnconfig.publish_key = pub_key
+        if uuid:
+            pnconfig.uuid = uuid
+        pnconfig.ssl = ssl
+        self.pubnub = PubNub(pnconfig)
+
+    def publish(self, channel, message, callback=None, meta=None):
+        request = self.pubnub.publish() \
+            .channel(channel) \
+            .message(message) \
+            .should_store(True)
+        if meta is not None:
+            request = request.meta(meta)
+        request.pn_async(callback or _ignore)
+
+    def publish_sync(self, channel, message):
+        self.pubnub.publish() \
+            .channel(channel) \
+            .message(message) \
+            .should_store(True) \
+            .sync()
+        return True
+
+    def subscribe(self, channels, handler):
+        self.pubnub.add_listener(_Listener(handler))
+        self.pubnub.subscribe() \
+            .channels(list(channels)) \
+            .execute()
+
+    def history(self, channel, count=100):
+        result = self.pubnub \
+            .history() \
+            .channel(channel) \
+            .count(count).sync()
+        return [m.entry for m in result.result.messages]
+
+    def unsubscribe_all(self):
+        self.pubnub.unsubscribe_all()
+
+
+def _ignore(result, status):
+    pass
+
+
+class Broker(object):
+    """Channel state shared by everyone on a local broker."""
+
+    def __init__(self, history_len=HISTORY_LEN):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(list)
+        self._history = defaultdict(lambda: deque(maxlen=history_len))
+
+    def publish(self, channel, message):
+        with self._lock:
+            self._history[channel].append(message)
+            handlers = list(self._subscribers.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler(channel, message)
+            except Exception:
+                traceback.print_exc()
+
+    def subscribe(self, channels, handler):
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].append(handler)
+
+    def unsubscribe(self, handler):
+        with self._lock:
+            for handlers in self._subscribers.values():
+                while handler in handlers:
+                    handlers.remove(handler)
+
+    def history(self, channel, count=100):
+        with self._lock:
+            messages = list(self._history.get(channel, ()))
+        return messages[-count:]
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(name="default"):
+    """:return: Broker The in-process broker with this name"""
+    with _brokers_lock:
+        if name not in _brokers:
+            _brokers[name] = Broker()
+        return _brokers[name]
+
+
+class MemoryTransport(Transport):
+    """
+    Everything stays in this process; subscribers are called directly from
+      the publishing thread. Meant for tests, benchmarks and replays.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else get_broker()
+        self._handlers = []
+
+    def publish(self, channel, message, callback=None, meta=None):
+        self.broker.publish(channel, message)
+        if callback:
+            callback(None, OK)
+
+    def publish_sync(self, channel, message):
+        self.broker.publish(channel, message)
+        return True
+
+    def subscribe(self, channels, handler):
+        self._handlers.append(handler)
+        self.broker.subscribe(channels, handler)
+
+    def history(self, channel, count=100):
+        return self.broker.history(channel, count)
+
+    def unsubscribe_all(self):
+        for handler in self._handlers:
+            self.broker.unsubscribe(handler)
+        self._handlers = []
+
+
+def send_frame(sock, obj):
+    data = json.dumps(obj, separators=(',', ':')).encode("utf-8")
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    size, = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError("frame of {} bytes is too big".format(size))
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+
+def parse_address(url):
+    """
+    :param url: str Like tcp://host:port or unix:///path/to/socket
+    :return: tuple (socket family, address)
+    """
+    if url.startswith("unix://"):
+        return socket.AF_UNIX, url[len("unix://"):]
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://"):].rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    raise ValueError("Unsupported broker address {}".format(url))
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.send_lock = threading.Lock()
+
+    def deliver(self, channel, message):
+        with self.send_lock:
+            send_frame(self.request, {"op": "msg", "ch": channel,
+                                      "msg": message})
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                frame = recv_frame(self.request)
+                op = frame.get("op")
+                if op == "pub":
+                    broker.publish(frame["ch"], frame["msg"])
+                    reply = {"op": "ack", "id": frame.get("id")}
+                elif op == "sub":
+                    broker.subscribe(frame["chs"], self._safe_deliver)
+                    reply = {"op": "ack", "id": frame.get("id")}
+                elif op == "hist":
+                    reply = {"op": "hist", "id": frame.get("id"),
+                             "msgs": broker.history(frame["ch"],
+                                                    frame.get("count", 100))}
+                else:
+                    reply = {"op": "err", "id": frame.get("id")}
+                with self.send_lock:
+                    send_frame(self.request, reply)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            broker.unsubscribe(self._safe_deliver)
+
+    def _safe_deliver(self, channel, message):
+        try:
+            self.deliver(channel, message)
+        except OSError:
+            pass  # Client went away; handle() cleans up
+
+
+class BrokerServer(object):
+    """
+    A local message broker for scanners and locators on one LAN (TCP) or
+      one machine (Unix socket).
+    """
+
+    def __init__(self, url, history_len=HISTORY_LEN):
+        family, address = parse_address(url)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            server_cls = socketserver.ThreadingUnixStreamServer
+        else:
+            server_cls = socketserver.ThreadingTCPServer
+        server_cls.allow_reuse_address = True
+        server_cls.daemon_threads = True
+        self.server = server_cls(address, _BrokerHandler)
+        self.server.broker = Broker(history_len)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SocketTransport(Transport):
+    """Client for a BrokerServer. Reconnects on the next call if dropped."""
+
+    def __init__(self, url, timeout=5.0):
+        self.family, self.address = parse_address(url)
+        self.timeout = timeout
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._waiting = {}  # id -> callback(frame)
+        self._subscriptions = []  # (channels, handler)
+        # Handlers run on their own thread, so they can call history()
+        #  without blocking the reader that would deliver the reply
+        self._inbox = queue.Queue()
+        self._dispatcher = None
+
+    def _connect(self):
+        """Call with _send_lock held."""
+        if self._sock is not None:
+            return self._sock
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        sock.settimeout(None)
+        self._sock = sock
+        reader = threading.Thread(target=self._read, args=(sock,))
+        reader.daemon = True
+        reader.start()
+        for channels, _ in self._subscriptions:
+            send_frame(sock, {"op": "sub", "chs": list(channels),
+                              "id": next(self._ids)})
+        return sock
+
+    def _read(self, sock):
+        try:
+            while True:
+                frame = recv_frame(sock)
+                if frame.get("op") == "msg":
+                    self._inbox.put(frame)
+                else:
+                    waiter = self._waiting.pop(frame.get("id"), None)
+                    if waiter:
+                        waiter(frame)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        with self._send_lock:
+            if self._sock is sock:
+                self._sock = None
+        # Nobody will answer these now
+        for msg_id in list(self._waiting):
+            waiter = self._waiting.pop(msg_id, None)
+            if waiter:
+                waiter(None)
+
+    def _dispatch(self):
+        while True:
+            frame = self._inbox.get()
+            for channels, handler in list(self._subscriptions):
+                if frame["ch"] in channels:
+                    try:
+                        handler(frame["ch"], frame["msg"])
+                    except Exception:
+                        traceback.print_exc()
+
+    def _request(self, frame, waiter=None):
+        msg_id = next(self._ids)
+        frame["id"] = msg_id
+        if waiter:
+            self._waiting[msg_id] = waiter
+        try:
+            with self._send_lock:
+                send_frame(self._connect(), frame)
+            return True
+        except OSError:
+            self._waiting.pop(msg_id, None)
+            with self._send_lock:
+                self._sock = None
+            return False
+
+    def publish(self, channel, message, callback=None, meta=None):
+        def waiter(frame):
+            if callback:
+                callback(None, OK if frame else TIMEOUT)
+
+        if not self._request({"op": "pub", "ch": channel, "msg": message},
+                             waiter) and callback:
+            callback(None, TIMEOUT)
+
+    def _call(self, frame):
+        done = threading.Event()
+        reply = []
+
+        def waiter(f):
+            reply.append(f)
+            done.set()
+
+        if not self._request(frame, waiter) or not done.wait(self.timeout):
+            return None
+        return reply[0]
+
+    def publish_sync(self, channel, message):
+        return self._call({"op": "pub", "ch": channel,
+                           "msg": message}) is not None
+
+    def subscribe(self, channels, handler):
+        channels = frozenset(channels)
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch)
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+        # Connect first - a fresh connection re-sends known subscriptions
+        try:
+            with self._send_lock:
+                self._connect()
+        except OSError:
+            pass
+        self._subscriptions.append((channels, handler))
+        self._request({"op": "sub", "chs": list(channels)})
+
+    def history(self, channel, count=100):
+        reply = self._call({"op": "hist", "ch": channel, "count": count})
+        return reply["msgs"] if reply else []
+
+    def unsubscribe_all(self):
+        self._subscriptions = []
+
+    def close(self):
+        self.unsubscribe_all()
+        with self._send_lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+
+class AsyncTransport(ABC):
+    """
+    Transport for asyncio code. Publish and history are coroutines, and
+      subscribed messages are put on an asyncio.Queue as
+      (channel, message, epoch seconds received).
+    """
+
+    dropped = 0  # Messages lost because the subscriber's queue was full
+
+    @abstractmethod
+    async def publish(self, channel, message):
+        """
+        Send a message. May wait for room when too many are in flight, but
+          not for the send itself.
+        """
+
+    @abstractmethod
+    def subscribe(self, channels, queue):
+        pass
+
+    @abstractmethod
+    async def history(self, channel, count=100):
+        """:return: list The last `count` messages on channel, oldest first"""
+
+    def unsubscribe_all(self):
+        pass
+
+    async def drain(self):
+        """Wait until every message received so far is on its queue."""
+        pass
+
+    async def close(self):
+        self.unsubscribe_all()
+
+
+class _Feeder(object):
+    """
+    Moves messages from transport threads onto an asyncio.Queue in bulk,
+      waking the loop once per bunch rather than once per message.
+    """
+
+    def __init__(self, loop, queue, limit):
+        self.loop = loop
+        self.queue = queue
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.task = loop.create_task(self._pump())
+
+    def put(self, item):
+        """Called from any thread but the loop's; waits while full."""
+        with self._cond:
+            while len(self._items) >= self.limit:
+                self._cond.wait()
+            self._items.append(item)
+            wake = len(self._items) == 1
+        if wake:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def _pump(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            self._idle.clear()
+            while True:
+                with self._cond:
+                    items = list(self._items)
+                    self._items.clear()
+                    self._cond.notify_all()
+                if not items:
+                    break
+                for item in items:
+                    await self.queue.put(item)
+            self._idle.set()
+
+    async def drain(self):
+        while True:
+            await self._idle.wait()
+            with self._cond:
+                if not self._items:
+                    return
+            await asyncio.sleep(0)  # The pump is about to wake
+
+
+class ThreadedAsyncTransport(AsyncTransport):
+    """
+    Any Transport, used from an event loop.
+
+    The thread delivering messages waits while the queue is full, so it
+      holds up the broker (memory://) or socket dispatcher (tcp://,
+      unix://) instead of dropping messages.
+    """
+
+    def __init__(self, transport, loop=None):
+        """
+        :param transport: Transport The transport to wrap
+        :param loop: asyncio.AbstractEventLoop The loop queues belong to
+          (default: the running loop, when subscribing)
+        """
+        self.transport = transport
+        self.loop = loop
+        self.errors = 0
+        self._feeders = []
+
+    def _callback(self, result, status):
+        if status.is_error():
+            self.errors += 1
+
+    async def publish(self, channel, message):
+        # Non-blocking for PubNub and sockets; memory:// delivers inline
+        self.transport.publish(channel, message, self._callback)
+
+    def subscribe(self, channels, queue):
+        loop = self.loop or asyncio.get_running_loop()
+        feeder = _Feeder(loop, queue, max(queue.maxsize, 1))
+        self._feeders.append(feeder)
+
+        def handler(channel, message):
+            item = (channel, message, time())
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                feeder.put(item)
+                return
+            # Published from the loop itself; waiting would deadlock
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+        self.transport.subscribe(channels, handler)
+
+    async def history(self, channel, count=100):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.transport.history,
+                                          channel, count)
+
+    def unsubscribe_all(self):
+        self.transport.unsubscribe_all()
+
+    async def drain(self):
+        for feeder in self._feeders:
+            await feeder.drain()
+
+    async def close(self):
+        self.transport.close()
+        for feeder in self._feeders:
+            feeder.task.cancel()
+        self._feeders = []
+
+
+class PubNubAsyncioTransport(AsyncTransport):
+    """
+    PubNub's asyncio client, so nothing runs on PubNub's threads. Needs
+      aiohttp.
+
+    PubNub can't be told to slow down, so messages arriving to a full queue
+      are dropped and counted.
+    """
+
+    def __init__(self, pub_key, sub_key, uuid=None, ssl=False,
+                 max_in_flight=100):
+        """
+        :param max_in_flight: int Max publishes awaiting a reply before
+          publish() waits
+        """
+        from pubnub.pubnub_asyncio import PubNubAsyncio
+
+        pnconfig = PNConfiguration()
+        pnconfig.subscribe_key = sub_key
+        pnconfig.publish_key = pub_key
+        if uuid:
+            pnconfig.uuid = uuid
+        pnconfig.ssl = ssl
+        self.pubnub = PubNubAsyncio(pnconfig)
+        self.errors = 0
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+
+    async def publish(self, channel, message):
+        await self._in_flight.acquire()
+        task = asyncio.ensure_future(self._publish(channel, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish(self, channel, message):
+        try:
+            await self.pubnub.publish() \
+                .channel(channel) \
+                .message(message) \
+                .should_store(True) \
+                .future()
+        except Exception:
+            self.errors += 1
+        finally:
+            self._in_flight.release()
+
+    def subscribe(self, channels, queue):
+        transport = self
+
+        class Listener(SubscribeCallback):
+            def status(self, pubnub, status):
+                pass
+
+            def presence(self, pubnub, presence):
+                pass
+
+            def message(self, pubnub, msg):
+                try:
+                    queue.put_nowait((msg.channel, msg.message, time()))
+                except asyncio.QueueFull:
+                    transport.dropped += 1
+
+        self.pubnub.add_listener(Listener())
+        self.pubnub.subscribe() \
+            .channels(list(channels)) \
+            .execute()
+
+    async def history(self, channel, count=100):
+        envelope = await self.pubnub \
+            .history() \
+            .channel(channel) \
+            .count(count).future()
+        return [m.entry for m in envelope.result.messages]
+
+    def unsubscribe_all(self):
+        self.pubnub.unsubscribe_all()
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        self.unsubscribe_all()
+        await self.pubnub.stop()
+
+
+def make_transport(url=None, pub_key=None, sub_key=None, uuid=None):
+    """
+    :param url: str One of:
+      None or "pubnub" - PubNub, with pub_key and sub_key
+      "memory://name" - in-process broker called name
+      "tcp://host:port" or "unix:///path" - a BrokerServer
+      An existing Transport is returned as-is.
+    :return: Transport
+    """
+    if isinstance(url, Transport):
+        return url
+    if is_pubnub(url):
+        return PubNubTransport(pub_key, sub_key, uuid=uuid)
+    if url.startswith("memory://"):
+        return MemoryTransport(get_broker(url[len("memory://"):] or "default"))
+    return SocketTransport(url)
+
+
+def make_async_transport(url=None, pub_key=None, sub_key=None, uuid=None):
+    """
+    Like make_transport, for asyncio code.
+    :param url: str As for make_transport; PubNub uses its asyncio client.
+      An existing AsyncTransport is returned as-is, and an existing
+      Transport is wrapped.
+    :return: AsyncTransport
+    """
+    if isinstance(url, AsyncTransport):
+        return url
+    if not isinstance(url, Transport) and is_pubnub(url):
+        return PubNubAsyncioTransport(pub_key, sub_key, uuid=uuid)
+    return ThreadedAsyncTransport(make_transport(url, pub_key, sub_key, uuid))
+
+
+if __name__ == "__main__":
+    """
+    Run a local broker like:
+      python transport.py tcp://0.0.0.0:5555
+    or
+      python transport.py unix:///tmp/bt-beacon.sock
+    """
+    import sys
+
+    if len(sys.argv) != 2:
+        print("Run transport.py with the address to serve on, like:")
+        print("-  python transport.py tcp://0.0.0.0:5555")
+        quit()
+
+    print("Broker listening on {}".format(sys.argv[1]))
+    BrokerServer(sys.argv[1]).serve_forever()
@@ -3,10 +3,24 @@ import numpy
 
 from scipy.optimize import minimize
 
+try:
+    from metrics import timed
+except ImportError:
+    from app.src.metrics import timed
+
+
+# Solved in-house instead of with scipy.optimize.minimize
+GAUSS_NEWTON = "gauss-newton"
+
 
 class TrilaterationSolver(object):
     def __init__(self, method="L-BFGS-B",
                  tolerance=1e-5, iterations=1e+2):
+        """
+        :param method: str "gauss-newton", or any scipy.optimize.minimize method
+        :param tolerance: float Relative change in error at which to stop
+        :param iterations: int Maximum iterations
+        """
         self.initial_guess = numpy.asarray((0, 0))
         self.method = method
         self.tolerance = tolerance
@@ -58,14 +72,249 @@ class TrilaterationSolver(object):
             location_count += 1
         return mse / location_count
 
-    def best_point(self, locations, distances):
+    @staticmethod
+    def weights(distances):
+        """
+        The same "near" weighting as mse, as an array.
+        :param distances: numpy.ndarray Distance guesses
+        :return: numpy.ndarray Multipliers for each error term
+        """
+        return 1 - numpy.maximum(0, distances - 1.5) / 100.0
+
+    @staticmethod
+    def linear_guess(locations, distances):
+        """
+        Closed-form estimate from subtracting the first circle equation
+         from the others and solving the linear system by least squares.
+        Falls back to an inverse-distance weighted centroid of the
+         locations if they don't span the plane (fewer than 3, or collinear).
+        :param locations: numpy.ndarray Shape (n, 2) node locations
+        :param distances: numpy.ndarray Shape (n,) distance guesses
+        :return: numpy.ndarray Shape (2,) coordinates
+        """
+        if len(locations) >= 3:
+            a = 2 * (locations[1:] - locations[0])
+            sq = (locations ** 2).sum(axis=1)
+            b = (distances[0] ** 2 - distances[1:] ** 2) + (sq[1:] - sq[0])
+            solution, _, rank, _ = numpy.linalg.lstsq(a, b, rcond=None)
+            if rank == 2:
+                return solution
+        inverse = 1 / numpy.maximum(distances, 1e-6)
+        return (locations * inverse[:, None]).sum(axis=0) / inverse.sum()
+
+    def _gauss_newton(self, locations, distances, initial_guess=None):
+        """
+        Minimize the same weighted mean square error as mse, using
+         Gauss-Newton steps with Levenberg-Marquardt damping and the
+         analytic Jacobian of the range residuals.
+        :return: tuple (coords as numpy.ndarray, mean square error)
+        """
+        locations = numpy.asarray(locations, dtype=float).reshape(-1, 2)
+        distances = numpy.asarray(distances, dtype=float)
+        weights = self.weights(distances)
+        count = len(distances)
+
+        if initial_guess is None:
+            point = self.linear_guess(locations, distances)
+        else:
+            point = numpy.asarray(initial_guess, dtype=float)
+
+        def residuals(p):
+            diff = p - locations
+            ranges = numpy.sqrt((diff ** 2).sum(axis=1))
+            return diff, ranges, (ranges - distances) * weights
+
+        diff, ranges, res = residuals(point)
+        cost = res.dot(res)
+        damping = 1e-3
+        for _ in range(int(self.iterations)):
+            # d(residual_i)/d(point) = weight_i * unit vector from node i
+            jac = diff * (weights / numpy.maximum(ranges, 1e-9))[:, None]
+            jtj = jac.T.dot(jac)
+            grad = jac.T.dot(res)
+
+            # Solve the damped 2x2 normal equations by hand
+            a = jtj[0, 0] * (1 + damping) + 1e-12
+            d = jtj[1, 1] * (1 + damping) + 1e-12
+            b = jtj[0, 1]
+            det = a * d - b * b
+            step = numpy.array((d * grad[0] - b * grad[1],
+                                a * grad[1] - b * grad[0])) / -det
+
+            new_point = point + step
+            new_diff, new_ranges, new_res = residuals(new_point)
+            new_cost = new_res.dot(new_res)
+            if new_cost <= cost:
+                improvement = cost - new_cost
+                point, diff, ranges, res = new_point, new_diff, new_ranges, new_res
+                cost = new_cost
+                damping = max(damping * 0.3, 1e-9)
+                if improvement <= self.tolerance * max(cost, 1e-12):
+                    break
+            else:
+                damping *= 10
+                if damping > 1e9:
+                    break
+        return point, cost / count
+
+    @staticmethod
+    def pad_batch(batch):
+        """
+        Pack ragged (locations, distances[, counts]) sets into padded arrays.
+        Counts are how many times each entry is repeated, and default to 1.
+        :param batch: list [ (locations, distances), ... ]
+        :return: tuple (locations (n, m, 2), distances (n, m),
+          counts (n, m), mask (n, m))
+        """
+        width = max(len(item[1]) for item in batch)
+        locations = numpy.zeros((len(batch), width, 2))
+        distances = numpy.zeros((len(batch), width))
+        counts = numpy.zeros((len(batch), width))
+        mask = numpy.zeros((len(batch), width), dtype=bool)
+        for i, item in enumerate(batch):
+            size = len(item[1])
+            locations[i, :size] = numpy.asarray(item[0], dtype=float) \
+                .reshape(-1, 2)
+            distances[i, :size] = item[1]
+            counts[i, :size] = item[2] if len(item) > 2 else 1
+            mask[i, :size] = True
+        return locations, distances, counts, mask
+
+    @staticmethod
+    def linear_guesses(locations, distances, mask):
+        """
+        linear_guess for a padded batch, via the 2x2 normal equations.
+        :return: numpy.ndarray Shape (n, 2) coordinates
+        """
+        rows = mask[:, 1:]
+        a = 2 * (locations[:, 1:] - locations[:, :1]) * rows[..., None]
+        sq = (locations ** 2).sum(axis=2)
+        b = ((distances[:, :1] ** 2 - distances[:, 1:] ** 2) +
+             (sq[:, 1:] - sq[:, :1])) * rows
+        ata = numpy.einsum('nki,nkj->nij', a, a)
+        atb = numpy.einsum('nki,nk->ni', a, b)
+        det = ata[:, 0, 0] * ata[:, 1, 1] - ata[:, 0, 1] * ata[:, 1, 0]
+        scale = numpy.maximum(ata[:, 0, 0] * ata[:, 1, 1], 1e-12)
+        solvable = (mask.sum(axis=1) >= 3) & (numpy.abs(det) > 1e-9 * scale)
+        safe_det = numpy.where(solvable, det, 1.0)
+        solved = numpy.stack((
+            ata[:, 1, 1] * atb[:, 0] - ata[:, 0, 1] * atb[:, 1],
+            ata[:, 0, 0] * atb[:, 1] - ata[:, 1, 0] * atb[:, 0],
+        ), axis=1) / safe_det[:, None]
+
+        inverse = mask / numpy.maximum(distances, 1e-6)
+        centroid = (locations * inverse[..., None]).sum(axis=1) / \
+            inverse.sum(axis=1)[:, None]
+        return numpy.where(solvable[:, None], solved, centroid)
+
+    @timed("solver_best_points_seconds", "Time solving a batch of beacons")
+    def best_points(self, batch, initial_guesses=None):
+        """
+        Solve many beacons at once with vectorized Gauss-Newton. Each set
+         can have a different number of nodes; sets are padded and masked.
+        Always uses Gauss-Newton, whatever the solver's method.
+        :param batch: list [ (locations, distances), ... ] - one per beacon,
+          each like the arguments to best_point. An optional third item
+          gives how many times each entry counts, as if it was repeated.
+        :param initial_guesses: numpy.ndarray Optional shape (n, 2) start
+          points, such as tracked positions. Rows of NaN use linear_guesses.
+        :return: dict {"coords": array (n, 2), "avg_err": array (n,)}
+        """
+        locations, distances, counts, mask = self.pad_batch(batch)
+        # Repeating an entry k times scales its squared error by k
+        weights = self.weights(distances) * numpy.sqrt(counts)
+        counts = counts.sum(axis=1)
+
+        points = self.linear_guesses(locations, distances, mask)
+        if initial_guesses is not None:
+            initial_guesses = numpy.asarray(initial_guesses, dtype=float)
+            known = numpy.isfinite(initial_guesses).all(axis=1)
+            points[known] = initial_guesses[known]
+
+        def residuals(p, rows):
+            diff = p[:, None, :] - locations[rows]
+            ranges = numpy.sqrt((diff ** 2).sum(axis=2))
+            return diff, ranges, (ranges - distances[rows]) * weights[rows]
+
+        everything = numpy.arange(len(batch))
+        diff, ranges, res = residuals(points, everything)
+        cost = (res ** 2).sum(axis=1)
+        damping = numpy.full(len(batch), 1e-3)
+        # Only the rows still improving are worked on in each iteration
+        rows = everything
+        for _ in range(int(self.iterations)):
+            w = weights[rows]
+            jac = diff * (w / numpy.maximum(ranges, 1e-9))[..., None]
+            jtj = numpy.einsum('nki,nkj->nij', jac, jac)
+            grad = numpy.einsum('nki,nk->ni', jac, res)
+
+            damp = damping[rows]
+            a = jtj[:, 0, 0] * (1 + damp) + 1e-12
+            d = jtj[:, 1, 1] * (1 + damp) + 1e-12
+            b = jtj[:, 0, 1]
+            det = a * d - b * b
+            step = numpy.stack((d * grad[:, 0] - b * grad[:, 1],
+                                a * grad[:, 1] - b * grad[:, 0]),
+                               axis=1) / -det[:, None]
+
+            new_points = points[rows] + step
+            new_diff, new_ranges, new_res = residuals(new_points, rows)
+            new_cost = (new_res ** 2).sum(axis=1)
+            old_cost = cost[rows]
+            accept = new_cost <= old_cost
+
+            points[rows[accept]] = new_points[accept]
+            cost[rows[accept]] = new_cost[accept]
+            damping[rows] = numpy.where(accept, numpy.maximum(damp * 0.3, 1e-9),
+                                        damp * 10)
+
+            converged = accept & (old_cost - new_cost <=
+                                  self.tolerance * numpy.maximum(new_cost, 1e-12))
+            keep = ~converged & (damping[rows] <= 1e9)
+            if not keep.any():
+                break
+            # Carry the current state of the remaining rows forward
+            diff = numpy.where(accept[:, None, None], new_diff, diff)[keep]
+            ranges = numpy.where(accept[:, None], new_ranges, ranges)[keep]
+            res = numpy.where(accept[:, None], new_res, res)[keep]
+            rows = rows[keep]
+
+        return {"coords": points,
+                "avg_err": numpy.sqrt(cost / counts)}
+
+    def avg_err(self, point, locations, distances, counts=None):
+        """
+        The avg_err best_points would report for point, without solving.
+        :param point: tuple Coordinates like (x_coord, y_coord)
+        :param counts: list How many times each entry counts (default 1)
+        :return: float Root mean square weighted error
+        """
+        locations = numpy.asarray(locations, dtype=float).reshape(-1, 2)
+        distances = numpy.asarray(distances, dtype=float)
+        counts = numpy.ones(len(distances)) if counts is None \
+            else numpy.asarray(counts, dtype=float)
+        ranges = numpy.sqrt(((numpy.asarray(point) - locations) ** 2)
+                            .sum(axis=1))
+        res = (ranges - distances) * self.weights(distances)
+        return math.sqrt((counts * res ** 2).sum() / counts.sum())
+
+    @timed("solver_best_point_seconds", "Time solving one beacon")
+    def best_point(self, locations, distances, initial_guess=None):
         """
         Find the point with the minimal error given a set of known points
          and distances from those points.
         :param locations: list Known node locations [ (x_coord1, y_coord1), ... ]
         :param distances: list Our RSSI-based distance guesses [ distance1, distance2, ... ]
+        :param initial_guess: tuple Optional start point, such as a tracked
+          position; by default one is worked out from the distances
         :return: tuple The coordinates of the minimal-error solution
         """
+        if self.method == GAUSS_NEWTON:
+            coords, mse = self._gauss_newton(locations, distances,
+                                             initial_guess)
+            return {"coords": tuple(coords),
+                    "avg_err": math.sqrt(mse)}
+
         # Find a reasonable initial guess using the closest distance guess
         data = zip(locations, distances)
         min_distance = float('inf')
@@ -75,7 +324,8 @@ class TrilaterationSolver(object):
             if dist < min_distance:
                 min_distance = dist
             closest_location = loc
-        self.initial_guess = closest_location
+        self.initial_guess = closest_location if initial_guess is None \
+            else initial_guess
 
         result = minimize(
             self.mse,  # The error function
@@ -0,0 +1,294 @@
+import base64
+import binascii
+import json
+import logging
+import struct
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+try:
+    from batching import BATCH_VERSION
+except ImportError:
+    from app.src.batching import BATCH_VERSION
+
+# Child of the 'scan' logger so records land in scan.log
+logger = logging.getLogger('scan.wire')
+
+COMPACT_VERSION = 2
+WIRE_FORMATS = ("compact", "json")
+
+# A compact message is still JSON, so it goes over any transport:
+#   {"v": 2, "z": "<base64 of the packed batch>", "trace": {...}}
+# The batch's trace context (see tracing.py), if any, is passed through as-is.
+#
+# The packed batch is big-endian:
+#   header   d  base epoch seconds (earliest sighting in the batch)
+#            B  node name length, then the UTF-8 node name
+#            H  beacon count
+#   beacon   6s MAC address
+#            B  flags, FLAG_PACKET | FLAG_PROPERTIES
+#            H  sighting count
+#            H  packet JSON length, then the JSON    (if FLAG_PACKET)
+#            H  properties JSON length, then the JSON (if FLAG_PROPERTIES)
+#   sighting b  RSSI
+#            H  milliseconds after the base time
+#
+# The node name is written once per message instead of once per sighting,
+#   and timestamps are 2-byte offsets instead of 8-byte floats. Packets are
+#   only sent when they change, or every `packet_interval` seconds. A packet
+#   counts as sent once a message holding it is published, so one lost with
+#   a dropped or failed batch goes out again in the next.
+HEADER = struct.Struct(">dB")
+COUNT = struct.Struct(">H")
+BEACON = struct.Struct(">6sBH")
+FLAG_PACKET = 1
+FLAG_PROPERTIES = 2
+MAX_OFFSET = 0xFFFF  # ms, so a batch can span about 65 seconds
+
+
+class EncodeError(ValueError):
+    """The batch can't be packed; send it as JSON instead."""
+
+
+def is_compact(message):
+    return isinstance(message, dict) and "z" in message
+
+
+def _mac_bytes(bt_addr):
+    try:
+        mac = binascii.unhexlify(bt_addr.replace(":", ""))
+    except (AttributeError, binascii.Error, ValueError):
+        raise EncodeError("Not a MAC address: {!r}".format(bt_addr))
+    if len(mac) != 6 or _mac_str(mac) != bt_addr:
+        raise EncodeError("Not a MAC address: {!r}".format(bt_addr))
+    return mac
+
+
+def _mac_str(mac):
+    return ":".join("{:02x}".format(b) for b in mac)
+
+
+def _json_bytes(value):
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(data) > 0xFFFF:
+        raise EncodeError("Packet too large")
+    return data
+
+
+class WireEncoder(object):
+    """
+    Pack BatchPublisher batches into compact 'raw_channel' messages.
+
+    Keeps the last packet published per beacon. Messages are encoded on one
+    thread (the batcher's) and confirmed from publish callbacks; publish
+    through tracking() so packets are confirmed.
+    """
+
+    def __init__(self, wire_format="compact", packet_interval=60.0,
+                 max_beacons=4096, max_in_flight=1024):
+        """
+        :param wire_format: str One of WIRE_FORMATS; "json" sends batches
+          unchanged
+        :param packet_interval: float Resend an unchanged packet after this
+          many seconds, so new subscribers learn it
+        :param max_beacons: int Max beacons to remember packets for; the
+          least recently seen are forgotten, and their packets resent
+        :param max_in_flight: int Max messages waiting to be confirmed; the
+          oldest are forgotten, as if they were lost
+        """
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError("Unknown wire format {}".format(wire_format))
+        self.wire_format = wire_format
+        self.packet_interval = packet_interval
+        self.max_beacons = max_beacons
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        # bt_addr -> (packet JSON, monotonic time published), LRU order
+        self._sent = OrderedDict()
+        # message "z" -> [(bt_addr, packet JSON, monotonic time encoded)]
+        self._in_flight = OrderedDict()
+
+    def encode(self, batch):
+        """
+        :param batch: dict A batch message built by BatchPublisher
+        :return: dict The compact message, or the batch itself if the format
+          is "json" or the batch can't be packed
+        """
+        if self.wire_format != "compact":
+            return batch
+        try:
+            data, packed = self._pack(batch)
+        except (EncodeError, struct.error) as e:
+            logger.debug("Sending batch as JSON: {}".format(e))
+            return batch
+        message = {"v": COMPACT_VERSION,
+                   "z": base64.b64encode(data).decode("ascii")}
+        if "trace" in batch:
+            message["trace"] = batch["trace"]
+        if packed:
+            with self._lock:
+                self._in_flight[message["z"]] = packed
+                while len(self._in_flight) > self.max_in_flight:
+                    self._in_flight.popitem(last=False)
+        return message
+
+    def confirm(self, message):
+        """
+        Count the packets in a message as sent, once it's published.
+        :param message: dict A message from encode()
+        """
+        if not is_compact(message):
+            return
+        with self._lock:
+            packed = self._in_flight.pop(message["z"], None)
+            if not packed:
+                return
+            for bt_addr, packets, encoded in packed:
+                sent = self._sent.get(bt_addr)
+                if sent is not None and sent[1] > encoded:
+                    continue  # A newer message was confirmed first
+                self._sent[bt_addr] = (packets, encoded)
+                self._sent.move_to_end(bt_addr)
+            while len(self._sent) > self.max_beacons:
+                self._sent.popitem(last=False)
+
+    def tracking(self, send_fn):
+        """
+        :param send_fn: callable Like send_fn(channel, message, callback),
+          with a PubNub-style callback(result, status)
+        :return: callable send_fn, confirming messages that publish
+        """
+        def send(channel, message, callback=None):
+            def published(result, status):
+                if not status.is_error():
+                    self.confirm(message)
+                if callback is not None:
+                    callback(result, status)
+            return send_fn(channel, message, published)
+        return send
+
+    def _pack(self, batch):
+        beacons = batch["beacons"]
+        base = min(ts for slot in beacons.values() for _, ts in slot["s"])
+        base = round(base, 3)
+        node = batch["node"].encode("utf-8")
+        if len(node) > 0xFF:
+            raise EncodeError("Node name too long")
+
+        now = monotonic()
+        packed = []
+        parts = [HEADER.pack(base, len(node)), node,
+                 COUNT.pack(len(beacons))]
+        for bt_addr, slot in beacons.items():
+            sightings = slot["s"]
+            flags = 0
+            extra = []
+            packets = (_json_bytes(slot.get("packet")),
+                       _json_bytes(slot.get("properties")))
+            with self._lock:
+                sent = self._sent.get(bt_addr)
+            if (sent is None or sent[0] != packets or
+                    now - sent[1] >= self.packet_interval):
+                pending = (bt_addr, packets, now)
+                if slot.get("packet") is not None:
+                    flags |= FLAG_PACKET
+                    extra += [COUNT.pack(len(packets[0])), packets[0]]
+                if slot.get("properties") is not None:
+                    flags |= FLAG_PROPERTIES
+                    extra += [COUNT.pack(len(packets[1])), packets[1]]
+            else:
+                pending = None
+
+            values = []
+            for rssi, timestamp in sightings:
+                offset = int(round((timestamp - base) * 1000))
+                if not 0 <= offset <= MAX_OFFSET:
+                    raise EncodeError("Batch spans too long")
+                values += (rssi, offset)
+            parts.append(BEACON.pack(_mac_bytes(bt_addr), flags,
+                                     len(sightings)))
+            parts += extra
+            parts.append(struct.pack(">" + "bH" * len(sightings), *values))
+            if pending and flags:
+                packed.append(pending)
+        return b"".join(parts), packed
+
+
+class WireDecoder(object):
+    """
+    Unpack compact 'raw_channel' messages back into batch messages.
+
+    Keeps the last packet seen per node and beacon, to fill in batches
+    where it was left out.
+    """
+
+    def __init__(self, max_beacons=65536):
+        """
+        :param max_beacons: int Max (node, beacon) packets to remember; the
+          least recently seen are forgotten until they're sent again
+        """
+        self.max_beacons = max_beacons
+        # (node, bt_addr) -> (packet, properties), LRU order
+        self._packets = OrderedDict()
+
+    def decode(self, message):
+        """
+        :param message: dict A compact message, or any other message
+        :return: The batch message, or the message as-is if not compact
+        """
+        if not is_compact(message):
+            return message
+        if message.get("v") != COMPACT_VERSION:
+            raise ValueError("Unknown wire version {}".format(
+                message.get("v")))
+        data = base64.b64decode(message["z"])
+
+        base, node_len = HEADER.unpack_from(data, 0)
+        pos = HEADER.size
+        node = data[pos:pos + node_len].decode("utf-8")
+        pos += node_len
+        (beacon_count,) = COUNT.unpack_from(data, pos)
+        pos += COUNT.size
+
+        beacons = {}
+        for _ in range(beacon_count):
+            mac, flags, sighting_count = BEACON.unpack_from(data, pos)
+            pos += BEACON.size
+            bt_addr = _mac_str(mac)
+            key = (node, bt_addr)
+            if flags & (FLAG_PACKET | FLAG_PROPERTIES):
+                packet = properties = None
+                if flags & FLAG_PACKET:
+                    packet, pos = self._read_json(data, pos)
+                if flags & FLAG_PROPERTIES:
+                    properties, pos = self._read_json(data, pos)
+                self._packets[key] = (packet, properties)
+                if len(self._packets) > self.max_beacons:
+                    self._packets.popitem(last=False)
+            else:
+                packet, properties = self._packets.get(key, (None, None))
+            if key in self._packets:
+                self._packets.move_to_end(key)
+
+            values = struct.unpack_from(">" + "bH" * sighting_count,
+                                        data, pos)
+            pos += 3 * sighting_count
+            beacons[bt_addr] = {
+                "s": [[values[i], round(base + values[i + 1] / 1000.0, 3)]
+                      for i in range(0, len(values), 2)],
+                "packet": packet,
+                "properties": properties,
+            }
+        batch = {"v": BATCH_VERSION,
+                 "node": node,
+                 "beacons": beacons}
+        if "trace" in message:
+            batch["trace"] = message["trace"]
+        return batch
+
+    @staticmethod
+    def _read_json(data, pos):
+        (size,) = COUNT.unpack_from(data, pos)
+        pos += COUNT.size
+        return json.loads(data[pos:pos + size].decode("utf-8")), pos + size
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of NMEA handling in CoordinateService.
+
+Compares parsing every sentence with pynmea2, as onNMEA used to, against
+NmeaFilter, which only lets the wanted sentences through to pynmea2.
+
+Run from the repo root:
+  python benchmarks/bench_nmea.py --epochs 10000
+"""
+import argparse
+import os
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "app", "src"))
+
+import pynmea2  # noqa: E402
+
+from gnss import NmeaFilter  # noqa: E402
+
+# One navigation epoch from a u-blox receiver with its default sentences on
+EPOCH = [
+    "$GNRMC,083559.00,A,4717.11437,N,00833.91522,E,0.004,77.52,091202,,,A*49",
+    "$GNVTG,77.52,T,,M,0.004,N,0.008,K,A*18",
+    "$GNGGA,083559.00,4717.11437,N,00833.91522,E,1,08,1.01,499.6,M,48.0,M,,*46",
+    "$GNGSA,A,3,23,29,07,08,09,18,26,28,,,,,1.94,1.18,1.54*13",
+    "$GPGSV,3,1,10,23,38,230,44,29,71,156,47,07,29,116,41,08,09,081,36*7F",
+    "$GPGSV,3,2,10,10,07,189,,05,05,220,,09,34,274,42,18,25,309,44*72",
+    "$GPGSV,3,3,10,26,82,187,47,28,43,056,46*77",
+    "$GNGLL,4717.11364,N,00833.91565,E,092321.00,A,A*7E",
+]
+
+
+def parse_all(lines):
+    kept = 0
+    for line in lines:
+        msg = pynmea2.parse(line)
+        if msg.__class__ is pynmea2.GGA or msg.__class__ is pynmea2.VTG:
+            kept += 1
+    return kept
+
+
+def parse_filtered(lines):
+    nmea_filter = NmeaFilter()
+    kept = 0
+    for line in lines:
+        if nmea_filter.sentence_type(line) is not None:
+            pynmea2.parse(line)
+            kept += 1
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--epochs", type=int, default=10000)
+    args = parser.parse_args()
+
+    lines = EPOCH * args.epochs
+    for name, fn in (("parse every sentence", parse_all),
+                     ("filter, then parse", parse_filtered)):
+        start = timer()
+        kept = fn(lines)
+        elapsed = timer() - start
+        print("{:22} {:8.1f} us/epoch  ({} of {} sentences parsed for use)"
+              .format(name, elapsed / args.epochs * 1e6, kept, len(lines)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the BLE scan callback hot path.
+
+Compares the old eager callback (repr strings and ISO timestamps for every
+advertisement) against BleMonitor._on_receive, which stores raw fields and
+renders them only when a message is built.
+
+Run from the repo root:
+  python benchmarks/bench_scan_callback.py --count 100000
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "app", "src"))
+os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "logs"), exist_ok=True)
+
+from beacontools import EddystoneUIDFrame  # noqa: E402
+
+from batching import BatchPublisher  # noqa: E402
+from inview import InViewStore  # noqa: E402
+from scan import BleMonitor  # noqa: E402
+from utility import UTC  # noqa: E402
+
+
+def make_packet():
+    return EddystoneUIDFrame({
+        "tx_power": -20,
+        "namespace": b"\x12\x34\x56\x78\x90\x12\x34\x67\x89\x01",
+        "instance": b"\x00\x00\x00\x00\x00\x01",
+        "rfu": b"\x00\x00",
+    })
+
+
+class LegacyCallback(object):
+    """The callback as it was: everything rendered per advertisement."""
+
+    def __init__(self):
+        self.in_view = []
+        self.published = []
+
+    def __call__(self, bt_addr, rssi, packet, properties):
+        now = datetime.now(UTC)
+        self.in_view.append(
+            {
+                "device_id": bt_addr,
+                "rssi": rssi,
+                "message": "{}".format(packet),
+                "time": now.isoformat(),
+                "status": "unpublished"
+            }
+        )
+        message = [bt_addr,
+                   rssi,
+                   "{}".format(packet),
+                   "{}".format(properties),
+                   now.isoformat(),
+                   "bench"]
+        self.published.append(message)
+
+
+def make_monitor():
+    # Skip Monitor.__init__ - we only want the callback, not a BT socket
+    monitor = BleMonitor.__new__(BleMonitor)
+    monitor.publish = True
+    monitor.node_name = "bench"
+    monitor.in_view = InViewStore()
+    monitor.batcher = BatchPublisher(lambda message: None, "bench",
+                                     window=3600, max_sightings=10 ** 9)
+    return monitor
+
+
+def run(callback, count, beacons, packet, properties):
+    addrs = ["aa:bb:cc:dd:{:02x}:{:02x}".format(i // 256, i % 256)
+             for i in range(beacons)]
+    start = timer()
+    for i in range(count):
+        callback(addrs[i % beacons], -60 - (i % 30), packet, properties)
+    return timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=100000,
+                        help='Advertisements to feed the callback')
+    parser.add_argument('--beacons', type=int, default=200,
+                        help='Distinct beacon addresses')
+    args = parser.parse_args()
+
+    packet = make_packet()
+    properties = packet.properties
+
+    legacy = run(LegacyCallback(), args.count, args.beacons,
+                 packet, properties)
+    monitor = make_monitor()
+    lazy = run(monitor._on_receive, args.count, args.beacons,
+               packet, properties)
+
+    # What the lazy path pays later, once per message
+    start = timer()
+    monitor.retrieve_in_view()
+    monitor.batcher.flush()
+    render = timer() - start
+
+    print("advertisements: {}  beacons: {}".format(args.count, args.beacons))
+    print("legacy callback: {:8.2f} us/adv".format(legacy / args.count * 1e6))
+    print("lazy callback:   {:8.2f} us/adv".format(lazy / args.count * 1e6))
+    print("deferred render: {:8.2f} ms total".format(render * 1e3))
+    print("speedup:         {:8.1f}x".format(legacy / lazy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Benchmark TrilaterationSolver backends on random fixes.
+
+Times scipy L-BFGS-B (the default) against the in-house Gauss-Newton
+solver on the same inputs, and reports how far each lands from the truth.
+
+Run from the repo root:
+  python benchmarks/bench_trilateration.py --fixes 500 --nodes 4
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "app", "src"))
+
+from trilateration import TrilaterationSolver  # noqa: E402
+
+
+def make_fixes(count, nodes, size, noise, seed):
+    rng = random.Random(seed)
+    fixes = []
+    for _ in range(count):
+        truth = (rng.uniform(0, size), rng.uniform(0, size))
+        locations = [(rng.uniform(0, size), rng.uniform(0, size))
+                     for _ in range(nodes)]
+        distances = [math.hypot(truth[0] - x, truth[1] - y) *
+                     rng.uniform(1 - noise, 1 + noise)
+                     for x, y in locations]
+        fixes.append((truth, locations, distances))
+    return fixes
+
+
+def run(solver, fixes):
+    errors = []
+    start = timer()
+    for truth, locations, distances in fixes:
+        coords = solver.best_point(locations, distances)['coords']
+        errors.append(math.hypot(coords[0] - truth[0], coords[1] - truth[1]))
+    elapsed = timer() - start
+    errors.sort()
+    return elapsed, errors[len(errors) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--fixes', type=int, default=500,
+                        help='Number of location fixes to solve')
+    parser.add_argument('--nodes', type=int, default=4,
+                        help='Nodes ranging each beacon')
+    parser.add_argument('--size', type=float, default=20.0,
+                        help='Side of the square area in meters')
+    parser.add_argument('--noise', type=float, default=0.2,
+                        help='Relative range error, uniform +/-')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fixes = make_fixes(args.fixes, args.nodes, args.size, args.noise,
+                       args.seed)
+    print("fixes: {}  nodes: {}".format(args.fixes, args.nodes))
+    results = {}
+    for method in ("L-BFGS-B", "gauss-newton"):
+        elapsed, median_err = run(TrilaterationSolver(method=method), fixes)
+        results[method] = elapsed
+        print("{:>14}: {:8.1f} us/fix  median error {:.2f} m".format(
+            method, elapsed / args.fixes * 1e6, median_err))
+    print("speedup: {:.1f}x".format(results["L-BFGS-B"] /
+                                    results["gauss-newton"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the solver, the locator and the scan callback.
+
+Each case runs in its own process, entirely offline (the locator and
+scanner use the in-memory transport), and reports throughput, per-call
+latency percentiles, Python allocations per call and peak RSS. Solver
+and locator cases also report position error against the true beacon
+positions. Results are written as JSON so runs can be compared across
+commits.
+
+Run from the repo root:
+  python benchmarks/suite.py --out before.json
+  python benchmarks/suite.py --out after.json --compare before.json
+  python benchmarks/suite.py --list
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, os.path.join(ROOT_DIR, "app", "src"))
+os.makedirs(os.path.join(ROOT_DIR, "logs"), exist_ok=True)
+
+# Calls traced for allocations; tracing is slow, so only a sample
+ALLOC_CALLS = 200
+
+
+# Each case's setup(scale, seed) returns (fn, calls, items per call,
+#   errors), where errors(outputs) takes what fn returned for each call and
+#   returns the position errors in meters, or errors is None.
+
+
+def solver_case(method, batch=None):
+    def setup(scale, seed):
+        from bench_trilateration import make_fixes
+        from trilateration import TrilaterationSolver
+
+        solver = TrilaterationSolver(method=method)
+        fixes = make_fixes(int(500 * scale), 4, 20.0, 0.2, seed)
+        truth = [fix[0] for fix in fixes]
+        sets = [(locations, distances) for _, locations, distances in fixes]
+        if batch is None:
+            def errors(outputs):
+                return [math.hypot(out['coords'][0] - x, out['coords'][1] - y)
+                        for out, (x, y) in zip(outputs, truth)]
+            return solver.best_point, sets, 1, errors
+
+        def errors(outputs):
+            coords = [c for out in outputs for c in out['coords'].tolist()]
+            return [math.hypot(c[0] - x, c[1] - y)
+                    for c, (x, y) in zip(coords, truth)]
+        return (solver.best_points,
+                [(sets[i:i + batch],) for i in range(0, len(sets), batch)],
+                batch, errors)
+    return setup
+
+
+def locator_case(batched, **locator_kwargs):
+    def setup(scale, seed):
+        from batching import unbatch
+        from locate import BeaconLocator
+        from ranging import parse_timestamp
+        from simulate import Simulator
+        from transport import make_transport
+
+        sim = Simulator(nodes=9, beacons=100, width=30.0, height=30.0,
+                        rate=1000, start=1760000000.0, seed=seed)
+        start = sim.time
+        locator = BeaconLocator(None, None, node_map=sim.nodes,
+                                transport="memory://bench",
+                                calibration=sim.calibration,
+                                **locator_kwargs)
+        located = []
+        make_transport("memory://bench").subscribe(
+            ['located'], lambda channel, message: located.append(message))
+        messages = []
+        truths = []  # True positions mid-way through each step
+        for _ in range(max(int(10 * scale), 1)):
+            step_messages, truth = sim.step()
+            messages += step_messages
+            truths.append(truth)
+
+        def errors(outputs):
+            if locator.tick:
+                locator._locate_dirty()
+            found = []
+            for bt_addr, timestamp, coords, _ in located:
+                step = min(int((parse_timestamp(timestamp) - start) /
+                               sim.window),
+                           len(truths) - 1)
+                x, y = truths[step][bt_addr]
+                found.append(math.hypot(coords[0] - x, coords[1] - y))
+            return found
+
+        if batched:
+            calls = [('raw_channel', m) for m in messages]
+            items = sum(len(slot["s"]) for m in messages
+                        for slot in m["beacons"].values())
+            return locator.handle, calls, items / float(len(calls)), errors
+        calls = [('raw_channel', sighting) for m in messages
+                 for sighting in unbatch(m)]
+        return locator.handle, calls, 1, errors
+    return setup
+
+
+def scan_case(scale, seed):
+    from scan import ScanService
+
+    service = ScanService(None, None, True, "bench",
+                          transport="memory://bench", batch_window=3600,
+                          batch_size=10 ** 9)
+    rng = random.Random(seed)
+    addrs = ["aa:bb:cc:dd:{:02x}:{:02x}".format(i // 256, i % 256)
+             for i in range(200)]
+    calls = [(rng.choice(addrs), -rng.randint(40, 90), None, None)
+             for _ in range(int(100000 * scale))]
+    return service._on_receive, calls, 1, None
+
+
+CASES = {
+    "solver.best_point[L-BFGS-B]": solver_case("L-BFGS-B"),
+    "solver.best_point[gauss-newton]": solver_case("gauss-newton"),
+    "solver.best_points[x100]": solver_case("gauss-newton", batch=100),
+    "locator.handle[sighting,gauss-newton]": locator_case(
+        False, solver_method="gauss-newton"),
+    "locator.handle[batch,gauss-newton]": locator_case(
+        True, solver_method="gauss-newton"),
+    "locator.handle[batch,kalman]": locator_case(
+        True, solver_method="gauss-newton", track="kalman"),
+    "locator.handle[batch,tick]": locator_case(
+        True, solver_method="gauss-newton", tick=3600),
+    "scan.on_receive": scan_case,
+}
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_case(name, scale, seed):
+    """Run one case in this process. :return: dict The case's results"""
+    setup = CASES[name]
+
+    fn, calls, items, errors = setup(scale, seed)
+    latencies = []
+    outputs = []
+    clock = time.perf_counter_ns
+    began = clock()
+    for args in calls:
+        start = clock()
+        output = fn(*args)
+        latencies.append(clock() - start)
+        outputs.append(output)
+    elapsed = (clock() - began) / 1e9
+    errors = sorted(errors(outputs)) if errors else []
+    outputs = None
+
+    # Fresh state for the allocation pass, so it sees the same work
+    fn, calls, _, _ = setup(scale, seed)
+    calls = calls[:ALLOC_CALLS]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for args in calls:
+        fn(*args)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    allocated = sum(max(s.size_diff, 0) for s in stats)
+    blocks = sum(max(s.count_diff, 0) for s in stats)
+
+    latencies.sort()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss_kb = usage.ru_maxrss / (1024.0 if sys.platform == "darwin" else 1.0)
+    result = {
+        "calls": len(latencies),
+        "items": int(round(items * len(latencies))),
+        "elapsed_s": elapsed,
+        "items_per_s": items * len(latencies) / elapsed,
+        "latency_us": {
+            "mean": sum(latencies) / len(latencies) / 1e3,
+            "p50": percentile(latencies, 0.5) / 1e3,
+            "p99": percentile(latencies, 0.99) / 1e3,
+            "max": latencies[-1] / 1e3,
+        },
+        "alloc": {
+            "retained_bytes_per_call": allocated / float(len(calls)),
+            "retained_blocks_per_call": blocks / float(len(calls)),
+            "peak_traced_kb": peak / 1024.0,
+        },
+        "peak_rss_kb": rss_kb,
+    }
+    if errors:
+        result["error_m"] = {
+            "located": len(errors),
+            "p50": percentile(errors, 0.5),
+            "p90": percentile(errors, 0.9),
+        }
+    return result
+
+
+def describe():
+    def git(*args):
+        try:
+            return subprocess.check_output(
+                ("git",) + args, cwd=ROOT_DIR,
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    import numpy
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def _error(result, key):
+    """:return: str The result's error percentile, or blank if it has none"""
+    if "error_m" not in result:
+        return ""
+    return "{:.2f}".format(result["error_m"][key])
+
+
+def compare(results, baseline):
+    print("\n{:42} {:>12} {:>12} {:>8}  {:>8} {:>8}  {:>8} {:>8}".format(
+        "case", "items/s", "base", "ratio", "err p50", "base",
+        "err p90", "base"))
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        print("{:42} {:12.0f} {:12.0f} {:7.2f}x  {:>8} {:>8}  {:>8} {:>8}"
+              .format(name, result["items_per_s"], base["items_per_s"],
+                      result["items_per_s"] / base["items_per_s"],
+                      _error(result, "p50"), _error(base, "p50"),
+                      _error(result, "p90"), _error(base, "p90")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--cases', nargs='*',
+                        help='Run cases whose names contain any of these')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply the work in every case')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Baseline results JSON file')
+    parser.add_argument('--list', action='store_true',
+                        help='List the cases and exit')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # Child process: one case, results on stdout
+        print(json.dumps(run_case(args.case, args.scale, args.seed)))
+        return
+    if args.list:
+        print("\n".join(CASES))
+        return
+
+    names = [name for name in CASES
+             if not args.cases or any(c in name for c in args.cases)]
+    results = {}
+    for name in names:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--case", name,
+             "--scale", str(args.scale), "--seed", str(args.seed)])
+        result = results[name] = json.loads(output.decode().splitlines()[-1])
+        print("{:42} {:12.0f} items/s  p50 {:9.1f} us  p99 {:9.1f} us  "
+              "rss {:7.0f} kB  err p50 {:>5} m".format(
+                  name, result["items_per_s"], result["latency_us"]["p50"],
+                  result["latency_us"]["p99"], result["peak_rss_kb"],
+                  _error(result, "p50") or "-"))
+
+    report = {"meta": dict(describe(), scale=args.scale, seed=args.seed),
+              "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,15 @@ from pathlib import Path
 import dotenv
 
 try:
+    from metrics import serve_metrics
+    from recording import Recorder
     from scan import ScanService
+    from transport import is_pubnub
 except ImportError:
+    from app.src.metrics import serve_metrics
+    from app.src.recording import Recorder
     from app.src.scan import ScanService
+    from app.src.transport import is_pubnub
 
 """
 The node needs publish and subscribe keys.
@@ -48,6 +54,33 @@ parser.add_argument(
 parser.add_argument(
     '--node_y', help='Your Y position in meters'
 )
+parser.add_argument(
+    '--batch_window', type=int, default=1000,
+    help='Max time to coalesce sightings into one message in milliseconds'
+)
+parser.add_argument(
+    '--batch_size', type=int, default=500,
+    help='Max sightings in one message before publishing early'
+)
+parser.add_argument(
+    '--wire_format', choices=['compact', 'json'], default='compact',
+    help='Encoding of published sightings; json for older locators'
+)
+parser.add_argument(
+    '--trace', type=float, default=0.0,
+    help='Fraction of messages to trace end to end, 0 to 1 (see tracing.py)'
+)
+parser.add_argument(
+    '--record', help='Also record published messages to this file'
+)
+parser.add_argument(
+    '--transport', default=os.environ.get("TRANSPORT", None),
+    help='pubnub (default), or a local broker like tcp://host:port'
+)
+parser.add_argument(
+    '--metrics_port', type=int, default=os.environ.get("METRICS_PORT", None),
+    help='Serve Prometheus metrics on this port'
+)
 args = parser.parse_args()
 
 # Choose or ask for publish key
@@ -70,9 +103,9 @@ if args.node_y:
     if args.node_y != '':
         node_y = args.node_y
 
-if not pub:
+if not pub and is_pubnub(args.transport):
     pub = input("What is your publish key?")
-if not sub:
+if not sub and is_pubnub(args.transport):
     sub = input("What is your subscribe key?")
 if not node:
     node = input("What is your hostname?")
@@ -81,5 +114,13 @@ if not node_x:
 if not node_y:
     node_y = input("What is your Y position in meters?")
 
-scanner = ScanService(pub, sub, True, node, (node_x, node_y))
+if args.metrics_port:
+    serve_metrics(args.metrics_port)
+
+scanner = ScanService(pub, sub, True, node, (node_x, node_y),
+                      batch_window=args.batch_window / 1000.0,
+                      batch_size=args.batch_size,
+                      transport=args.transport,
+                      wire_format=args.wire_format, trace_rate=args.trace,
+                      recorder=Recorder(args.record) if args.record else None)
 scanner.scan()
@@ -7,9 +7,13 @@ from pathlib import Path
 import dotenv
 
 try:
+    from metrics import serve_metrics
     from node import Node
+    from transport import is_pubnub
 except ImportError:
+    from app.src.metrics import serve_metrics
     from app.src.node import Node
+    from app.src.transport import is_pubnub
 
 """
 The node needs publish and subscribe keys.
@@ -56,6 +60,18 @@ parser.add_argument(
     help='Set debug mode; print messages (not published)',
     default=False
 )
+parser.add_argument(
+    '--transport', default=os.environ.get("TRANSPORT", None),
+    help='pubnub (default), or a local broker like tcp://host:port'
+)
+parser.add_argument(
+    '--ubx_pvt', action='store_true', default=False,
+    help='Have the u-blox receiver send binary NAV-PVT instead of NMEA'
+)
+parser.add_argument(
+    '--metrics_port', type=int, default=os.environ.get("METRICS_PORT", None),
+    help='Serve Prometheus metrics on this port'
+)
 args = parser.parse_args()
 
 # Choose or ask for publish key
@@ -68,13 +84,17 @@ if args.sub:
     if args.sub != '':
         sub = args.sub
 
-if not pub:
+if not pub and is_pubnub(args.transport):
     pub = input("What is your publish key?")
-if not sub:
+if not sub and is_pubnub(args.transport):
     sub = input("What is your subscribe key?")
 
 args.interval = args.interval / 1000.0
 
+if args.metrics_port:
+    serve_metrics(args.metrics_port)
+
 node = Node(args.port, pub_key=pub, sub_key=sub,
-            interval=args.interval, debug=args.debug)
+            interval=args.interval, debug=args.debug,
+            transport=args.transport, ubx_pvt=args.ubx_pvt)
 node.start()